@@ -4,6 +4,1170 @@ const path = require('path');
 const fs = require('fs');
 const crypto = require('crypto');
 const os = require('os');
+const readline = require('readline');
+const { once } = require('events');
+
+const DEFAULT_PYTHON_PATH = '/opt/venv/bin/python';
+const DEFAULT_SCRIPT_PATH = path.join(__dirname, 'scripts', 'anki_generator.py');
+const DEFAULT_IMAGE_SCRIPT_PATH = path.join(__dirname, 'scripts', 'image_normalizer.py');
+const IMAGE_NORMALIZE_TIMEOUT_MS = 5 * 60 * 1000; // 5 minutes per batch
+// Image normalization requests made this close together share one helper process
+const IMAGE_BATCH_WINDOW_MS = 50;
+const DEFAULT_MEDIA_INDEX_SCRIPT_PATH = path.join(__dirname, 'scripts', 'media_index.py');
+const MEDIA_INDEX_TIMEOUT_MS = 5 * 60 * 1000;
+const MEDIA_INDEX_FLUSH_DELAY_MS = 2000;
+
+const MEDIA_INDEX_ENABLED = process.env.MEDIA_INDEX !== '0';
+const MEDIA_INDEX_PATH = process.env.MEDIA_INDEX_PATH || path.join(__dirname, 'uploads', '.cache', 'media.sqlite');
+const MEDIA_GC_INTERVAL_MS = parseFloat(process.env.MEDIA_GC_INTERVAL_MINUTES || '60') * 60 * 1000;
+const MEDIA_GC_BUDGET_BYTES = parseInt(process.env.MEDIA_GC_BUDGET_MB || '2048') * 1024 * 1024;
+const MEDIA_GC_MAX_AGE_MS = parseFloat(process.env.MEDIA_GC_MAX_AGE_DAYS || '14') * 24 * 60 * 60 * 1000;
+const MEDIA_GC_GRACE_MS = parseFloat(process.env.MEDIA_GC_GRACE_MINUTES || '60') * 60 * 1000;
+// Cards at least this similar to an earlier card are dropped as near-duplicates (0 disables)
+const DEFAULT_DEDUPE_THRESHOLD = parseFloat(process.env.ANKI_GENERATOR_DEDUPE || '0');
+// Output formats: an .apkg package, or a text file for Anki's importer plus a media zip
+const EXPORT_FORMATS = ['apkg', 'tsv', 'csv'];
+const DEFAULT_EXPORT_FORMAT = process.env.ANKI_EXPORT_FORMAT || 'apkg';
+// Generation is allowed to run long as long as the generator keeps reporting progress; during
+// phases that move no counter it repeats its latest record every 15 seconds (HEARTBEAT_INTERVAL_SECONDS)
+const GENERATION_TIMEOUT_MS = 30 * 60 * 1000; // hard cap, 30 minutes
+const GENERATION_IDLE_TIMEOUT_MS = 2 * 60 * 1000; // 2 minutes without a progress record
+const HEALTH_CHECK_INTERVAL_MS = 30 * 1000;
+const HEALTH_CHECK_TIMEOUT_MS = 10 * 1000;
+// The generator writes newline-delimited JSON progress records to this inherited descriptor
+const PROGRESS_FD = 3;
+// Generator jobs allowed to run at once (one worker process each) and to wait behind them
+const GENERATION_CONCURRENCY = Math.max(1, parseInt(process.env.ANKI_GENERATION_CONCURRENCY || '2'));
+const GENERATION_QUEUE_LIMIT = Math.max(0, parseInt(process.env.ANKI_GENERATION_QUEUE_LIMIT || '20'));
+// Recent jobs kept for the wait/run time percentiles reported by the metrics endpoint
+const METRICS_WINDOW = 200;
+// Generated packages are kept for identical requests until the cache exceeds either limit
+const PACKAGE_CACHE_MAX_BYTES = parseInt(process.env.ANKI_PACKAGE_CACHE_MAX_MB || '1024') * 1024 * 1024;
+const PACKAGE_CACHE_MAX_AGE_MS = parseFloat(process.env.ANKI_PACKAGE_CACHE_MAX_AGE_HOURS || '168') * 60 * 60 * 1000;
+// Bump when the generator's output for the same input changes
+const PACKAGE_CACHE_VERSION = 2;
+
+/**
+ * Raised when the generation queue is already holding as many jobs as it may
+ */
+class QueueFullError extends Error {
+  constructor(limit) {
+    super(`Generation queue is full (${limit} jobs waiting)`);
+    this.name = 'QueueFullError';
+  }
+}
+
+/**
+ * Raised when a generation job is cancelled, e.g. because its client disconnected
+ */
+class GenerationCancelledError extends Error {
+  constructor(message = 'Generation was cancelled') {
+    super(message);
+    this.name = 'GenerationCancelledError';
+  }
+}
+
+/**
+ * Parses one progress record line from the generator
+ * @param {string} line Raw line read from the progress descriptor
+ * @returns {Object|null} Progress record, or null for blank or malformed lines
+ */
+function parseProgressLine(line) {
+  if (!line.trim()) return null;
+
+  try {
+    const record = JSON.parse(line);
+    return record && record.event === 'progress' ? record : null;
+  } catch (parseError) {
+    console.warn(`Ignoring malformed progress output: ${line}`);
+    return null;
+  }
+}
+
+/**
+ * Timer pair for one generation: a hard deadline plus an inactivity deadline
+ * that is pushed back every time the generator reports progress
+ * @param {Object} options Timeouts in milliseconds and the expiry callback
+ * @param {number} options.timeoutMs Hard cap on the whole request
+ * @param {number} options.idleTimeoutMs Longest allowed gap between progress records; 0 disables
+ * @param {Function} options.onTimeout Called once with an Error when either deadline passes
+ * @returns {{touch: Function, clear: Function}} Controls for the timers
+ */
+function createProgressTimeout({ timeoutMs, idleTimeoutMs = 0, onTimeout }) {
+  let idleTimer = null;
+
+  const expire = (message) => {
+    clear();
+    onTimeout(new Error(message));
+  };
+
+  const hardTimer = setTimeout(
+    () => expire(`Python generator timed out after ${Math.round(timeoutMs / 1000)} seconds`),
+    timeoutMs
+  );
+
+  const touch = () => {
+    if (!idleTimeoutMs) return;
+    clearTimeout(idleTimer);
+    idleTimer = setTimeout(
+      () => expire(`Python generator made no progress for ${Math.round(idleTimeoutMs / 1000)} seconds`),
+      idleTimeoutMs
+    );
+  };
+
+  const clear = () => {
+    clearTimeout(hardTimer);
+    clearTimeout(idleTimer);
+  };
+
+  touch();
+  return { touch, clear };
+}
+
+/**
+ * Long-lived Python generator process speaking newline-delimited JSON over stdin/stdout.
+ * Keeps the interpreter, genanki import and note models warm between decks.
+ */
+class GeneratorWorker {
+  constructor({
+    pythonPath = DEFAULT_PYTHON_PATH,
+    scriptPath = DEFAULT_SCRIPT_PATH,
+    healthCheckIntervalMs = HEALTH_CHECK_INTERVAL_MS
+  } = {}) {
+    this.pythonPath = pythonPath;
+    this.scriptPath = scriptPath;
+    this.healthCheckIntervalMs = healthCheckIntervalMs;
+    this.process = null;
+    this.pending = new Map();
+    this.nextId = 1;
+    // The Python side handles one request at a time, so requests are chained
+    this.tail = Promise.resolve();
+    this.busy = false;
+    this.healthTimer = null;
+  }
+
+  start() {
+    if (this.process) {
+      return this.process;
+    }
+
+    if (!fs.existsSync(this.scriptPath)) {
+      throw new Error(`Python script not found at ${this.scriptPath}`);
+    }
+
+    console.log(`Starting Python Anki generator worker: ${this.pythonPath} ${this.scriptPath}`);
+    const child = spawn(this.pythonPath, [this.scriptPath, '--worker', '--progress-fd', String(PROGRESS_FD)], {
+      stdio: ['pipe', 'pipe', 'pipe', 'pipe']
+    });
+    this.process = child;
+
+    // Each stdout line is one response frame
+    const lines = readline.createInterface({ input: child.stdout });
+    lines.on('line', (line) => this.handleResponse(line));
+
+    // Progress records arrive separately, tagged with the request id
+    const progressLines = readline.createInterface({ input: child.stdio[PROGRESS_FD] });
+    progressLines.on('line', (line) => this.handleProgress(line));
+
+    child.stderr.on('data', (data) => {
+      console.error(`Python worker: ${data.toString().trimEnd()}`);
+    });
+
+    child.on('error', (error) => {
+      console.error(`Python worker error: ${error.message}`);
+      this.handleExit(child, error);
+    });
+
+    // A worker that dies or closes stdin between requests makes the next write fail
+    // with EPIPE; without a listener that error would take down the server
+    child.stdin.on('error', (error) => {
+      console.error(`Python worker stdin error: ${error.message}`);
+      if (this.process !== child) return;
+      this.restart('stdin closed', new Error(`Python worker stdin error: ${error.message}`));
+    });
+
+    child.on('exit', (code, signal) => {
+      console.log(`Python worker exited with code ${code}${signal ? ` (signal ${signal})` : ''}`);
+      this.handleExit(child, new Error(`Python worker exited with code ${code}`));
+    });
+
+    if (!this.healthTimer && this.healthCheckIntervalMs > 0) {
+      this.healthTimer = setInterval(() => this.healthCheck(), this.healthCheckIntervalMs);
+      this.healthTimer.unref();
+    }
+
+    return child;
+  }
+
+  handleResponse(line) {
+    if (!line.trim()) return;
+
+    let response;
+    try {
+      response = JSON.parse(line);
+    } catch (parseError) {
+      console.warn(`Ignoring malformed worker output: ${line}`);
+      return;
+    }
+
+    const entry = this.pending.get(response.id);
+    if (!entry) {
+      console.warn(`Received response for unknown request ${response.id}`);
+      return;
+    }
+
+    this.pending.delete(response.id);
+    entry.timeout.clear();
+    delete response.id;
+    entry.resolve(response);
+  }
+
+  handleProgress(line) {
+    const record = parseProgressLine(line);
+    if (!record) return;
+
+    const entry = this.pending.get(record.id);
+    if (!entry) return;
+
+    entry.timeout.touch();
+    if (entry.onProgress) {
+      try {
+        entry.onProgress(record);
+      } catch (error) {
+        console.error(`Progress callback failed: ${error.message}`);
+      }
+    }
+  }
+
+  handleExit(child, error) {
+    if (this.process !== child) return;
+    this.process = null;
+
+    // Fail everything in flight; the next request will start a fresh worker
+    for (const [id, entry] of this.pending) {
+      entry.timeout.clear();
+      entry.reject(error);
+      this.pending.delete(id);
+    }
+  }
+
+  send(payload, timeoutMs, { idleTimeoutMs = 0, onProgress = null } = {}) {
+    return new Promise((resolve, reject) => {
+      let child;
+      try {
+        child = this.start();
+      } catch (error) {
+        return reject(error);
+      }
+
+      const id = this.nextId++;
+      const timeout = createProgressTimeout({
+        timeoutMs,
+        idleTimeoutMs,
+        onTimeout: (error) => {
+          this.pending.delete(id);
+          reject(error);
+          // A hung worker cannot be trusted with the next request
+          this.restart('request timed out');
+        }
+      });
+
+      this.pending.set(id, { resolve, reject, timeout, onProgress });
+      child.stdin.write(`${JSON.stringify({ id, ...payload })}\n`);
+    });
+  }
+
+  /**
+   * Queues a request behind any in-flight one and resolves with the worker's response
+   * @param {Object} payload Request body (op plus op-specific fields)
+   * @param {number} timeoutMs Time allowed once the request reaches the worker
+   * @param {Object} options Optional idleTimeoutMs (reset by each progress record) and onProgress callback
+   * @returns {Promise<Object>} Parsed response frame
+   */
+  request(payload, timeoutMs = GENERATION_TIMEOUT_MS, options = {}) {
+    const run = async () => {
+      this.busy = true;
+      try {
+        return await this.send(payload, timeoutMs, options);
+      } finally {
+        this.busy = false;
+      }
+    };
+
+    const result = this.tail.then(run, run);
+    this.tail = result.catch(() => {});
+    return result;
+  }
+
+  async ping(timeoutMs = HEALTH_CHECK_TIMEOUT_MS) {
+    const response = await this.request({ op: 'ping' }, timeoutMs);
+    return response.success === true;
+  }
+
+  async healthCheck() {
+    // Only probe a live, idle worker; a busy one is already proving itself
+    if (!this.process || this.busy) return;
+
+    try {
+      await this.ping();
+    } catch (error) {
+      console.warn(`Python worker health check failed: ${error.message}`);
+      this.restart('health check failed');
+    }
+  }
+
+  restart(reason, error) {
+    console.warn(`Restarting Python worker: ${reason}`);
+    this.kill(error);
+  }
+
+  kill(error = new Error('Python worker was stopped')) {
+    const child = this.process;
+    if (!child) return;
+
+    this.handleExit(child, error);
+    try {
+      child.kill();
+    } catch (e) {
+      console.error('Failed to kill Python worker:', e);
+    }
+  }
+
+  stop() {
+    if (this.healthTimer) {
+      clearInterval(this.healthTimer);
+      this.healthTimer = null;
+    }
+    this.kill();
+  }
+}
+
+// Shared workers keyed by interpreter, script and queue slot
+const workers = new Map();
+
+function getWorker(pythonPath = DEFAULT_PYTHON_PATH, scriptPath = DEFAULT_SCRIPT_PATH, slot = 0) {
+  const key = `${pythonPath}\0${scriptPath}\0${slot}`;
+  if (!workers.has(key)) {
+    workers.set(key, new GeneratorWorker({ pythonPath, scriptPath }));
+  }
+  return workers.get(key);
+}
+
+/**
+ * Starts the shared generator worker ahead of the first request
+ * @param {Object} options Optional pythonPath/scriptPath overrides
+ */
+function startWorker(options = {}) {
+  if (process.env.ANKI_GENERATOR_WORKER === '0') return;
+
+  try {
+    getWorker(options.pythonPath, options.scriptPath).start();
+  } catch (error) {
+    console.error('Failed to start Python worker:', error);
+  }
+}
+
+/**
+ * Stops all generator workers
+ */
+function stopWorkers() {
+  for (const worker of workers.values()) {
+    worker.stop();
+  }
+  workers.clear();
+}
+
+/**
+ * Rolling window of durations with summary statistics
+ */
+class DurationStats {
+  constructor(windowSize = METRICS_WINDOW) {
+    this.windowSize = windowSize;
+    this.samples = [];
+    this.count = 0;
+    this.totalMs = 0;
+    this.maxMs = 0;
+  }
+
+  record(ms) {
+    this.count++;
+    this.totalMs += ms;
+    this.maxMs = Math.max(this.maxMs, ms);
+    this.samples.push(ms);
+    if (this.samples.length > this.windowSize) {
+      this.samples.shift();
+    }
+  }
+
+  summary() {
+    const sorted = [...this.samples].sort((a, b) => a - b);
+    const percentile = (p) => (sorted.length ? sorted[Math.min(sorted.length - 1, Math.floor(p * sorted.length))] : 0);
+    return {
+      count: this.count,
+      avgMs: this.count ? Math.round(this.totalMs / this.count) : 0,
+      p50Ms: percentile(0.5),
+      p95Ms: percentile(0.95),
+      maxMs: this.maxMs
+    };
+  }
+}
+
+/**
+ * FIFO scheduler in front of the generator: at most `concurrency` jobs run at
+ * once, each on its own slot (and so its own worker process), and at most
+ * `maxQueued` wait behind them. Further submissions are rejected with a
+ * QueueFullError rather than piling up.
+ */
+class GenerationQueue {
+  constructor({ concurrency = GENERATION_CONCURRENCY, maxQueued = GENERATION_QUEUE_LIMIT } = {}) {
+    this.concurrency = concurrency;
+    this.maxQueued = maxQueued;
+    this.freeSlots = Array.from({ length: concurrency }, (_, slot) => slot);
+    this.waiting = [];
+    this.running = 0;
+    this.counters = { submitted: 0, completed: 0, failed: 0, cancelled: 0, rejected: 0 };
+    this.waitStats = new DurationStats();
+    this.runStats = new DurationStats();
+  }
+
+  /**
+   * Queues a job and resolves with its result once it has run
+   * @param {Function} task Called as task({slot, signal}) when a slot frees up
+   * @param {Object} options Optional AbortSignal, onQueued(position, queued) and onStart() callbacks
+   * @returns {Promise<*>} Whatever the task resolves with
+   */
+  submit(task, { signal, onQueued, onStart } = {}) {
+    if (signal && signal.aborted) {
+      return Promise.reject(new GenerationCancelledError());
+    }
+
+    if (this.freeSlots.length === 0 && this.waiting.length >= this.maxQueued) {
+      this.counters.rejected++;
+      return Promise.reject(new QueueFullError(this.maxQueued));
+    }
+
+    this.counters.submitted++;
+    return new Promise((resolve, reject) => {
+      const job = { task, signal, onQueued, onStart, resolve, reject, enqueuedAt: Date.now() };
+
+      if (signal) {
+        // Cancelling a job that is still waiting just drops it from the queue;
+        // running jobs watch the same signal themselves
+        job.onAbort = () => {
+          const index = this.waiting.indexOf(job);
+          if (index === -1) return;
+          this.waiting.splice(index, 1);
+          this.counters.cancelled++;
+          reject(new GenerationCancelledError());
+          this.notifyPositions();
+        };
+        signal.addEventListener('abort', job.onAbort, { once: true });
+      }
+
+      this.waiting.push(job);
+      this.drain();
+      this.notifyPositions();
+    });
+  }
+
+  drain() {
+    while (this.freeSlots.length > 0 && this.waiting.length > 0) {
+      this.run(this.waiting.shift(), this.freeSlots.shift());
+    }
+  }
+
+  async run(job, slot) {
+    const startedAt = Date.now();
+    this.waitStats.record(startedAt - job.enqueuedAt);
+    this.running++;
+
+    try {
+      if (job.onStart) job.onStart();
+      const result = await job.task({ slot, signal: job.signal });
+      this.counters.completed++;
+      job.resolve(result);
+    } catch (error) {
+      if (error instanceof GenerationCancelledError) {
+        this.counters.cancelled++;
+      } else {
+        this.counters.failed++;
+      }
+      job.reject(error);
+    } finally {
+      if (job.signal) job.signal.removeEventListener('abort', job.onAbort);
+      this.runStats.record(Date.now() - startedAt);
+      this.running--;
+      this.freeSlots.push(slot);
+      this.drain();
+      this.notifyPositions();
+    }
+  }
+
+  notifyPositions() {
+    this.waiting.forEach((job, index) => {
+      if (!job.onQueued) return;
+      // Only tell a job about changes to its own place in line
+      const update = `${index + 1}/${this.waiting.length}`;
+      if (job.lastUpdate === update) return;
+      job.lastUpdate = update;
+      try {
+        job.onQueued(index + 1, this.waiting.length);
+      } catch (error) {
+        console.error(`Queue position callback failed: ${error.message}`);
+      }
+    });
+  }
+
+  /**
+   * Point-in-time queue depth, counters and wait/run time statistics
+   * @returns {Object} Metrics snapshot
+   */
+  metrics() {
+    const now = Date.now();
+    return {
+      concurrency: this.concurrency,
+      maxQueued: this.maxQueued,
+      running: this.running,
+      queued: this.waiting.length,
+      oldestQueuedMs: this.waiting.length ? now - this.waiting[0].enqueuedAt : 0,
+      ...this.counters,
+      waitTime: this.waitStats.summary(),
+      runTime: this.runStats.summary()
+    };
+  }
+}
+
+// Every generator run goes through this queue
+const generationQueue = new GenerationQueue();
+
+/**
+ * Current generation queue and package cache metrics, for the metrics endpoint
+ * @returns {Object} Metrics snapshot
+ */
+function getGenerationMetrics() {
+  const packageCache = { hits: 0, misses: 0, coalesced: 0, evicted: 0 };
+  for (const cache of packageCaches.values()) {
+    for (const key of Object.keys(packageCache)) {
+      packageCache[key] += cache.stats[key];
+    }
+  }
+  return { ...generationQueue.metrics(), packageCache };
+}
+
+/**
+ * JSON with object keys sorted at every level, so equal values hash equally
+ * @param {*} value Any JSON-serializable value
+ * @returns {string} Canonical JSON text
+ */
+function canonicalJson(value) {
+  if (Array.isArray(value)) {
+    return `[${value.map(canonicalJson).join(',')}]`;
+  }
+  if (value && typeof value === 'object') {
+    const entries = Object.keys(value)
+      .filter(key => value[key] !== undefined)
+      .sort()
+      .map(key => `${JSON.stringify(key)}:${canonicalJson(value[key])}`);
+    return `{${entries.join(',')}}`;
+  }
+  return JSON.stringify(value === undefined ? null : value);
+}
+
+/**
+ * Size and modification time of a file, or null if it doesn't exist
+ * @param {string} filePath File to stat
+ * @returns {Array|null} [size, mtimeMs]
+ */
+function fileSignature(filePath) {
+  try {
+    const stat = fs.statSync(filePath);
+    return [stat.size, stat.mtimeMs];
+  } catch (error) {
+    return null;
+  }
+}
+
+/**
+ * Waits for a promise, rejecting early with GenerationCancelledError if the signal fires
+ * @param {Promise} promise Promise to wait for
+ * @param {AbortSignal} signal Optional cancellation signal
+ * @returns {Promise<*>} The promise's result
+ */
+function untilAborted(promise, signal) {
+  if (!signal) return promise;
+  if (signal.aborted) return Promise.reject(new GenerationCancelledError());
+
+  return new Promise((resolve, reject) => {
+    const onAbort = () => reject(new GenerationCancelledError());
+    signal.addEventListener('abort', onAbort, { once: true });
+    promise.then(resolve, reject).finally(() => signal.removeEventListener('abort', onAbort));
+  });
+}
+
+/**
+ * Content-addressed cache of generated packages in an output directory
+ *
+ * Packages are keyed by a hash of everything that determines their content
+ * (deck metadata, cards, images and the files behind them, generator
+ * settings), so a repeated request is answered with the existing file.
+ * Fields can pull in media the request doesn't list, so each entry also
+ * records the signature of every media path the generator looked up
+ * (its mediaSources); the entry is dropped once any of them changes.
+ * Identical requests that arrive while one is being built share that build.
+ * The index lives in <outputDir>/.cache/packages.json; least recently used
+ * packages are deleted once the cache exceeds its size or age limit.
+ */
+class PackageCache {
+  constructor(outputDir, { maxBytes = PACKAGE_CACHE_MAX_BYTES, maxAgeMs = PACKAGE_CACHE_MAX_AGE_MS } = {}) {
+    this.outputDir = outputDir;
+    this.indexPath = path.join(outputDir, '.cache', 'packages.json');
+    this.maxBytes = maxBytes;
+    this.maxAgeMs = maxAgeMs;
+    this.entries = null;
+    this.inflight = new Map();
+    this.stats = { hits: 0, misses: 0, coalesced: 0, evicted: 0 };
+  }
+
+  /**
+   * Hash identifying a package's content
+   * @param {Object} inputData Generator input (header fields plus cards)
+   * @param {Object} settings Generator settings and media folder
+   * @returns {string} Hex SHA-256
+   */
+  keyFor(inputData, { mediaFolder, scriptPath, backend, compact, dedupe, appendTo }) {
+    const hash = crypto.createHash('sha256');
+    const { cacheKey, ...content } = inputData;
+    const images = [...(content.images || []), ...(content.decks || []).flatMap(deck => deck.images || [])];
+
+    hash.update(canonicalJson({
+      version: PACKAGE_CACHE_VERSION,
+      generator: fileSignature(scriptPath),
+      backend,
+      compact,
+      dedupe,
+      appendTo: appendTo ? [path.basename(appendTo), fileSignature(appendTo)] : null,
+      // Image files can change on disk under the same name
+      media: images.map(image => fileSignature(path.join(mediaFolder, image.path || '')))
+    }));
+    hash.update('\0');
+    hash.update(canonicalJson(content));
+    return hash.digest('hex');
+  }
+
+  load() {
+    if (this.entries) return this.entries;
+
+    try {
+      this.entries = JSON.parse(fs.readFileSync(this.indexPath, 'utf8'));
+    } catch (error) {
+      this.entries = {};
+    }
+    return this.entries;
+  }
+
+  save() {
+    fs.mkdirSync(path.dirname(this.indexPath), { recursive: true });
+    const tempPath = `${this.indexPath}.${process.pid}.tmp`;
+    fs.writeFileSync(tempPath, JSON.stringify(this.entries));
+    fs.renameSync(tempPath, this.indexPath);
+  }
+
+  /**
+   * Cached result for a key, if its package is still on disk
+   * @param {string} key Package hash
+   * @returns {Object|null} Generator result marked cached: true
+   */
+  get(key) {
+    const entries = this.load();
+    const entry = entries[key];
+    if (!entry) return null;
+
+    if (!entryFiles(entry).every(filename => fs.existsSync(path.join(this.outputDir, filename)))) {
+      delete entries[key];
+      this.save();
+      return null;
+    }
+
+    if (!mediaUnchanged(entry.media)) {
+      console.log(`Media behind cached package ${entry.filename} changed; rebuilding`);
+      this.remove(key);
+      this.save();
+      return null;
+    }
+
+    entry.lastUsedAt = Date.now();
+    this.save();
+    touchMediaFiles(entryFiles(entry).map(filename => path.join(this.outputDir, filename)));
+    return {
+      ...entry.result,
+      filename: entry.filename,
+      path: path.join(this.outputDir, entry.filename),
+      ...(entry.mediaFilename ? { mediaFilename: entry.mediaFilename } : {}),
+      cached: true
+    };
+  }
+
+  put(key, result) {
+    const entries = this.load();
+    const now = Date.now();
+    const entry = {
+      filename: result.filename,
+      mediaFilename: result.mediaFilename,
+      createdAt: now,
+      lastUsedAt: now,
+      media: (result.mediaSources || []).map(mediaPath => [mediaPath, fileSignature(mediaPath)]),
+      result: { success: result.success, stats: result.stats, timings: result.timings }
+    };
+    entry.bytes = entryFiles(entry).reduce((sum, filename) => sum + fs.statSync(path.join(this.outputDir, filename)).size, 0);
+    entries[key] = entry;
+    this.evict();
+    this.save();
+  }
+
+  /**
+   * Deletes a package and its index entry
+   * @param {string} key Package hash
+   * @returns {boolean} False if the files couldn't be deleted (the entry is kept)
+   */
+  remove(key) {
+    const entry = this.entries[key];
+    try {
+      for (const filename of entryFiles(entry)) {
+        fs.rmSync(path.join(this.outputDir, filename), { force: true });
+      }
+    } catch (error) {
+      console.warn(`Failed to evict cached package ${entry.filename}: ${error.message}`);
+      return false;
+    }
+    delete this.entries[key];
+    return true;
+  }
+
+  /**
+   * Deletes packages unused for longer than maxAgeMs, then least recently used ones until under maxBytes
+   */
+  evict() {
+    const entries = this.load();
+    const now = Date.now();
+    const byAge = Object.entries(entries).sort(([, a], [, b]) => a.lastUsedAt - b.lastUsedAt);
+    let totalBytes = byAge.reduce((sum, [, entry]) => sum + entry.bytes, 0);
+
+    // The most recently used package is kept even if it alone exceeds the budget
+    for (const [key, entry] of byAge.slice(0, -1)) {
+      const expired = now - entry.lastUsedAt > this.maxAgeMs;
+      if (!expired && totalBytes <= this.maxBytes) continue;
+
+      if (!this.remove(key)) continue;
+      totalBytes -= entry.bytes;
+      this.stats.evicted++;
+    }
+  }
+
+  /**
+   * Returns the cached package for key, joining an identical in-flight build
+   * or running create() to build it
+   * @param {string} key Package hash
+   * @param {Function} create Builds the package and resolves with the generator result
+   * @param {AbortSignal} signal Optional cancellation signal for this caller
+   * @returns {Promise<Object>} Generator result
+   */
+  async getOrCreate(key, create, signal) {
+    for (;;) {
+      const cached = this.get(key);
+      if (cached) {
+        this.stats.hits++;
+        console.log(`Serving cached package ${cached.filename}`);
+        return cached;
+      }
+
+      const pending = this.inflight.get(key);
+      if (!pending) break;
+
+      this.stats.coalesced++;
+      try {
+        return { ...(await untilAborted(pending, signal)), coalesced: true };
+      } catch (error) {
+        // If the build we joined was cancelled by its own client, build it ourselves
+        if (!(error instanceof GenerationCancelledError) || (signal && signal.aborted)) throw error;
+      }
+    }
+
+    this.stats.misses++;
+    const build = (async () => {
+      const result = await create();
+      this.put(key, result);
+      return result;
+    })();
+    this.inflight.set(key, build);
+
+    try {
+      return await build;
+    } finally {
+      this.inflight.delete(key);
+    }
+  }
+}
+
+/**
+ * Whether every media file recorded for a cached package still has the signature it was built from
+ * @param {Array} media [path, signature] pairs; signature is null for a file that was missing
+ * @returns {boolean} True if none changed, appeared or disappeared
+ */
+function mediaUnchanged(media = []) {
+  return media.every(([mediaPath, signature]) => canonicalJson(fileSignature(mediaPath)) === canonicalJson(signature));
+}
+
+/**
+ * Files a cached package consists of: the package, plus the media zip of a flat-file export
+ * @param {Object} entry Package cache entry
+ * @returns {Array<string>} Filenames in the output directory
+ */
+function entryFiles(entry) {
+  return entry.mediaFilename ? [entry.filename, entry.mediaFilename] : [entry.filename];
+}
+
+// Package caches keyed by output directory
+const packageCaches = new Map();
+
+function getPackageCache(outputDir) {
+  if (!packageCaches.has(outputDir)) {
+    packageCaches.set(outputDir, new PackageCache(outputDir));
+  }
+  return packageCaches.get(outputDir);
+}
+
+/**
+ * Runs a generator job through the output directory's package cache, unless disabled
+ * @param {boolean} useCache Whether to consult the cache
+ * @param {string} outputDir Directory the package is written to
+ * @param {Object} inputData Generator input
+ * @param {Object} settings Settings that affect the package content
+ * @param {Function} create Builds the package
+ * @param {AbortSignal} signal Optional cancellation signal
+ * @returns {Promise<Object>} Generator result
+ */
+function cachedGeneration(useCache, outputDir, inputData, settings, create, signal) {
+  if (!useCache) return create();
+
+  const cache = getPackageCache(outputDir);
+  return cache.getOrCreate(cache.keyFor(inputData, settings), create, signal);
+}
+
+/**
+ * Logs the generator's per-stage timing breakdown for a deck
+ * @param {string} deckName Name of the deck
+ * @param {Object} result Parsed generator result
+ */
+function logGeneratorTimings(deckName, result) {
+  if (!result || !result.timings) return;
+
+  const stages = Object.entries(result.timings.stages || {})
+    .map(([name, stage]) => `${name} ${stage.seconds.toFixed(3)}s${stage.peakRssGrowthMb ? ` (peak RSS +${stage.peakRssGrowthMb} MB)` : ''}`)
+    .join(', ');
+  console.log(`Packaging timings for "${deckName}": total ${result.timings.totalSeconds.toFixed(3)}s; ${stages}`);
+
+  if (result.profile) {
+    console.log(`Profiling reports for "${deckName}":`, result.profile);
+  }
+}
+
+/**
+ * Streams deck input as NDJSON: a header line followed by one card per line
+ * @param {stream.Writable} stream Destination (temp file or Python stdin)
+ * @param {Object} inputData Deck metadata plus cards array
+ * @returns {Promise<void>} Resolves once everything has been handed to the stream
+ */
+async function writeNdjsonInput(stream, inputData) {
+  const { cards = [], ...header } = inputData;
+
+  const writeLine = async (value) => {
+    if (!stream.write(`${JSON.stringify(value)}\n`)) {
+      await once(stream, 'drain');
+    }
+  };
+
+  await writeLine(header);
+  for (const card of cards) {
+    await writeLine(card);
+  }
+  stream.end();
+}
+
+/**
+ * Deck ID derived from the deck name, so regenerating a deck keeps its ID
+ * @param {string} deckName Name of the deck
+ * @returns {number} Deck ID
+ */
+function deckIdFor(deckName) {
+  return parseInt(crypto.createHash('md5').update(deckName).digest('hex').substring(0, 8), 16) % 2147483647;
+}
+
+/**
+ * Timestamped output path for a package name
+ * @param {string} outputDir Directory to save the package
+ * @param {string} name Deck or package name
+ * @param {string} format Export format, used as the file extension
+ * @returns {string} Output path
+ */
+function packagePathFor(outputDir, name, format = 'apkg') {
+  return path.join(outputDir, `${name.replace(/[^a-z0-9]/gi, '_').toLowerCase()}_${Date.now()}.${format}`);
+}
+
+/**
+ * Checks a requested export format
+ * @param {string} format 'apkg', 'tsv' or 'csv'
+ * @returns {string} The format
+ */
+function checkExportFormat(format) {
+  if (!EXPORT_FORMATS.includes(format)) {
+    throw new Error(`Unknown export format: ${format} (expected one of ${EXPORT_FORMATS.join(', ')})`);
+  }
+  return format;
+}
+
+/**
+ * Adds the output filenames to a generator result
+ * @param {Object} result Parsed generator result
+ * @param {string} outputPath Path the package was written to
+ * @returns {Object} The result, with filename (and mediaFilename for flat-file exports with media)
+ */
+function withOutputFiles(result, outputPath) {
+  result.filename = path.basename(outputPath);
+  if (result.zip && result.zip.mediaPath) {
+    result.mediaFilename = path.basename(result.zip.mediaPath);
+  }
+  return result;
+}
+
+/**
+ * Runs the Python generator on prepared input, through the worker or a one-shot process
+ * @param {Object} inputData Header fields (deckName, deckId, images, decks...) plus the cards array
+ * @param {string} outputApkgPath Path of the package to write
+ * @param {Object} settings Resolved generator settings (see generateAnkiPackage)
+ * @returns {Promise<Object>} Result object with path to the generated package
+ */
+async function runGenerator(inputData, outputApkgPath, settings) {
+  const {
+    mediaFolder,
+    pythonPath,
+    scriptPath,
+    useWorker,
+    backend,
+    cacheDir = null,
+    appendTo = null,
+    compact,
+    dedupe,
+    jobs,
+    mediaIndex = null,
+    slot = 0,
+    signal,
+    onProgress
+  } = settings;
+  const { deckName } = inputData;
+
+  if (signal && signal.aborted) {
+    throw new GenerationCancelledError();
+  }
+
+  const reportProgress = (record) => {
+    if (!onProgress) return;
+    try {
+      onProgress(record);
+    } catch (error) {
+      console.error(`Progress callback failed: ${error.message}`);
+    }
+  };
+
+  // Create a unique ID for this generation
+  const sessionId = crypto.randomBytes(8).toString('hex');
+
+  if (useWorker) {
+    // Create a temp directory for the NDJSON input file
+    const tempDir = path.join(os.tmpdir(), `anki_gen_${sessionId}`);
+    fs.mkdirSync(tempDir, { recursive: true });
+    const inputPath = path.join(tempDir, `${sessionId}_input.ndjson`);
+
+    const worker = getWorker(pythonPath, scriptPath, slot);
+    // A cancelled job's worker is restarted; the queue gives each slot one job at a time
+    const onAbort = () => worker.restart('generation cancelled', new GenerationCancelledError());
+    if (signal) signal.addEventListener('abort', onAbort, { once: true });
+
+    try {
+      const inputStream = fs.createWriteStream(inputPath, 'utf8');
+      await writeNdjsonInput(inputStream, inputData);
+      await once(inputStream, 'finish');
+
+      console.log(`Sending deck "${deckName}" to Python worker, output: ${outputApkgPath}`);
+
+      const result = await worker.request({
+        op: 'generate',
+        input: inputPath,
+        output: outputApkgPath,
+        mediaFolder,
+        backend,
+        cacheDir,
+        appendTo,
+        compact,
+        dedupe,
+        jobs,
+        mediaIndex
+      }, GENERATION_TIMEOUT_MS, {
+        idleTimeoutMs: GENERATION_IDLE_TIMEOUT_MS,
+        onProgress: reportProgress
+      });
+
+      if (!result.success) {
+        throw new Error(`Python worker failed: ${result.error}`);
+      }
+
+      logGeneratorTimings(deckName, result);
+      return withOutputFiles(result, outputApkgPath);
+    } finally {
+      if (signal) signal.removeEventListener('abort', onAbort);
+      try {
+        fs.rmSync(tempDir, { recursive: true, force: true });
+      } catch (cleanupError) {
+        console.warn(`Cleanup error: ${cleanupError.message}`);
+      }
+    }
+  }
+
+  console.log(`Starting Python Anki generation process for deck: ${deckName}`);
+  console.log(`Output APKG: ${outputApkgPath}`);
+  console.log(`Using Python executable: ${pythonPath}`);
+  console.log(`Script path: ${scriptPath}`);
+
+  // Make sure the script directory exists
+  const scriptDir = path.dirname(scriptPath);
+  if (!fs.existsSync(scriptDir)) {
+    fs.mkdirSync(scriptDir, { recursive: true });
+  }
+
+  // Make sure the script exists
+  if (!fs.existsSync(scriptPath)) {
+    console.error(`Python script not found at ${scriptPath}`);
+    throw new Error(`Python script not found at ${scriptPath}`);
+  }
+
+  // Execute Python script as child process
+  return new Promise((resolve, reject) => {
+    // Start Python process, streaming the input over stdin
+    const pythonProcess = spawn(pythonPath, [
+      scriptPath,
+      '--progress-fd', String(PROGRESS_FD),
+      '--backend', backend,
+      ...(cacheDir ? ['--cache-dir', cacheDir] : []),
+      ...(appendTo ? ['--append-to', appendTo] : []),
+      ...(compact ? [] : ['--no-compact']),
+      ...(dedupe ? ['--dedupe', String(dedupe)] : []),
+      ...(jobs ? ['--jobs', String(jobs)] : []),
+      ...(mediaIndex ? ['--media-index', mediaIndex] : []),
+      '-',
+      outputApkgPath,
+      mediaFolder
+    ], {
+      stdio: ['pipe', 'pipe', 'pipe', 'pipe']
+    });
+
+    const stop = (error) => {
+      try {
+        pythonProcess.kill();
+      } catch (e) {
+        console.error('Failed to kill Python process:', e);
+      }
+      reject(error);
+    };
+
+    // The process is only killed if it stops reporting progress or runs past the hard cap,
+    // or if the job is cancelled
+    const timeout = createProgressTimeout({
+      timeoutMs: GENERATION_TIMEOUT_MS,
+      idleTimeoutMs: GENERATION_IDLE_TIMEOUT_MS,
+      onTimeout: stop
+    });
+    const onAbort = () => {
+      timeout.clear();
+      stop(new GenerationCancelledError());
+    };
+    if (signal) signal.addEventListener('abort', onAbort, { once: true });
+
+    const progressLines = readline.createInterface({ input: pythonProcess.stdio[PROGRESS_FD] });
+    progressLines.on('line', (line) => {
+      const record = parseProgressLine(line);
+      if (!record) return;
+      timeout.touch();
+      reportProgress(record);
+    });
+
+    // An early exit closes stdin; the close handler reports the failure
+    pythonProcess.stdin.on('error', (error) => {
+      console.error(`Python stdin error: ${error.message}`);
+    });
+
+    writeNdjsonInput(pythonProcess.stdin, inputData).catch((error) => {
+      console.error(`Error writing input to Python process: ${error.message}`);
+    });
+
+    let stdoutData = '';
+    let stderrData = '';
+
+    // Collect stdout data
+    pythonProcess.stdout.on('data', (data) => {
+      stdoutData += data.toString();
+      console.log(`Python stdout: ${data.toString()}`);
+    });
+
+    // Collect stderr data
+    pythonProcess.stderr.on('data', (data) => {
+      stderrData += data.toString();
+      console.error(`Python stderr: ${data.toString()}`);
+    });
+
+    // Handle process completion
+    pythonProcess.on('close', (code) => {
+      console.log(`Python process exited with code ${code}`);
+      timeout.clear();
+      if (signal) signal.removeEventListener('abort', onAbort);
+
+      if (code === 0) {
+        // The result is the last stdout line; log lines come before it
+        try {
+          const lines = stdoutData.trim().split('\n');
+          const result = JSON.parse(lines[lines.length - 1]);
+          logGeneratorTimings(deckName, result);
+          resolve(withOutputFiles(result, outputApkgPath));
+        } catch (parseError) {
+          console.error('Error parsing Python output:', parseError);
+          // Even if we can't parse the output, if the exit code is 0, assume success
+          resolve({
+            success: true,
+            filename: path.basename(outputApkgPath),
+            path: outputApkgPath,
+            stats: {
+              cloze: 0,
+              standard: 0,
+              error: 0
+            }
+          });
+        }
+      } else {
+        // Failed with a non-zero exit code
+        console.error('Python process failed:');
+        console.error(`STDOUT: ${stdoutData}`);
+        console.error(`STDERR: ${stderrData}`);
+        reject(new Error(`Python process failed with code ${code}: ${stderrData}`));
+      }
+    });
+
+    // Handle process errors (like if Python executable not found)
+    pythonProcess.on('error', (error) => {
+      console.error(`Python process error: ${error.message}`);
+      timeout.clear();
+      if (signal) signal.removeEventListener('abort', onAbort);
+      reject(error);
+    });
+  });
+}
 
 /**
  * Generates an Anki package using the Python script
@@ -12,7 +1176,24 @@ const os = require('os');
  * @param {Array} options.images Array of image objects
  * @param {string} options.deckName Name of the deck
  * @param {string} options.outputDir Directory to save the package
- * @returns {Promise<Object>} Result object with path to the generated package
+ * @param {boolean} options.useWorker Use the persistent worker instead of a one-shot process
+ * @param {string} options.backend Packaging backend: 'genanki' or 'sqlite' (direct bulk writer); unused when
+ *   the note cache or append mode applies, which always write through the sqlite writer
+ * @param {string} options.format Output format: 'apkg' (default), or 'tsv'/'csv' for a text file Anki
+ *   can import plus a media zip; flat formats skip the note cache and can't be appended to
+ * @param {string} options.cacheDir Folder for per-deck note caches (incremental regeneration); null (the
+ *   default unless ANKI_NOTE_CACHE_DIR is set) disables
+ * @param {string} options.cacheKey Stable key for this deck's note cache, e.g. the section ID
+ * @param {string} options.mediaIndex Media index database recording the images the package references; null disables
+ * @param {string} options.append Filename of a package in outputDir to merge into instead of rebuilding
+ * @param {boolean} options.compact Hoist repeated inline <style> blocks into model CSS and minify fields
+ * @param {number} options.dedupe Drop cards at least this similar (0-1) to an earlier card, merging tags; 0 disables
+ * @param {Function} options.onProgress Called with each progress record ({stage, notesBuilt, mediaAdded, bytesZipped})
+ * @param {Function} options.onQueued Called with (position, queued) while the job waits for a generator slot
+ * @param {AbortSignal} options.signal Cancels the job, waiting or running (e.g. when the client disconnects)
+ * @param {boolean} options.useCache Serve an identical earlier package instead of rebuilding
+ * @returns {Promise<Object>} Result object with path to the generated package (cached: true when reused;
+ *   mediaFilename names the media zip of a flat-file export)
  */
 async function generateAnkiPackage(options) {
   try {
@@ -23,151 +1204,157 @@ async function generateAnkiPackage(options) {
       outputDir = path.join(__dirname, 'uploads'),
       mediaFolder = path.join(__dirname, 'public'),
       // Use the Python from the virtual environment
-      pythonPath = '/opt/venv/bin/python',
-      scriptPath = path.join(__dirname, 'scripts', 'anki_generator.py')
+      pythonPath = DEFAULT_PYTHON_PATH,
+      scriptPath = DEFAULT_SCRIPT_PATH,
+      useWorker = process.env.ANKI_GENERATOR_WORKER !== '0',
+      backend: apkgBackend = process.env.ANKI_GENERATOR_BACKEND || 'genanki',
+      format = DEFAULT_EXPORT_FORMAT,
+      cacheDir: noteCacheDir = process.env.ANKI_NOTE_CACHE_DIR || null,
+      cacheKey,
+      mediaIndex = MEDIA_INDEX_ENABLED ? MEDIA_INDEX_PATH : null,
+      append,
+      compact = process.env.ANKI_GENERATOR_COMPACT !== '0',
+      dedupe = DEFAULT_DEDUPE_THRESHOLD,
+      useCache = process.env.ANKI_PACKAGE_CACHE !== '0',
+      onProgress,
+      onQueued,
+      signal
     } = options;
 
-    // Create a unique ID for this generation
-    const sessionId = crypto.randomBytes(8).toString('hex');
-    
     // Ensure output directory exists
     if (!fs.existsSync(outputDir)) {
       fs.mkdirSync(outputDir, { recursive: true });
     }
 
-    // Create a temp directory for intermediate files
-    const tempDir = path.join(os.tmpdir(), `anki_gen_${sessionId}`);
-    if (!fs.existsSync(tempDir)) {
-      fs.mkdirSync(tempDir, { recursive: true });
-    }
-
     // Prepare input data
     const inputData = {
       deckName,
       cards,
       images,
-      deckId: parseInt(crypto.createHash('md5').update(deckName).digest('hex').substring(0, 8), 16) % 2147483647
+      deckId: deckIdFor(deckName),
+      cacheKey
     };
 
-    // Input and output file paths
-    const inputJsonPath = path.join(tempDir, `${sessionId}_input.json`);
-    const outputApkgPath = path.join(outputDir, `${deckName.replace(/[^a-z0-9]/gi, '_').toLowerCase()}_${Date.now()}.apkg`);
-
-    // Write input data to JSON file
-    fs.writeFileSync(inputJsonPath, JSON.stringify(inputData, null, 2), 'utf8');
+    // Flat-file formats are written by their own generator backend, without the note cache
+    const flat = checkExportFormat(format) !== 'apkg';
+    const backend = flat ? format : apkgBackend;
+    const cacheDir = flat ? null : noteCacheDir;
+    const outputApkgPath = packagePathFor(outputDir, deckName, format);
 
-    console.log(`Starting Python Anki generation process for deck: ${deckName}`);
-    console.log(`Input JSON: ${inputJsonPath}`);
-    console.log(`Output APKG: ${outputApkgPath}`);
-    console.log(`Using Python executable: ${pythonPath}`);
-    console.log(`Script path: ${scriptPath}`);
-
-    // Make sure the script directory exists
-    const scriptDir = path.dirname(scriptPath);
-    if (!fs.existsSync(scriptDir)) {
-      fs.mkdirSync(scriptDir, { recursive: true });
+    // Only packages we generated ourselves can be appended to
+    let appendTo = null;
+    if (append) {
+      if (flat) {
+        throw new Error(`Appending only applies to .apkg output, not ${format}`);
+      }
+      appendTo = path.join(outputDir, path.basename(append));
+      if (!fs.existsSync(appendTo)) {
+        throw new Error(`Package to append to not found: ${path.basename(append)}`);
+      }
     }
 
-    // Make sure the script exists
-    if (!fs.existsSync(scriptPath)) {
-      console.error(`Python script not found at ${scriptPath}`);
-      throw new Error(`Python script not found at ${scriptPath}`);
-    }
-
-    // Execute Python script as child process
-    return new Promise((resolve, reject) => {
-      // Start Python process
-      const pythonProcess = spawn(pythonPath, [
+    const settings = { mediaFolder, scriptPath, backend, compact, dedupe, appendTo };
+    return await cachedGeneration(useCache, outputDir, inputData, settings, () => generationQueue.submit(
+      ({ slot, signal: jobSignal }) => runGenerator(inputData, outputApkgPath, {
+        mediaFolder,
+        pythonPath,
         scriptPath,
-        inputJsonPath,
-        outputApkgPath,
-        mediaFolder
-      ]);
-
-      let stdoutData = '';
-      let stderrData = '';
-
-      // Collect stdout data
-      pythonProcess.stdout.on('data', (data) => {
-        stdoutData += data.toString();
-        console.log(`Python stdout: ${data.toString()}`);
-      });
+        useWorker,
+        backend,
+        cacheDir,
+        appendTo,
+        compact,
+        dedupe,
+        mediaIndex,
+        slot,
+        signal: jobSignal,
+        onProgress
+      }),
+      { signal, onQueued }
+    ), signal);
+  } catch (error) {
+    console.error('Error in generateAnkiPackage:', error);
+    throw error;
+  }
+}
 
-      // Collect stderr data
-      pythonProcess.stderr.on('data', (data) => {
-        stderrData += data.toString();
-        console.error(`Python stderr: ${data.toString()}`);
-      });
+/**
+ * Generates one package holding several decks in a single generator run,
+ * e.g. a whole notebook with one "Section::Page" subdeck per page
+ * @param {Object} options Configuration options
+ * @param {string} options.packageName Name of the package file
+ * @param {Array} options.decks Deck specs ({deckName, cards, images}); "::" in a name makes it a subdeck
+ * @param {string} options.outputDir Directory to save the package
+ * @param {boolean} options.useWorker Use the persistent worker instead of a one-shot process
+ * @param {boolean} options.compact Hoist repeated inline <style> blocks into model CSS and minify fields
+ * @param {number} options.dedupe Drop cards at least this similar (0-1) to an earlier card of the same deck; 0 disables
+ * @param {number} options.jobs Processes the generator may use to build decks (default: its CPU count)
+ * @param {string} options.format Output format: 'apkg' (default), or 'tsv'/'csv' with a deck column
+ * @param {string} options.mediaIndex Media index database recording the images the package references; null disables
+ * @param {Function} options.onProgress Called with each progress record ({stage, notesBuilt, mediaAdded, bytesZipped})
+ * @param {Function} options.onQueued Called with (position, queued) while the job waits for a generator slot
+ * @param {AbortSignal} options.signal Cancels the job, waiting or running (e.g. when the client disconnects)
+ * @param {boolean} options.useCache Serve an identical earlier package instead of rebuilding
+ * @returns {Promise<Object>} Result object with path to the generated package; stats.decks has per-deck counts
+ */
+async function generateBatchPackage(options) {
+  try {
+    const {
+      packageName,
+      decks,
+      outputDir = path.join(__dirname, 'uploads'),
+      mediaFolder = path.join(__dirname, 'public'),
+      pythonPath = DEFAULT_PYTHON_PATH,
+      scriptPath = DEFAULT_SCRIPT_PATH,
+      useWorker = process.env.ANKI_GENERATOR_WORKER !== '0',
+      compact = process.env.ANKI_GENERATOR_COMPACT !== '0',
+      dedupe = DEFAULT_DEDUPE_THRESHOLD,
+      jobs = parseInt(process.env.ANKI_GENERATOR_JOBS || '0') || undefined,
+      format = DEFAULT_EXPORT_FORMAT,
+      mediaIndex = MEDIA_INDEX_ENABLED ? MEDIA_INDEX_PATH : null,
+      useCache = process.env.ANKI_PACKAGE_CACHE !== '0',
+      onProgress,
+      onQueued,
+      signal
+    } = options;
 
-      // Handle process completion
-      pythonProcess.on('close', (code) => {
-        console.log(`Python process exited with code ${code}`);
-        
-        try {
-          // Clean up temp files
-          if (fs.existsSync(inputJsonPath)) {
-            fs.unlinkSync(inputJsonPath);
-          }
-          
-          if (fs.existsSync(tempDir)) {
-            fs.rmdirSync(tempDir, { recursive: true });
-          }
-        } catch (cleanupError) {
-          console.warn(`Cleanup error: ${cleanupError.message}`);
-        }
+    if (!Array.isArray(decks) || decks.length === 0) {
+      throw new Error('Batch export needs at least one deck');
+    }
 
-        if (code === 0) {
-          // Try to parse JSON result from stdout
-          try {
-            const result = JSON.parse(stdoutData);
-            result.filename = path.basename(outputApkgPath);
-            resolve(result);
-          } catch (parseError) {
-            console.error('Error parsing Python output:', parseError);
-            // Even if we can't parse the output, if the exit code is 0, assume success
-            resolve({
-              success: true,
-              filename: path.basename(outputApkgPath),
-              path: outputApkgPath,
-              stats: {
-                cloze: 0,
-                standard: 0,
-                error: 0
-              }
-            });
-          }
-        } else {
-          // Failed with a non-zero exit code
-          console.error('Python process failed:');
-          console.error(`STDOUT: ${stdoutData}`);
-          console.error(`STDERR: ${stderrData}`);
-          reject(new Error(`Python process failed with code ${code}: ${stderrData}`));
-        }
-      });
+    if (!fs.existsSync(outputDir)) {
+      fs.mkdirSync(outputDir, { recursive: true });
+    }
 
-      // Handle process errors (like if Python executable not found)
-      pythonProcess.on('error', (error) => {
-        console.error(`Python process error: ${error.message}`);
-        reject(error);
-      });
+    // Cards share one stream, tagged with their deck's index; the generator
+    // pools every deck's images into one deduplicated media set
+    const inputData = {
+      deckName: packageName,
+      decks: decks.map(deck => ({ deckName: deck.deckName, deckId: deckIdFor(deck.deckName) })),
+      images: decks.flatMap(deck => deck.images || []),
+      cards: decks.flatMap((deck, index) => (deck.cards || []).map(card => ({ ...card, deck: index })))
+    };
 
-      // Set a timeout in case the process hangs
-      const timeout = setTimeout(() => {
-        try {
-          pythonProcess.kill();
-        } catch (e) {
-          console.error('Failed to kill Python process:', e);
-        }
-        reject(new Error('Python process timed out after 5 minutes'));
-      }, 5 * 60 * 1000); // 5 minute timeout
+    console.log(`Batch export "${packageName}": ${decks.length} decks, ${inputData.cards.length} cards`);
 
-      // Clear timeout when process ends
-      pythonProcess.on('close', () => {
-        clearTimeout(timeout);
-      });
-    });
+    const outputApkgPath = packagePathFor(outputDir, packageName, checkExportFormat(format));
+    // Batch packages are always written by the direct SQLite writer
+    const settings = { mediaFolder, scriptPath, backend: format === 'apkg' ? 'sqlite' : format, compact, dedupe };
+    return await cachedGeneration(useCache, outputDir, inputData, settings, () => generationQueue.submit(
+      ({ slot, signal: jobSignal }) => runGenerator(inputData, outputApkgPath, {
+        ...settings,
+        pythonPath,
+        useWorker,
+        jobs,
+        mediaIndex,
+        slot,
+        signal: jobSignal,
+        onProgress
+      }),
+      { signal, onQueued }
+    ), signal);
   } catch (error) {
-    console.error('Error in generateAnkiPackage:', error);
+    console.error('Error in generateBatchPackage:', error);
     throw error;
   }
 }
@@ -179,9 +1366,19 @@ async function generateAnkiPackage(options) {
  * @returns {Array} Processed cards ready for Anki generation
  */
 function prepareCardsForAnki(flashcards, processedImages = []) {
+  // Position of each card within its source page, for stable note GUIDs
+  const pagePositions = new Map();
+
   return flashcards.map(card => {
     // Determine card type
     const isCloze = card.type === 'cloze' || (card.text && card.text.includes('{{c'));
+
+    let sourceKey;
+    if (card.sourcePageId) {
+      const position = pagePositions.get(card.sourcePageId) || 0;
+      pagePositions.set(card.sourcePageId, position + 1);
+      sourceKey = `${card.sourcePageId}:${position}`;
+    }
     
     // Format card object for Python script
     return {
@@ -191,7 +1388,8 @@ function prepareCardsForAnki(flashcards, processedImages = []) {
       answer: card.answer || '',
       notes: card.notes || '',
       tags: card.tags || [],
-      relatedImages: card.relatedImages || []
+      relatedImages: card.relatedImages || [],
+      sourceKey
     };
   });
 }
@@ -209,8 +1407,300 @@ function prepareImagesForAnki(images) {
   }));
 }
 
+/**
+ * Runs a Python helper that reads one JSON request on stdin and prints one JSON result
+ * @param {string} pythonPath Path to Python executable
+ * @param {Array} args Script path and arguments
+ * @param {Object} request JSON request written to stdin
+ * @param {number} timeoutMs Time allowed before the helper is killed
+ * @param {string} label Name used in log lines and errors
+ * @returns {Promise<Object>} Parsed result, rejected unless it has success: true
+ */
+function runJsonHelper(pythonPath, args, request, timeoutMs, label) {
+  return new Promise((resolve, reject) => {
+    const pythonProcess = spawn(pythonPath, args);
+    const timer = setTimeout(() => {
+      pythonProcess.kill();
+      reject(new Error(`${label} timed out after ${timeoutMs / 1000} seconds`));
+    }, timeoutMs);
+
+    let stdoutData = '';
+    let stderrData = '';
+    pythonProcess.stdout.on('data', (data) => {
+      stdoutData += data.toString();
+    });
+    pythonProcess.stderr.on('data', (data) => {
+      stderrData += data.toString();
+    });
+
+    // An early exit closes stdin; the close handler reports the failure
+    pythonProcess.stdin.on('error', (error) => {
+      console.error(`${label} stdin error: ${error.message}`);
+    });
+    pythonProcess.stdin.end(JSON.stringify(request));
+
+    pythonProcess.on('close', (code) => {
+      clearTimeout(timer);
+      if (stderrData.trim()) {
+        console.log(`${label}: ${stderrData.trim()}`);
+      }
+
+      try {
+        const result = JSON.parse(stdoutData);
+        if (code === 0 && result.success) {
+          resolve(result);
+          return;
+        }
+        reject(new Error(`${label} failed: ${result.error}`));
+      } catch (parseError) {
+        reject(new Error(`${label} failed with code ${code}: ${stderrData}`));
+      }
+    });
+
+    pythonProcess.on('error', (error) => {
+      clearTimeout(timer);
+      reject(error);
+    });
+  });
+}
+
+// Pending image normalization batches keyed by their helper settings
+const imageBatches = new Map();
+
+/**
+ * Downscales and recompresses oversized raster images with the Python image helper
+ *
+ * Calls made within IMAGE_BATCH_WINDOW_MS of each other, or while a helper
+ * run is in flight, are merged into the next run, so the pages of an export
+ * share a helper process (and its process pool) instead of starting one each.
+ * @param {Array} images Array of {input, output} objects; output is a path without extension
+ * @param {Object} options Configuration options
+ * @param {number} options.maxDimension Longest side in pixels
+ * @param {number} options.maxBytes Byte budget per image
+ * @param {number} options.jobs Processes used to normalize in parallel (default: CPU count)
+ * @param {string} options.pythonPath Path to Python executable
+ * @param {string} options.scriptPath Path to image_normalizer.py
+ * @returns {Promise<Array>} One result per image ({input, output, bytesBefore, bytesAfter, changed} or
+ *   {input, error}); output is null for an image kept as it is
+ */
+function normalizeImages(images, options = {}) {
+  const {
+    maxDimension,
+    maxBytes,
+    jobs,
+    pythonPath = DEFAULT_PYTHON_PATH,
+    scriptPath = DEFAULT_IMAGE_SCRIPT_PATH
+  } = options;
+  const settings = { maxDimension, maxBytes, jobs, pythonPath, scriptPath };
+  const key = canonicalJson(settings);
+
+  if (!imageBatches.has(key)) {
+    imageBatches.set(key, { settings, waiting: [], running: false, timer: null });
+  }
+  const batch = imageBatches.get(key);
+  return new Promise((resolve, reject) => {
+    batch.waiting.push({ images, resolve, reject });
+    scheduleImageBatch(batch);
+  });
+}
+
+function scheduleImageBatch(batch) {
+  if (batch.running || batch.timer || batch.waiting.length === 0) return;
+  batch.timer = setTimeout(() => runImageBatch(batch), IMAGE_BATCH_WINDOW_MS);
+}
+
+/**
+ * Runs the image helper once for every waiting caller, then starts the next batch if more arrived
+ * @param {Object} batch Entry of imageBatches
+ */
+async function runImageBatch(batch) {
+  const { maxDimension, maxBytes, jobs, pythonPath, scriptPath } = batch.settings;
+  const callers = batch.waiting.splice(0);
+  batch.timer = null;
+  batch.running = true;
+
+  try {
+    // Callers often ask for the same content (and so the same output) more than once
+    const requests = new Map();
+    for (const { images } of callers) {
+      for (const image of images) {
+        if (!requests.has(image.output)) requests.set(image.output, image);
+      }
+    }
+
+    const args = [scriptPath];
+    if (jobs) {
+      args.push('--jobs', String(jobs));
+    }
+    const result = await runJsonHelper(pythonPath, args, { images: [...requests.values()], maxDimension, maxBytes },
+      IMAGE_NORMALIZE_TIMEOUT_MS, 'Image normalization');
+
+    const byOutput = new Map([...requests.keys()].map((output, i) => [output, result.images[i]]));
+    for (const { images, resolve } of callers) {
+      resolve(images.map(image => byOutput.get(image.output)));
+    }
+  } catch (error) {
+    for (const { reject } of callers) {
+      reject(error);
+    }
+  } finally {
+    batch.running = false;
+    scheduleImageBatch(batch);
+  }
+}
+
+/**
+ * Runs ops against the media index with the Python index helper
+ * @param {Array} ops record, touch, release and gc ops (see scripts/media_index.py)
+ * @param {Object} options Configuration options
+ * @param {string} options.dbPath Media index database
+ * @param {string} options.pythonPath Path to Python executable
+ * @param {string} options.scriptPath Path to media_index.py
+ * @returns {Promise<Array>} One result per op
+ */
+async function runMediaIndex(ops, options = {}) {
+  const {
+    dbPath = MEDIA_INDEX_PATH,
+    pythonPath = DEFAULT_PYTHON_PATH,
+    scriptPath = DEFAULT_MEDIA_INDEX_SCRIPT_PATH
+  } = options;
+
+  const result = await runJsonHelper(pythonPath, [scriptPath], { db: dbPath, ops },
+    MEDIA_INDEX_TIMEOUT_MS, 'Media index');
+  return result.results;
+}
+
+// Record and touch ops are batched into one helper run; runs never overlap
+let pendingMediaOps = [];
+let mediaFlushTimer = null;
+let mediaIndexChain = Promise.resolve();
+
+function scheduleMediaFlush() {
+  if (mediaFlushTimer) return;
+  mediaFlushTimer = setTimeout(() => {
+    mediaFlushTimer = null;
+    flushMediaIndex().catch(error => console.warn(`Media index update failed: ${error.message}`));
+  }, MEDIA_INDEX_FLUSH_DELAY_MS);
+  mediaFlushTimer.unref();
+}
+
+/**
+ * Queues the files an owner references, replacing what it referenced before
+ * @param {string} owner File that keeps the paths alive, like a page cache entry
+ * @param {Array<string>} paths Absolute paths of referenced images
+ * @param {string} ownerKind Kind of the owner file
+ */
+function recordMediaReferences(owner, paths, ownerKind = 'page') {
+  if (!MEDIA_INDEX_ENABLED) return;
+  pendingMediaOps.push({ op: 'record', owner, ownerKind, paths });
+  scheduleMediaFlush();
+}
+
+/**
+ * Queues marking indexed files as just used
+ * @param {Array<string>} paths Absolute paths
+ */
+function touchMediaFiles(paths) {
+  if (!MEDIA_INDEX_ENABLED || !paths.length) return;
+  pendingMediaOps.push({ op: 'touch', paths });
+  scheduleMediaFlush();
+}
+
+/**
+ * Writes queued ops, plus any extra ones, to the media index
+ * @param {Array} extraOps Ops run after the queued ones
+ * @param {Object} options Options for runMediaIndex
+ * @returns {Promise<Array>} Results of the extra ops
+ */
+function flushMediaIndex(extraOps = [], options = {}) {
+  const ops = pendingMediaOps;
+  pendingMediaOps = [];
+  if (mediaFlushTimer) {
+    clearTimeout(mediaFlushTimer);
+    mediaFlushTimer = null;
+  }
+
+  const run = mediaIndexChain.then(async () => {
+    if (!ops.length && !extraOps.length) return [];
+    const results = await runMediaIndex([...ops, ...extraOps], options);
+    return results.slice(ops.length);
+  });
+  mediaIndexChain = run.catch(() => {});
+  return run;
+}
+
+/**
+ * Removes expired, unreferenced and over-budget files under the given folders
+ * @param {Object} options Configuration options
+ * @param {Array} options.roots Array of {path, kind}; kind 'image' files live only while referenced
+ * @param {boolean} options.dryRun Report what would be deleted without deleting (default: true)
+ * @param {number} options.budgetBytes Bytes the roots may hold in total (0 for no budget)
+ * @param {number} options.maxAgeMs Unused time after which packages and caches expire (0 to keep)
+ * @param {number} options.graceMs Age an unreferenced image must reach before it is deleted
+ * @returns {Promise<Object>} GC report (see scripts/media_index.py)
+ */
+async function collectMediaGarbage(options = {}) {
+  const {
+    roots,
+    dryRun = true,
+    budgetBytes = MEDIA_GC_BUDGET_BYTES,
+    maxAgeMs = MEDIA_GC_MAX_AGE_MS,
+    graceMs = MEDIA_GC_GRACE_MS,
+    ...indexOptions
+  } = options;
+
+  const [report] = await flushMediaIndex([{
+    op: 'gc',
+    roots,
+    dryRun,
+    budgetBytes: budgetBytes || null,
+    maxAgeSeconds: maxAgeMs ? maxAgeMs / 1000 : null,
+    graceSeconds: graceMs / 1000
+  }], indexOptions);
+  return report;
+}
+
+/**
+ * Runs the garbage collector on an interval
+ * @param {Array} roots Array of {path, kind}
+ * @param {number} intervalMs Time between runs (0 disables)
+ * @returns {NodeJS.Timeout|null} Interval timer
+ */
+function startMediaGc(roots, intervalMs = MEDIA_GC_INTERVAL_MS) {
+  if (!MEDIA_INDEX_ENABLED || !intervalMs) return null;
+
+  const timer = setInterval(async () => {
+    try {
+      const report = await collectMediaGarbage({ roots, dryRun: false });
+      if (report.bytesFreed || report.failed) {
+        console.log(`Media GC freed ${report.bytesFreed} bytes ` +
+          `(${report.deleted.expired} expired, ${report.deleted.unreferenced} unreferenced, ` +
+          `${report.deleted.budget} over budget, ${report.failed} failed) in ${report.seconds}s`);
+      }
+    } catch (error) {
+      console.warn(`Media GC failed: ${error.message}`);
+    }
+  }, intervalMs);
+  timer.unref();
+  return timer;
+}
+
 module.exports = {
+  GeneratorWorker,
+  GenerationQueue,
+  QueueFullError,
+  GenerationCancelledError,
+  getGenerationMetrics,
+  startWorker,
+  stopWorkers,
   generateAnkiPackage,
+  generateBatchPackage,
   prepareCardsForAnki,
-  prepareImagesForAnki
+  prepareImagesForAnki,
+  normalizeImages,
+  recordMediaReferences,
+  touchMediaFiles,
+  flushMediaIndex,
+  collectMediaGarbage,
+  startMediaGc
 };
\ No newline at end of file
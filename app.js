@@ -9,6 +9,7 @@ const { JSDOM } = require('jsdom');
 const AnkiExport = require('anki-apkg-export').default;
 const session = require('express-session');
 const crypto = require('crypto');
+const { pipeline } = require('stream/promises');
 const { v4: uuidv4 } = require('uuid');
 const { GoogleGenerativeAI } = require("@google/generative-ai");
 
@@ -71,6 +72,119 @@ const REDIRECT_URI = process.env.REDIRECT_URI || `https://autoanki.fly.dev/auth/
 
 // Initialize Gemini API
 const genAI = new GoogleGenerativeAI(process.env.GOOGLE_API_KEY);
+const AI_MODEL_NAME = "gemini-2.5-pro-exp-03-25";
+
+// AI output (concept map, image analyses, flashcards) cached per OneNote page
+const PAGE_CACHE_ENABLED = process.env.PAGE_AI_CACHE !== '0';
+const PAGE_CACHE_DIR = process.env.PAGE_AI_CACHE_DIR || path.join(UPLOADS_DIR, '.cache', 'pages');
+// Bump when prompts or post-processing change so old AI output is regenerated
+const PAGE_CACHE_VERSION = 1;
+
+// Microsoft Graph endpoint (overridable to point at a local mock server)
+const GRAPH_API_BASE = process.env.GRAPH_API_BASE || 'https://graph.microsoft.com/v1.0';
+// Notebook, section and page lists are reused within a session for this long
+const GRAPH_CACHE_TTL_MS = parseFloat(process.env.GRAPH_CACHE_TTL_SECONDS || '60') * 1000;
+// Retries for throttled (429) or temporarily unavailable (503/504) Graph calls
+const GRAPH_MAX_RETRIES = 3;
+
+// Pages of one export processed at the same time
+const PAGE_CONCURRENCY = parseInt(process.env.PAGE_CONCURRENCY || '4');
+
+// Downloaded raster images larger than these limits are downscaled and recompressed
+const IMAGE_NORMALIZE_ENABLED = process.env.IMAGE_NORMALIZE !== '0';
+const IMAGE_MAX_DIMENSION = parseInt(process.env.IMAGE_MAX_DIMENSION || '1600');
+const IMAGE_MAX_BYTES = parseInt(process.env.IMAGE_MAX_KB || '512') * 1024;
+// Downloads larger than this are abandoned
+const IMAGE_MAX_DOWNLOAD_BYTES = parseInt(process.env.IMAGE_MAX_DOWNLOAD_MB || '25') * 1024 * 1024;
+const IMAGE_CACHE_DIR = path.join(UPLOADS_DIR, '.cache', 'images');
+const RASTER_IMAGE_EXTENSIONS = new Set(['.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff']);
+const IMAGE_MIME_TYPES = {
+  '.svg': 'image/svg+xml',
+  '.jpg': 'image/jpeg',
+  '.jpeg': 'image/jpeg',
+  '.gif': 'image/gif',
+  '.webp': 'image/webp'
+};
+
+// Folders the media garbage collector manages. Images live while a cached page
+// or package references them; the other kinds expire when unused (see MEDIA_GC_*)
+const MEDIA_GC_ROOTS = [
+  { path: IMAGES_DIR, kind: 'image' },
+  { path: UPLOADS_DIR, kind: 'package' },
+  { path: PAGE_CACHE_DIR, kind: 'page' },
+  { path: IMAGE_CACHE_DIR, kind: 'cache' }
+];
+
+// Runs at most `concurrency` tasks at once, starting them at least
+// minIntervalMs apart (for APIs with a requests-per-minute quota)
+function createLimiter(concurrency, minIntervalMs = 0) {
+  const waiting = [];
+  let active = 0;
+  let nextStartAt = 0;
+  
+  const startNext = () => {
+    while (active < concurrency && waiting.length > 0) {
+      const { task, resolve, reject } = waiting.shift();
+      const now = Date.now();
+      const delayMs = Math.max(0, nextStartAt - now);
+      nextStartAt = Math.max(nextStartAt, now) + minIntervalMs;
+      active++;
+      
+      setTimeout(() => {
+        Promise.resolve()
+          .then(task)
+          .then(resolve, reject)
+          .finally(() => {
+            active--;
+            startNext();
+          });
+      }, delayMs);
+    }
+  };
+  
+  return task => new Promise((resolve, reject) => {
+    waiting.push({ task, resolve, reject });
+    startNext();
+  });
+}
+
+// Shared by every export, so the limits hold across concurrent users
+const graphLimiter = createLimiter(parseInt(process.env.GRAPH_CONCURRENCY || '4'));
+const imageDownloadLimiter = createLimiter(parseInt(process.env.IMAGE_DOWNLOAD_CONCURRENCY || '6'));
+const AI_REQUESTS_PER_MINUTE = parseFloat(process.env.AI_REQUESTS_PER_MINUTE || '0');
+const aiLimiter = createLimiter(
+  parseInt(process.env.AI_CONCURRENCY || '4'),
+  AI_REQUESTS_PER_MINUTE > 0 ? 60000 / AI_REQUESTS_PER_MINUTE : 0
+);
+
+// Call Gemini through the shared AI concurrency and rate limits
+function generateWithAI(request) {
+  return aiLimiter(() => genAI.getGenerativeModel({ model: AI_MODEL_NAME }).generateContent(request));
+}
+
+// Run worker over items with at most `concurrency` in flight, returning
+// { value } or { error } per item in the original order so one failing page
+// doesn't stop the others. onSettled is called as each item finishes, and
+// no new items are started once the signal aborts.
+async function mapPagesConcurrently(items, worker, { concurrency = PAGE_CONCURRENCY, signal, onSettled = () => {} } = {}) {
+  const outcomes = new Array(items.length);
+  let nextIndex = 0;
+  
+  const runWorker = async () => {
+    while (nextIndex < items.length && !(signal && signal.aborted)) {
+      const index = nextIndex++;
+      try {
+        outcomes[index] = { value: await worker(items[index], index) };
+      } catch (error) {
+        outcomes[index] = { error };
+      }
+      onSettled(outcomes[index], items[index], index);
+    }
+  };
+  
+  await Promise.all(Array.from({ length: Math.min(concurrency, items.length) }, runWorker));
+  return outcomes;
+}
 
 // Authentication middleware
 function ensureAuthenticated(req, res, next) {
@@ -117,26 +231,49 @@ async function getAccessToken(req) {
   return req.session.accessToken;
 }
 
+// Delay before retrying a throttled Graph call: Retry-After (seconds or an
+// HTTP date) when Graph sends it, otherwise exponential backoff
+function graphRetryDelayMs(retryAfter, attempt) {
+  if (retryAfter) {
+    const seconds = Number(retryAfter);
+    if (!Number.isNaN(seconds)) return Math.max(0, seconds * 1000);
+    
+    const date = Date.parse(retryAfter);
+    if (!Number.isNaN(date)) return Math.max(0, date - Date.now());
+  }
+  return 1000 * 2 ** attempt;
+}
+
 // Microsoft Graph API functions
 async function callGraphAPI(req, url, options = {}) {
-  try {
-    const accessToken = await getAccessToken(req);
-    
-    const response = await axios({
-      url: url.startsWith('https://') ? url : `https://graph.microsoft.com/v1.0${url}`,
-      method: options.method || 'GET',
-      headers: {
-        Authorization: `Bearer ${accessToken}`,
-        ...options.headers
-      },
-      data: options.data,
-      params: options.params,
-      responseType: options.responseType || 'json'
-    });
-    return response.data;
-  } catch (error) {
-    console.error(`Error calling Graph API (${url}):`, error.response?.data || error.message);
-    throw error;
+  for (let attempt = 0; ; attempt++) {
+    try {
+      const accessToken = await getAccessToken(req);
+      
+      const response = await graphLimiter(() => axios({
+        url: /^https?:\/\//.test(url) ? url : `${GRAPH_API_BASE}${url}`,
+        method: options.method || 'GET',
+        headers: {
+          Authorization: `Bearer ${accessToken}`,
+          ...options.headers
+        },
+        data: options.data,
+        params: options.params,
+        responseType: options.responseType || 'json'
+      }));
+      return response.data;
+    } catch (error) {
+      const status = error.response?.status;
+      if ([429, 503, 504].includes(status) && attempt < GRAPH_MAX_RETRIES) {
+        const delayMs = graphRetryDelayMs(error.response.headers?.['retry-after'], attempt);
+        console.warn(`Graph API throttled (${status}) on ${url}, retrying in ${delayMs}ms...`);
+        await new Promise(resolve => setTimeout(resolve, delayMs));
+        continue;
+      }
+      
+      console.error(`Error calling Graph API (${url}):`, error.response?.data || error.message);
+      throw error;
+    }
   }
 }
 
@@ -144,30 +281,71 @@ async function callGraphAPI(req, url, options = {}) {
 async function getAllGraphResults(req, initialUrl, options = {}) {
   let results = [];
   let nextLink = initialUrl;
+  let pageOptions = options;
   
   while (nextLink) {
-    const response = await callGraphAPI(req, nextLink, options);
+    const response = await callGraphAPI(req, nextLink, pageOptions);
     
     if (response.value && Array.isArray(response.value)) {
       results = results.concat(response.value);
     }
     
     nextLink = response['@odata.nextLink'];
+    // nextLink already carries the query parameters
+    pageOptions = { ...options, params: undefined };
   }
   
   return results;
 }
 
+// Graph list results per session: sessionID -> Map(key -> { expires, promise })
+const graphCache = new Map();
+
+// Share one Graph lookup between all callers in a session for GRAPH_CACHE_TTL_MS,
+// including calls made while it is still in flight. Callers must not modify
+// the cached results.
+function cachedGraphResults(req, key, fetchResults, { refresh = false } = {}) {
+  const now = Date.now();
+  
+  // Drop expired entries and sessions left with none
+  for (const [sessionId, entries] of graphCache) {
+    for (const [entryKey, entry] of entries) {
+      if (entry.expires <= now) entries.delete(entryKey);
+    }
+    if (entries.size === 0) graphCache.delete(sessionId);
+  }
+  
+  if (!graphCache.has(req.sessionID)) {
+    graphCache.set(req.sessionID, new Map());
+  }
+  const entries = graphCache.get(req.sessionID);
+  
+  if (!refresh && entries.has(key)) {
+    return entries.get(key).promise;
+  }
+  
+  const promise = fetchResults();
+  entries.set(key, { expires: now + GRAPH_CACHE_TTL_MS, promise });
+  
+  // Don't keep failed lookups around
+  promise.catch(() => {
+    if (entries.get(key)?.promise === promise) entries.delete(key);
+  });
+  return promise;
+}
+
 // OneNote API functions
-async function getOneNoteNotebooks(req) {
-  return await getAllGraphResults(req, '/me/onenote/notebooks');
+async function getOneNoteNotebooks(req, options = {}) {
+  return await cachedGraphResults(req, 'notebooks',
+    () => getAllGraphResults(req, '/me/onenote/notebooks'), options);
 }
 
-async function getOneNoteSections(req, notebookId) {
-  return await getAllGraphResults(req, `/me/onenote/notebooks/${notebookId}/sections`);
+async function getOneNoteSections(req, notebookId, options = {}) {
+  return await cachedGraphResults(req, `sections:${notebookId}`,
+    () => getAllGraphResults(req, `/me/onenote/notebooks/${notebookId}/sections`), options);
 }
 
-async function getOneNotePages(req, sectionId) {
+async function getOneNotePages(req, sectionId, options = {}) {
   const url = `/me/onenote/sections/${sectionId}/pages`;
   const params = {
     '$select': 'id,title,createdDateTime,lastModifiedDateTime',
@@ -175,7 +353,21 @@ async function getOneNotePages(req, sectionId) {
     '$top': 100
   };
   
-  return await getAllGraphResults(req, url, { params });
+  return await cachedGraphResults(req, `pages:${sectionId}`,
+    () => getAllGraphResults(req, url, { params }), options);
+}
+
+// id -> page lookup, built once per fetched page list
+const pageIndexes = new WeakMap();
+
+// Find one page of a section without scanning the page list
+async function getOneNotePage(req, sectionId, pageId) {
+  const pages = await getOneNotePages(req, sectionId);
+  
+  if (!pageIndexes.has(pages)) {
+    pageIndexes.set(pages, new Map(pages.map(page => [page.id, page])));
+  }
+  return pageIndexes.get(pages).get(pageId) || null;
 }
 
 async function getPageContent(req, pageId) {
@@ -184,23 +376,105 @@ async function getPageContent(req, pageId) {
   });
 }
 
-// Download images from OneNote and save them locally
+// Download images from OneNote and save them locally, streaming to disk
+// and hashing the content on the way. Returns { localPath, contentHash }.
 async function downloadImage(req, imageUrl, imageName) {
+  const imagePath = path.join(IMAGES_DIR, imageName);
+  const partPath = `${imagePath}.part`;
+  
   try {
-    const response = await callGraphAPI(req, imageUrl, {
-      responseType: 'arraybuffer'
+    return await imageDownloadLimiter(async () => {
+      const stream = await callGraphAPI(req, imageUrl, {
+        responseType: 'stream'
+      });
+      
+      const hash = crypto.createHash('sha256');
+      let bytes = 0;
+      await pipeline(stream, async function* (source) {
+        for await (const chunk of source) {
+          bytes += chunk.length;
+          if (bytes > IMAGE_MAX_DOWNLOAD_BYTES) {
+            throw new Error(`Image exceeds ${IMAGE_MAX_DOWNLOAD_BYTES} bytes`);
+          }
+          hash.update(chunk);
+          yield chunk;
+        }
+      }, fs.createWriteStream(partPath));
+      
+      await fs.promises.rename(partPath, imagePath);
+      return { localPath: `/images/${imageName}`, contentHash: hash.digest('hex') };
     });
-    
-    const imagePath = path.join(IMAGES_DIR, imageName);
-    fs.writeFileSync(imagePath, Buffer.from(response));
-    
-    return `/images/${imageName}`;
   } catch (error) {
     console.error('Error downloading image:', error);
+    fs.rmSync(partPath, { force: true });
     return null;
   }
 }
 
+// Marker image_normalizer.py leaves in the cache for an image it kept as it is
+const UNCHANGED_IMAGE_SUFFIX = '.unchanged';
+const UNCHANGED_IMAGE = Symbol('unchanged image');
+
+// Earlier outcome for an image in the content-hash cache: the path of its
+// normalized copy, UNCHANGED_IMAGE if the original is kept, or null if unseen
+function cachedNormalizedImage(cacheBase, ext) {
+  if (fs.existsSync(cacheBase + UNCHANGED_IMAGE_SUFFIX)) return UNCHANGED_IMAGE;
+  return [ext, '.jpg', '.png'].map(candidate => cacheBase + candidate).find(candidate => fs.existsSync(candidate)) || null;
+}
+
+// Downscale and recompress a page's oversized raster images, reusing earlier
+// results by content hash. Takes and returns downloadImage results; a
+// normalized image may change extension (e.g. a large photo PNG becomes JPEG).
+async function normalizeDownloadedImages(downloads) {
+  const cacheBaseFor = ({ contentHash }) =>
+    path.join(IMAGE_CACHE_DIR, `${contentHash}_${IMAGE_MAX_DIMENSION}_${IMAGE_MAX_BYTES}`);
+  const isRaster = download => download && RASTER_IMAGE_EXTENSIONS.has(path.extname(download.localPath).toLowerCase());
+  
+  if (!IMAGE_NORMALIZE_ENABLED || !downloads.some(isRaster)) {
+    return downloads;
+  }
+  
+  // Normalize each image not in the cache yet, once per distinct content
+  const misses = new Map();
+  for (const download of downloads.filter(isRaster)) {
+    const cacheBase = cacheBaseFor(download);
+    if (!misses.has(cacheBase) && !cachedNormalizedImage(cacheBase, path.extname(download.localPath).toLowerCase())) {
+      misses.set(cacheBase, { input: path.join(__dirname, 'public', download.localPath), output: cacheBase });
+    }
+  }
+  
+  if (misses.size > 0) {
+    try {
+      fs.mkdirSync(IMAGE_CACHE_DIR, { recursive: true });
+      const results = await ankiBridge.normalizeImages([...misses.values()], {
+        maxDimension: IMAGE_MAX_DIMENSION,
+        maxBytes: IMAGE_MAX_BYTES
+      });
+      
+      const saved = results.reduce((sum, result) => sum + (result.changed ? result.bytesBefore - result.bytesAfter : 0), 0);
+      console.log(`Normalized ${results.filter(result => result.changed).length} of ${results.length} images, saving ${saved} bytes`);
+    } catch (error) {
+      console.warn(`Image normalization failed, keeping the originals: ${error.message}`);
+    }
+  }
+  
+  return Promise.all(downloads.map(async download => {
+    if (!isRaster(download)) return download;
+    
+    const originalName = path.basename(download.localPath);
+    const originalExt = path.extname(originalName);
+    const cachedPath = cachedNormalizedImage(cacheBaseFor(download), originalExt.toLowerCase());
+    if (!cachedPath || cachedPath === UNCHANGED_IMAGE) return download;
+    
+    const normalizedName = path.basename(originalName, originalExt) + path.extname(cachedPath);
+    await fs.promises.copyFile(cachedPath, path.join(IMAGES_DIR, normalizedName));
+    if (normalizedName !== originalName) {
+      await fs.promises.rm(path.join(IMAGES_DIR, originalName), { force: true });
+    }
+    return { ...download, localPath: `/images/${normalizedName}` };
+  }));
+}
+
 // Extract content from OneNote HTML, including text and images
 async function extractContentFromOneNoteHtml(req, html, pageId) {
   try {
@@ -227,6 +501,7 @@ async function extractContentFromOneNoteHtml(req, html, pageId) {
     // Extract images
     const images = document.querySelectorAll('img');
     const extractedImages = [];
+    const imageDownloads = [];
     
     for (const img of images) {
       const src = img.getAttribute('src');
@@ -255,24 +530,30 @@ async function extractContentFromOneNoteHtml(req, html, pageId) {
           }
         }
         
-        try {
-          const localPath = await downloadImage(req, src, imageName);
-          if (localPath) {
-            extractedImages.push({
-              path: localPath,
-              altText: altText,
-              context: contextText
-            });
-            
-            // Add a reference to this image in the extracted text
-            extractedText += `\n![Image: ${altText || 'OneNote image'}](${localPath})\n${contextText ? `*${contextText}*\n` : ''}\n`;
-          }
-        } catch (imgError) {
-          console.error('Error processing image:', imgError);
-        }
+        imageDownloads.push({ src, imageName, altText, contextText });
       }
     }
     
+    // Download the page's images in parallel (bounded by the download limiter),
+    // then shrink oversized ones before they go to Gemini and into the deck
+    const downloads = await normalizeDownloadedImages(await Promise.all(
+      imageDownloads.map(({ src, imageName }) => downloadImage(req, src, imageName))
+    ));
+    
+    imageDownloads.forEach(({ altText, contextText }, i) => {
+      const localPath = downloads[i] && downloads[i].localPath;
+      if (localPath) {
+        extractedImages.push({
+          path: localPath,
+          altText: altText,
+          context: contextText
+        });
+        
+        // Add a reference to this image in the extracted text
+        extractedText += `\n![Image: ${altText || 'OneNote image'}](${localPath})\n${contextText ? `*${contextText}*\n` : ''}\n`;
+      }
+    });
+    
     // Handle ink drawings (SVG content)
     const svgElements = document.querySelectorAll('svg');
     for (const svg of svgElements) {
@@ -359,9 +640,8 @@ Here are the notes:
 ${processableContent}
 `;
 
-    // Initialize Gemini model and generate content
-    const model = genAI.getGenerativeModel({ model: "gemini-2.5-pro-exp-03-25" });
-    const result = await model.generateContent(prompt);
+    // Generate content with Gemini
+    const result = await generateWithAI(prompt);
     const responseText = result.response.text();
 
     // Extract JSON from response
@@ -488,11 +768,10 @@ async function processImagesWithAI(images, pageTitle) {
   }
   
   try {
-    const processedImages = [];
-    
-    for (const image of images) {
+    // Analyse the images in parallel (bounded by the AI limiter), keeping their order
+    const analysedImages = await Promise.all(images.map(async image => {
       // Skip processing if no image path
-      if (!image.path) continue;
+      if (!image.path) return null;
       
       // For each image, we'll create an analysis using multimodal AI
       const imagePath = path.join(__dirname, 'public', image.path);
@@ -500,12 +779,12 @@ async function processImagesWithAI(images, pageTitle) {
       // Check if file exists
       if (!fs.existsSync(imagePath)) {
         console.error(`Image file not found: ${imagePath}`);
-        continue;
+        return null;
       }
       
       try {
         // Read image file as base64 for API
-        const imageBuffer = fs.readFileSync(imagePath);
+        const imageBuffer = await fs.promises.readFile(imagePath);
         const base64Image = imageBuffer.toString('base64');
         
         // Create prompt for multimodal model
@@ -527,37 +806,36 @@ Context information provided with the image: "${image.context || ''}"
 Alt text for the image: "${image.altText || ''}"
 `;
 
-        // Call multimodal model
-        const model = genAI.getGenerativeModel({ model: "gemini-2.5-pro-exp-03-25" });
-        
         // Prepare the image data for the model
         const imageData = {
           inlineData: {
             data: base64Image,
-            mimeType: path.extname(imagePath) === '.svg' ? 'image/svg+xml' : 'image/png'
+            mimeType: IMAGE_MIME_TYPES[path.extname(imagePath).toLowerCase()] || 'image/png'
           }
         };
         
         // Generate content with both text and image
-        const result = await model.generateContent([prompt, imageData]);
+        const result = await generateWithAI([prompt, imageData]);
         const analysis = result.response.text();
         
         // Add processed information to the image
-        processedImages.push({
+        return {
           ...image,
           analysis,
           // Extract potential questions from the analysis
           potentialQuestions: extractQuestionsFromAnalysis(analysis)
-        });
+        };
       } catch (imgError) {
         console.error(`Error processing image with AI: ${image.path}`, imgError);
-        processedImages.push({
+        return {
           ...image,
           analysis: "Error processing image with AI.",
           potentialQuestions: []
-        });
+        };
       }
-    }
+    }));
+    
+    const processedImages = analysedImages.filter(Boolean);
     
     return processedImages;
   } catch (error) {
@@ -745,9 +1023,8 @@ Here are the notes:
 ${processableContent}
 `;
 
-    // Initialize Gemini model and generate content
-    const model = genAI.getGenerativeModel({ model: "gemini-2.5-pro-exp-03-25" });
-    const result = await model.generateContent(prompt);
+    // Generate content with Gemini
+    const result = await generateWithAI(prompt);
     const responseText = result.response.text();
 
     // Extract JSON from response
@@ -1218,6 +1495,194 @@ async function generateAnkiPackage(deckName, flashcards) {
   }
 }
 
+// Read card generation preferences from query parameters
+function parseCardPreferences(query) {
+  return {
+    enableCloze: query.enableCloze === 'true',
+    enableStandard: query.enableStandard === 'true',
+    enableProcess: query.enableProcess === 'true',
+    enableConceptMap: query.enableConceptMap === 'true',
+    maxCardsPerPage: parseInt(query.maxCardsPerPage || '0'),
+    cardComplexity: query.cardComplexity || 'standard',
+    processImages: query.processImages === 'true',
+    generateConceptMaps: query.generateConceptMaps === 'true',
+    useOriginalText: query.useOriginalText === 'true',
+    includeMetadata: query.includeMetadata === 'true'
+  };
+}
+
+// Cache file for a page's AI output under the given preferences. The card
+// limit is applied after generation, so it doesn't affect what's cached.
+function pageCachePath(pageId, preferences) {
+  const { maxCardsPerPage, ...aiPreferences } = preferences;
+  const key = JSON.stringify([
+    PAGE_CACHE_VERSION,
+    AI_MODEL_NAME,
+    pageId,
+    Object.entries(aiPreferences).sort(([a], [b]) => a.localeCompare(b))
+  ]);
+  return path.join(PAGE_CACHE_DIR, `${crypto.createHash('sha256').update(key).digest('hex')}.json`);
+}
+
+// Cached AI output for this version of a page, or null if the page changed
+// or one of its downloaded images has since been removed
+function readPageCache(cachePath, pageVersion) {
+  let entry;
+  try {
+    entry = JSON.parse(fs.readFileSync(cachePath, 'utf8'));
+  } catch (error) {
+    return null;
+  }
+  
+  if (entry.pageVersion !== pageVersion) return null;
+  if (!entry.images.every(img => fs.existsSync(path.join(__dirname, 'public', img.path)))) return null;
+  return entry;
+}
+
+function writePageCache(cachePath, pageVersion, output) {
+  try {
+    fs.mkdirSync(PAGE_CACHE_DIR, { recursive: true });
+    const tempPath = `${cachePath}.${process.pid}.tmp`;
+    fs.writeFileSync(tempPath, JSON.stringify({ pageVersion, cachedAt: Date.now(), ...output }));
+    fs.renameSync(tempPath, cachePath);
+  } catch (error) {
+    console.warn(`Failed to cache AI output: ${error.message}`);
+  }
+}
+
+// The AI helpers swallow their errors and return empty or placeholder results;
+// those must not be cached, or the page would never be retried
+function isCacheablePageOutput({ flashcards, images }) {
+  return flashcards.length > 0 && images.every(img => img.analysis !== "Error processing image with AI.");
+}
+
+// Run the AI steps (image analysis, concept map, flashcards) on a page's HTML
+async function generatePageOutput(req, htmlContent, pageInfo, preferences, onStage) {
+  const pageTitle = pageInfo.title;
+  const extractedContent = await extractContentFromOneNoteHtml(req, htmlContent, pageInfo.id);
+  
+  // Image analysis and the concept map don't depend on each other, so run them together
+  onStage('processing_images', 0.3, `Processing images and creating concept map for "${pageTitle}"...`);
+  
+  const [processedImages, conceptMap] = await Promise.all([
+    // Only process images if the setting is enabled
+    preferences.processImages ? 
+      processImagesWithAI(extractedContent.images, pageTitle) :
+      extractedContent.images.map(img => ({ ...img, analysis: '', potentialQuestions: [] })),
+    // Only generate concept maps if the setting is enabled
+    preferences.generateConceptMaps ? 
+      generateConceptMap(extractedContent.text, pageTitle) :
+      { concepts: [], relationships: [] }
+  ]);
+  
+  // Extract flashcards
+  onStage('creating_cards', 0.1, `Generating flashcards for "${pageTitle}"...`);
+  
+  // Pass user preferences to the flashcard generation function
+  const flashcards = await extractFlashcardsWithAI(
+    extractedContent.text, 
+    pageTitle, 
+    conceptMap,
+    processedImages,
+    preferences
+  );
+  
+  return { flashcards, images: processedImages, conceptMap };
+}
+
+// Turn one OneNote page into tagged flashcards and processed images.
+// onStage(stage, remaining, message) is called before each step, where
+// remaining is the fraction of the page's work still to do.
+async function processPageForAnki(req, pageInfo, preferences, onStage = () => {}) {
+  const pageId = pageInfo.id;
+  const pageTitle = pageInfo.title;
+  const cachePath = PAGE_CACHE_ENABLED ? pageCachePath(pageId, preferences) : null;
+  
+  // Reuse the AI output from an earlier export if the page hasn't been modified since
+  let pageVersion = pageInfo.lastModifiedDateTime;
+  let cached = cachePath && pageVersion ? readPageCache(cachePath, pageVersion) : null;
+  
+  // Extract content
+  onStage('extracting', 0.5, `Extracting content from "${pageTitle}"...`);
+  
+  let htmlContent = null;
+  if (!cached) {
+    htmlContent = await getPageContent(req, pageId);
+    
+    // Without a modification time, fall back to the page content itself
+    if (cachePath && !pageVersion) {
+      pageVersion = `sha256:${crypto.createHash('sha256').update(htmlContent).digest('hex')}`;
+      cached = readPageCache(cachePath, pageVersion);
+    }
+  }
+  
+  let output = cached;
+  if (cached) {
+    console.log(`Using cached AI output for page "${pageTitle}"`);
+    onStage('creating_cards', 0.1, `Using cached flashcards for "${pageTitle}"...`);
+  } else {
+    output = await generatePageOutput(req, htmlContent, pageInfo, preferences, onStage);
+    if (cachePath && isCacheablePageOutput(output)) {
+      writePageCache(cachePath, pageVersion, output);
+    }
+  }
+  
+  // The cache entry keeps the page's images alive for the media garbage collector
+  if (cachePath && (cached || isCacheablePageOutput(output))) {
+    ankiBridge.recordMediaReferences(cachePath,
+      output.images.map(img => path.join(__dirname, 'public', img.path)));
+  }
+  
+  const { flashcards, images: processedImages } = output;
+  
+  // Apply card limit if set
+  let pageFlashcards = flashcards;
+  if (preferences.maxCardsPerPage > 0 && flashcards.length > preferences.maxCardsPerPage) {
+    pageFlashcards = flashcards.slice(0, preferences.maxCardsPerPage);
+  }
+  
+  // Add page title as a tag to all cards
+  const formattedPageTag = pageTitle
+    .toLowerCase()
+    .replace(/[^a-z0-9]/g, '_')
+    .replace(/_+/g, '_')
+    .replace(/^_|_$/g, '');
+  
+  // Add page info to each flashcard
+  const taggedFlashcards = pageFlashcards.map(card => ({
+    ...card,
+    tags: [...(card.tags || []), formattedPageTag],
+    sourcePageTitle: pageTitle,
+    sourcePageId: pageId
+  }));
+  
+  return { flashcards: taggedFlashcards, images: processedImages };
+}
+
+// Abort signal that fires if the client disconnects before the response is finished
+function disconnectSignal(res) {
+  const controller = new AbortController();
+  res.on('close', () => {
+    if (!res.writableEnded) {
+      controller.abort();
+    }
+  });
+  return controller.signal;
+}
+
+// SSE error message for a failed generator job
+function generationErrorMessage(error) {
+  if (error instanceof ankiBridge.QueueFullError) {
+    return 'The deck generator is busy right now. Please try again in a few minutes.';
+  }
+  return `Error generating Anki package: ${error.message}`;
+}
+
+// Subdeck-safe name part: "::" separates deck levels in Anki
+function deckNamePart(name) {
+  return (name || 'Untitled').replace(/::/g, ':').trim() || 'Untitled';
+}
+
 // ------ ROUTES ------
 
 // Main application page
@@ -1309,6 +1774,7 @@ app.get('/auth/callback', async (req, res) => {
 });
 
 app.get('/auth/signout', (req, res) => {
+  graphCache.delete(req.sessionID);
   req.session.destroy();
   res.redirect('/');
 });
@@ -1334,10 +1800,10 @@ app.get('/api/notebooks/:notebookId/sections', ensureAuthenticated, async (req,
   }
 });
 
-// Scan a OneNote section for pages
+// Scan a OneNote section for pages (?refresh=true skips the session's cached page list)
 app.get('/api/onenote/scan/:sectionId', ensureAuthenticated, async (req, res) => {
   try {
-    const pages = await getOneNotePages(req, req.params.sectionId);
+    const pages = await getOneNotePages(req, req.params.sectionId, { refresh: req.query.refresh === 'true' });
     
     res.json({
       sectionId: req.params.sectionId,
@@ -1374,8 +1840,7 @@ app.post('/api/anki/generate', ensureAuthenticated, async (req, res) => {
       
       try {
         // Get page content and title
-        const pages = await getOneNotePages(req, sectionId);
-        const pageInfo = pages.find(p => p.id === pageId);
+        const pageInfo = await getOneNotePage(req, sectionId, pageId);
         
         if (!pageInfo) {
           console.warn(`Page ${pageId} not found, skipping...`);
@@ -1466,18 +1931,7 @@ app.get('/api/anki/generate/stream', ensureAuthenticated, async (req, res) => {
     const pageIds = req.query.pageIds.split(',');
     
     // Get card generation preferences from query parameters
-    const preferences = {
-      enableCloze: req.query.enableCloze === 'true',
-      enableStandard: req.query.enableStandard === 'true',
-      enableProcess: req.query.enableProcess === 'true',
-      enableConceptMap: req.query.enableConceptMap === 'true',
-      maxCardsPerPage: parseInt(req.query.maxCardsPerPage || '0'),
-      cardComplexity: req.query.cardComplexity || 'standard',
-      processImages: req.query.processImages === 'true',
-      generateConceptMaps: req.query.generateConceptMaps === 'true',
-      useOriginalText: req.query.useOriginalText === 'true',
-      includeMetadata: req.query.includeMetadata === 'true'
-    };
+    const preferences = parseCardPreferences(req.query);
     
     console.log('Card generation preferences:', preferences);
     
@@ -1500,109 +1954,61 @@ app.get('/api/anki/generate/stream', ensureAuthenticated, async (req, res) => {
       })}\n\n`);
     };
     
+    // Stop working for clients that have gone away
+    const signal = disconnectSignal(res);
+    
     // Track progress
-    let currentPage = 0;
+    let completedPages = 0;
     const totalPages = pageIds.length;
-    let allFlashcards = [];
-    let allImages = [];
+    const allFlashcards = [];
+    const allImages = [];
     let totalCardCount = 0;
     
     // Initial progress update
     sendProgress('initializing', 0, 'Starting deck generation...');
     
-    // Process each page
-    for (const pageId of pageIds) {
-      currentPage++;
+    // Process several pages at once; progress follows completed pages
+    const pageProgress = () => Math.floor(completedPages / totalPages * 100);
+    const outcomes = await mapPagesConcurrently(pageIds, async (pageId, index) => {
+      sendProgress('loading', pageProgress(), `Loading page ${index + 1} of ${totalPages}...`);
       
-      try {
-        // Get page info
-        sendProgress('loading', Math.floor((currentPage - 0.7) / totalPages * 100), 
-          `Loading page ${currentPage} of ${totalPages}...`);
-        
-        const pages = await getOneNotePages(req, sectionId);
-        const pageInfo = pages.find(p => p.id === pageId);
-        
-        if (!pageInfo) {
-          console.warn(`Page ${pageId} not found, skipping...`);
-          continue;
-        }
-        
-        const pageTitle = pageInfo.title;
-        
-        // Extract content
-        sendProgress('extracting', Math.floor((currentPage - 0.5) / totalPages * 100), 
-          `Extracting content from "${pageTitle}"...`);
-        
-        const htmlContent = await getPageContent(req, pageId);
-        const extractedContent = await extractContentFromOneNoteHtml(req, htmlContent, pageId);
-        
-        // Process images
-        sendProgress('processing_images', Math.floor((currentPage - 0.3) / totalPages * 100), 
-          `Processing images from "${pageTitle}"...`);
-        
-        // Only process images if the setting is enabled
-        const processedImages = preferences.processImages ? 
-          await processImagesWithAI(extractedContent.images, pageTitle) :
-          extractedContent.images.map(img => ({ ...img, analysis: '', potentialQuestions: [] }));
-        
-        // Track all images for Anki generation
-        allImages = [...allImages, ...processedImages];
-        
-        // Generate concept map
-        sendProgress('generating_map', Math.floor((currentPage - 0.2) / totalPages * 100), 
-          `Creating concept map for "${pageTitle}"...`);
-        
-        // Only generate concept maps if the setting is enabled
-        const conceptMap = preferences.generateConceptMaps ? 
-          await generateConceptMap(extractedContent.text, pageTitle) :
-          { concepts: [], relationships: [] };
-        
-        // Extract flashcards
-        sendProgress('creating_cards', Math.floor((currentPage - 0.1) / totalPages * 100), 
-          `Generating flashcards for "${pageTitle}"...`);
-        
-        // Pass user preferences to the flashcard generation function
-        const flashcards = await extractFlashcardsWithAI(
-          extractedContent.text, 
-          pageTitle, 
-          conceptMap,
-          processedImages,
-          preferences
-        );
-        
-        // Apply card limit if set
-        let pageFlashcards = flashcards;
-        if (preferences.maxCardsPerPage > 0 && flashcards.length > preferences.maxCardsPerPage) {
-          pageFlashcards = flashcards.slice(0, preferences.maxCardsPerPage);
+      const pageInfo = await getOneNotePage(req, sectionId, pageId);
+      
+      if (!pageInfo) {
+        console.warn(`Page ${pageId} not found, skipping...`);
+        return null;
+      }
+      
+      return await processPageForAnki(req, pageInfo, preferences,
+        (stage, remaining, message) => sendProgress(stage, pageProgress(), message));
+    }, {
+      signal,
+      onSettled: ({ value, error }, pageId, index) => {
+        completedPages++;
+        if (error) {
+          console.error(`Error processing page ${pageId}:`, error);
+          sendProgress('page_error', pageProgress(), 
+            `Error on page ${index + 1}. Continuing with remaining pages...`);
+        } else if (value) {
+          // Update on page completion
+          sendProgress('page_complete', pageProgress(), 
+            `Completed ${completedPages} of ${totalPages} pages (${value.flashcards.length} cards)`, 
+            { cardCount: value.flashcards.length });
         }
-        
-        // Add page title as a tag to all cards
-        const formattedPageTag = pageTitle
-          .toLowerCase()
-          .replace(/[^a-z0-9]/g, '_')
-          .replace(/_+/g, '_')
-          .replace(/^_|_$/g, '');
-        
-        // Add page info to each flashcard
-        const taggedFlashcards = pageFlashcards.map(card => ({
-          ...card,
-          tags: [...(card.tags || []), formattedPageTag],
-          sourcePageTitle: pageTitle,
-          sourcePageId: pageId
-        }));
-        
-        allFlashcards = [...allFlashcards, ...taggedFlashcards];
-        totalCardCount += taggedFlashcards.length;
-        
-        // Update on page completion
-        sendProgress('page_complete', Math.floor(currentPage / totalPages * 100), 
-          `Completed ${currentPage} of ${totalPages} pages (${taggedFlashcards.length} cards)`, 
-          { cardCount: taggedFlashcards.length });
-      } catch (error) {
-        console.error(`Error processing page ${pageId}:`, error);
-        sendProgress('page_error', Math.floor(currentPage / totalPages * 100), 
-          `Error on page ${currentPage}. Continuing with remaining pages...`);
       }
+    });
+    
+    // Track all cards and images for Anki generation, in page order
+    for (const { value } of outcomes) {
+      if (!value) continue;
+      allImages.push(...value.images);
+      allFlashcards.push(...value.flashcards);
+      totalCardCount += value.flashcards.length;
+    }
+    
+    if (signal.aborted) {
+      console.log(`Client disconnected, abandoning deck generation for section ${sectionId}`);
+      return;
     }
     
     // Generate deck name
@@ -1621,7 +2027,28 @@ app.get('/api/anki/generate/stream', ensureAuthenticated, async (req, res) => {
         images: preparedImages,
         deckName: deckName,
         outputDir: UPLOADS_DIR,
-        mediaFolder: path.join(__dirname, 'public')
+        mediaFolder: path.join(__dirname, 'public'),
+        // Reuse the section's note cache across regenerations
+        cacheKey: `section_${sectionId}`,
+        // Merge into a previously downloaded package when asked to
+        append: req.query.appendTo || undefined,
+        // 'tsv' or 'csv' exports a text file for Anki's importer plus a media zip
+        format: req.query.format || undefined,
+        // Relay the generator's live counts; packaging fills the 95-99% band
+        onProgress: (record) => {
+          const built = Math.min(record.notesBuilt, preparedCards.length);
+          const fraction = preparedCards.length ? built / preparedCards.length : 1;
+          const megabytesZipped = (record.bytesZipped / (1024 * 1024)).toFixed(1);
+          sendProgress('packaging', 95 + Math.floor(fraction * 4),
+            `Packaging: ${built}/${preparedCards.length} notes built, ${record.mediaAdded} images added, ${megabytesZipped} MB zipped`,
+            { packagingStage: record.stage, notesBuilt: built, mediaAdded: record.mediaAdded, bytesZipped: record.bytesZipped });
+        },
+        // Report the job's place in line while it waits for a free generator
+        onQueued: (position, queued) => {
+          sendProgress('queued', 95, `Waiting for a free deck generator (position ${position} of ${queued})...`,
+            { queuePosition: position, queueLength: queued });
+        },
+        signal
       });
       
       // Return download URL
@@ -1641,18 +2068,26 @@ app.get('/api/anki/generate/stream', ensureAuthenticated, async (req, res) => {
         totalPages,
         totalCards: clozeCount + standardCount,
         downloadUrl,
+        mediaDownloadUrl: result.mediaFilename ? `/download/${result.mediaFilename}` : undefined,
         deckName,
+        cached: Boolean(result.cached),
         statistics: {
           cloze: clozeCount,
           standard: standardCount,
-          error: result.stats.error || 0
+          error: result.stats.error || 0,
+          media: result.stats.media,
+          duplicatesDropped: result.stats.dedupe ? result.stats.dedupe.dropped : 0
         }
       })}\n\n`);
       
       res.end();
     } catch (error) {
+      if (error instanceof ankiBridge.GenerationCancelledError) {
+        console.log(`Deck generation for section ${sectionId} cancelled: ${error.message}`);
+        return;
+      }
       console.error('Error generating Anki package:', error);
-      sendProgress('error', 100, `Error generating Anki package: ${error.message}`);
+      sendProgress('error', 100, generationErrorMessage(error));
       
       res.write(`data: ${JSON.stringify({
         error: 'Failed to generate Anki deck',
@@ -1672,6 +2107,196 @@ app.get('/api/anki/generate/stream', ensureAuthenticated, async (req, res) => {
 });
 
 
+// Export a whole notebook (or a selection of its sections) as one package
+// with a "Notebook::Section::Page" subdeck per page, built in one generator run
+app.get('/api/anki/generate/notebook/stream', ensureAuthenticated, async (req, res) => {
+  try {
+    const { notebookId } = req.query;
+    const sectionIds = req.query.sectionIds ? req.query.sectionIds.split(',') : null;
+    // 'page' gives one subdeck per page, 'section' one per section
+    const subdecks = req.query.subdecks === 'section' ? 'section' : 'page';
+    const preferences = parseCardPreferences(req.query);
+    
+    if (!notebookId) {
+      return res.status(400).json({ error: 'Invalid request parameters' });
+    }
+    
+    // Set up SSE (Server-Sent Events) for progress updates
+    res.setHeader('Content-Type', 'text/event-stream');
+    res.setHeader('Cache-Control', 'no-cache');
+    res.setHeader('Connection', 'keep-alive');
+    
+    const sendProgress = (stage, progress, message, extraData = {}) => {
+      res.write(`data: ${JSON.stringify({
+        stage,
+        progress,
+        message,
+        ...extraData
+      })}\n\n`);
+    };
+    
+    // Stop working for clients that have gone away
+    const signal = disconnectSignal(res);
+    
+    sendProgress('initializing', 0, 'Listing notebook sections...');
+    
+    let notebookName = req.query.notebookName;
+    if (!notebookName) {
+      const notebooks = await getOneNoteNotebooks(req);
+      const notebook = notebooks.find(n => n.id === notebookId);
+      notebookName = notebook ? notebook.displayName : 'OneNote Notebook';
+    }
+    
+    const sections = (await getOneNoteSections(req, notebookId))
+      .filter(section => !sectionIds || sectionIds.includes(section.id));
+    
+    // List every section's pages up front so progress covers the whole notebook
+    const sectionPages = await Promise.all(sections.map(async section => ({
+      section,
+      pages: await getOneNotePages(req, section.id)
+    })));
+    
+    const rootName = deckNamePart(notebookName);
+    const allPages = sectionPages.flatMap(({ section, pages }) => pages.map(pageInfo => ({ section, pageInfo })));
+    const totalPages = allPages.length;
+    const decks = new Map();
+    let completedPages = 0;
+    let totalCardCount = 0;
+    
+    // Process several pages at once; progress follows completed pages
+    const pageProgress = () => Math.floor(completedPages / totalPages * 90);
+    const outcomes = await mapPagesConcurrently(allPages, ({ pageInfo }) => processPageForAnki(
+      req, pageInfo, preferences,
+      (stage, remaining, message) => sendProgress(stage, pageProgress(), message)
+    ), {
+      signal,
+      onSettled: ({ value, error }, { pageInfo }, index) => {
+        completedPages++;
+        if (error) {
+          console.error(`Error processing page ${pageInfo.id}:`, error);
+          sendProgress('page_error', pageProgress(), 
+            `Error on page ${index + 1}. Continuing with remaining pages...`);
+        } else {
+          sendProgress('page_complete', pageProgress(), 
+            `Completed ${completedPages} of ${totalPages} pages (${value.flashcards.length} cards)`, 
+            { cardCount: value.flashcards.length });
+        }
+      }
+    });
+    
+    // Group cards into subdecks in notebook order
+    outcomes.forEach(({ value }, index) => {
+      if (!value) return;
+      const { section, pageInfo } = allPages[index];
+      const sectionDeck = `${rootName}::${deckNamePart(section.displayName)}`;
+      const deckName = subdecks === 'section' ? sectionDeck : `${sectionDeck}::${deckNamePart(pageInfo.title)}`;
+      
+      if (!decks.has(deckName)) {
+        decks.set(deckName, { deckName, flashcards: [], images: [] });
+      }
+      const deck = decks.get(deckName);
+      deck.flashcards.push(...value.flashcards);
+      deck.images.push(...value.images);
+      totalCardCount += value.flashcards.length;
+    });
+    
+    if (signal.aborted) {
+      console.log(`Client disconnected, abandoning export of notebook ${notebookId}`);
+      return;
+    }
+    
+    if (decks.size === 0) {
+      throw new Error('No pages could be converted');
+    }
+    
+    sendProgress('packaging', 90, `Creating Anki package with ${decks.size} decks and ${totalCardCount} flashcards...`);
+    
+    const packageName = `${notebookName.replace(/[^a-zA-Z0-9 ]/g, '')}_${new Date().toISOString().split('T')[0]}`;
+    const batchDecks = [...decks.values()].map(deck => ({
+      deckName: deck.deckName,
+      cards: ankiBridge.prepareCardsForAnki(deck.flashcards, deck.images),
+      images: ankiBridge.prepareImagesForAnki(deck.images)
+    }));
+    
+    const result = await ankiBridge.generateBatchPackage({
+      packageName,
+      decks: batchDecks,
+      outputDir: UPLOADS_DIR,
+      mediaFolder: path.join(__dirname, 'public'),
+      format: req.query.format || undefined,
+      onProgress: (record) => {
+        const built = Math.min(record.notesBuilt, totalCardCount);
+        const fraction = totalCardCount ? built / totalCardCount : 1;
+        sendProgress('packaging', 90 + Math.floor(fraction * 9),
+          `Packaging: ${built}/${totalCardCount} notes built, ${record.mediaAdded} images added`,
+          { packagingStage: record.stage, notesBuilt: built, mediaAdded: record.mediaAdded, bytesZipped: record.bytesZipped });
+      },
+      onQueued: (position, queued) => {
+        sendProgress('queued', 90, `Waiting for a free deck generator (position ${position} of ${queued})...`,
+          { queuePosition: position, queueLength: queued });
+      },
+      signal
+    });
+    
+    const clozeCount = result.stats.cloze || 0;
+    const standardCount = result.stats.standard || 0;
+    
+    sendProgress('complete', 100, 
+      `Notebook export complete! Created ${clozeCount} cloze cards and ${standardCount} standard cards in ${decks.size} decks.`);
+    
+    res.write(`data: ${JSON.stringify({
+      complete: true,
+      success: true,
+      totalPages,
+      totalDecks: decks.size,
+      totalCards: clozeCount + standardCount,
+      downloadUrl: `/download/${result.filename}`,
+      mediaDownloadUrl: result.mediaFilename ? `/download/${result.mediaFilename}` : undefined,
+      deckName: packageName,
+      cached: Boolean(result.cached),
+      statistics: {
+        cloze: clozeCount,
+        standard: standardCount,
+        error: result.stats.error || 0,
+        media: result.stats.media,
+        duplicatesDropped: result.stats.dedupe ? result.stats.dedupe.dropped : 0,
+        decks: result.stats.decks
+      }
+    })}\n\n`);
+    
+    res.end();
+  } catch (error) {
+    if (error instanceof ankiBridge.GenerationCancelledError) {
+      console.log(`Notebook export cancelled: ${error.message}`);
+      return;
+    }
+    console.error('Error in notebook export stream:', error);
+    res.write(`data: ${JSON.stringify({ stage: 'error', progress: 100, message: generationErrorMessage(error) })}\n\n`);
+    res.write(`data: ${JSON.stringify({
+      error: 'Failed to export notebook',
+      complete: true
+    })}\n\n`);
+    res.end();
+  }
+});
+
+// Generator queue depth, counters and wait/run times
+app.get('/api/metrics/generation', ensureAuthenticated, (req, res) => {
+  res.json(ankiBridge.getGenerationMetrics());
+});
+
+// What the media garbage collector would delete now, without deleting anything.
+// Only counts and bytes are returned; the per-file list holds server paths
+app.get('/api/metrics/media', ensureAuthenticated, async (req, res) => {
+  try {
+    const { files, ...report } = await ankiBridge.collectMediaGarbage({ roots: MEDIA_GC_ROOTS, dryRun: true });
+    res.json(report);
+  } catch (error) {
+    console.error('Error collecting media report:', error);
+    res.status(500).json({ error: 'Failed to collect media report' });
+  }
+});
+
 // Download route for Anki files
 app.get('/download/:filename', (req, res) => {
   const filePath = path.join(UPLOADS_DIR, req.params.filename);
@@ -1683,8 +2308,29 @@ app.get('/download/:filename', (req, res) => {
   res.download(filePath);
 });
 
-// Start server
+// Start server (unless loaded by the tests, which drive the app and helpers below directly)
 const PORT = process.env.PORT || 3000;
-app.listen(PORT, () => {
-  console.log(`Server running on http://localhost:${PORT}`);
-});
\ No newline at end of file
+if (require.main === module) {
+  app.listen(PORT, () => {
+    console.log(`Server running on http://localhost:${PORT}`);
+
+    // Warm up the Python generator so the first deck doesn't pay its startup cost
+    ankiBridge.startWorker();
+
+    // Periodically remove images and files nothing references any more
+    ankiBridge.startMediaGc(MEDIA_GC_ROOTS);
+  });
+}
+
+module.exports = {
+  app,
+  graphRetryDelayMs,
+  callGraphAPI,
+  cachedGraphResults,
+  getOneNoteNotebooks,
+  getOneNotePages,
+  pageCachePath,
+  readPageCache,
+  writePageCache,
+  processPageForAnki
+};
\ No newline at end of file
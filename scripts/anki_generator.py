@@ -1,19 +1,60 @@
 #!/usr/bin/env python3
+"""Build Anki packages from converted OneNote cards
+
+Run as a script (see parse_args) or in --worker mode for anki_bridge.js, or
+import it and build decks in-process:
+
+    from anki_generator import Card, DeckBuilder
+    
+    builder = DeckBuilder('Biology', media_folder='public')
+    builder.add_cards(Card(question=q, answer=a) for q, a in pairs)
+    result = builder.build('out/biology.apkg', backend='sqlite')
+"""
 import sys
 import json
 import os
+import re
+import html
+import time
 import random
+import hashlib
 import logging
+import argparse
+import itertools
+import sqlite3
+import csv
+import tempfile
+import zipfile
+import contextlib
+import fcntl
+import zlib
+import struct
+import functools
+import dataclasses
+import pstats
+import cProfile
+import resource
+import tracemalloc
+import threading
 import genanki
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
+from urllib.parse import unquote
+from genanki.apkg_col import APKG_COL
+from genanki.apkg_schema import APKG_SCHEMA
+from genanki.util import guid_for
+from media_index import open_index
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, 
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    stream=sys.stdout)
 logger = logging.getLogger("AnkiGenerator")
 
+def configure_logging(stream=sys.stdout):
+    """Log to stream when run as a script; importers keep their own logging setup"""
+    logging.basicConfig(level=logging.INFO, 
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        stream=stream)
+
 # Fixed model IDs for consistency
 CLOZE_MODEL_ID = 1607392319
 BASIC_MODEL_ID = 1380120668 
@@ -53,11 +94,431 @@ basic_model = genanki.Model(
     ]
 )
 
+MODELS_BY_ID = {model.model_id: model for model in (cloze_model, basic_model)}
+
+def split_tags(tags):
+    """Tags as a list, accepting Anki's space-separated string form"""
+    if isinstance(tags, str):
+        return tags.split()
+    return list(tags or [])
+
+@dataclass(slots=True)
+class ImageRef:
+    """An image to package, by its path under the media folder"""
+    path: str
+    
+    @classmethod
+    def coerce(cls, value):
+        """ImageRef from an ImageRef, a path, or a {'path': ...} dict"""
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, str):
+            return cls(value)
+        return cls(value['path'])
+    
+    def to_dict(self):
+        return {'path': self.path}
+
+@dataclass(slots=True)
+class Card:
+    """One card to build into a note
+    
+    Cloze cards use text (and notes as the Extra field); basic cards use
+    question and answer, with notes appended to the back. source_key, when
+    set, keys the note's GUID and cache entry; deck is the index of the
+    target deck in a batch export.
+    """
+    type: str = 'standard'
+    text: str = ''
+    question: str = ''
+    answer: str = ''
+    notes: str = ''
+    tags: list[str] = field(default_factory=list)
+    related_images: list[str] = field(default_factory=list)
+    source_key: str | None = None
+    deck: int | None = None
+    
+    @classmethod
+    def coerce(cls, value):
+        """Card from a Card or from the camelCase dict used in JSON input"""
+        if isinstance(value, cls):
+            return value
+        if not isinstance(value, dict):
+            raise TypeError(f"Expected a card object, got {type(value).__name__}")
+        return cls(type=value.get('type') or 'standard',
+                   text=value.get('text') or '',
+                   question=value.get('question') or '',
+                   answer=value.get('answer') or '',
+                   notes=value.get('notes') or '',
+                   tags=split_tags(value.get('tags')),
+                   related_images=list(value.get('relatedImages') or []),
+                   source_key=value.get('sourceKey'),
+                   deck=value.get('deck'))
+    
+    def to_dict(self):
+        """The card in JSON input form, leaving out unset optional keys"""
+        data = {'type': self.type, 'text': self.text, 'question': self.question, 'answer': self.answer,
+                'notes': self.notes, 'tags': self.tags, 'relatedImages': self.related_images}
+        if self.source_key is not None:
+            data['sourceKey'] = self.source_key
+        if self.deck is not None:
+            data['deck'] = self.deck
+        return data
+
+def iter_cards(values, stats):
+    """Cards from dicts or Card objects, counting malformed entries as errors"""
+    for value in values:
+        try:
+            yield Card.coerce(value)
+        except (TypeError, KeyError, AttributeError) as e:
+            logger.error(f"Error reading card: {str(e)}")
+            stats['error'] += 1
+
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+
+def iter_ndjson_cards(stream, close=False):
+    """Yield one card per non-empty line of an NDJSON stream"""
+    try:
+        for line_number, line in enumerate(stream, start=2):
+            line = line.strip()
+            if not line:
+                continue
+            
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.error(f"Skipping malformed card on line {line_number}: {str(e)}")
+    finally:
+        if close:
+            stream.close()
+
+def read_ndjson_input(stream, close=False):
+    """Read the NDJSON header line and return deck data with a lazy card iterator"""
+    header_line = stream.readline()
+    if not header_line.strip():
+        raise ValueError("NDJSON input is missing its header line")
+    
+    data = json.loads(header_line)
+    data['cards'] = iter_ndjson_cards(stream, close=close)
+    return data
+
+# Progress records are emitted at most this often
+PROGRESS_INTERVAL_SECONDS = 0.25
+# Well under the bridge's idle timeout (GENERATION_IDLE_TIMEOUT_MS in anki_bridge.js)
+HEARTBEAT_INTERVAL_SECONDS = 15
+
+class StageTimer:
+    """Exclusive wall time and memory growth per packaging stage
+    
+    Stages nest: time spent in an inner stage (e.g. reading the next card
+    while building notes) is charged to the inner stage only. Lazy iterators
+    are timed per item with timed_iter. ru_maxrss only ever rises over the
+    life of the process (a warm worker keeps its largest earlier job's peak),
+    so each stage reports how far it raised that high-water mark between its
+    first entry and its end. When tracemalloc is running, the peak traced
+    Python memory is also attributed to whichever stage was active when it
+    occurred.
+    """
+    
+    def __init__(self):
+        self.seconds = {}
+        self.rss_growth = {}
+        self._rss_start = {}
+        self.peak_traced = {}
+        self._stack = []
+        self._mark = time.perf_counter()
+        self._started = self._mark
+    
+    def _switch(self, sample):
+        now = time.perf_counter()
+        if self._stack:
+            name = self._stack[-1]
+            self.seconds[name] = self.seconds.get(name, 0.0) + now - self._mark
+            if tracemalloc.is_tracing():
+                peak = tracemalloc.get_traced_memory()[1]
+                self.peak_traced[name] = max(self.peak_traced.get(name, 0), peak)
+                tracemalloc.reset_peak()
+            if sample:
+                self.rss_growth[name] = peak_rss_bytes() - self._rss_start[name]
+        self._mark = now
+    
+    def enter(self, name):
+        self._switch(sample=False)
+        if name not in self._rss_start:
+            self._rss_start[name] = peak_rss_bytes()
+        self._stack.append(name)
+    
+    def exit(self, sample=True):
+        self._switch(sample=sample)
+        self._stack.pop()
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+    
+    def timed_iter(self, name, iterable):
+        """Yield from iterable, charging the time spent producing each item to name"""
+        iterator = iter(iterable)
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.exit()
+                return
+            except BaseException:
+                self.exit()
+                raise
+            self.exit(sample=False)
+            yield item
+    
+    def report(self):
+        stages = {}
+        for name, seconds in self.seconds.items():
+            stage = {'seconds': round(seconds, 6)}
+            if name in self.rss_growth:
+                stage['peakRssGrowthMb'] = round(self.rss_growth[name] / (1 << 20), 1)
+            if name in self.peak_traced:
+                stage['peakTracedMb'] = round(self.peak_traced[name] / (1 << 20), 2)
+            stages[name] = stage
+        return {
+            'totalSeconds': round(time.perf_counter() - self._started, 6),
+            'stages': stages,
+        }
+
+def timed_stage(timer, name):
+    """timer.stage(name), or a no-op when no timer is in use"""
+    return timer.stage(name) if timer is not None else contextlib.nullcontext()
+
+def peak_rss_bytes():
+    """High-water mark of this process's resident memory"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS and kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+@contextlib.contextmanager
+def profiling(profile_dir, label):
+    """Optionally run the block under cProfile and tracemalloc, dumping reports to profile_dir
+    
+    Yields a dict that is filled with the paths of the written reports.
+    """
+    outputs = {}
+    if not profile_dir:
+        yield outputs
+        return
+    
+    os.makedirs(profile_dir, exist_ok=True)
+    base_path = os.path.join(profile_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', label)}_{int(time.time() * 1000)}")
+    profiler = cProfile.Profile()
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+    
+    profiler.enable()
+    try:
+        yield outputs
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracing:
+            tracemalloc.stop()
+        
+        outputs['cprofile'] = base_path + '.prof'
+        profiler.dump_stats(outputs['cprofile'])
+        
+        outputs['cprofileSummary'] = base_path + '.prof.txt'
+        with open(outputs['cprofileSummary'], 'w') as f:
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(PROFILE_TOP_ENTRIES)
+        
+        outputs['tracemalloc'] = base_path + '.tracemalloc.txt'
+        with open(outputs['tracemalloc'], 'w') as f:
+            for entry in snapshot.statistics('lineno')[:PROFILE_TOP_ENTRIES]:
+                f.write(f"{entry}\n")
+        
+        logger.info(f"Wrote profiling reports to {base_path}.*")
+
+class ProgressReporter:
+    """Throttled, machine-readable progress records on a dedicated stream
+    
+    Each record is one JSON line with the current stage and running counts of
+    notes built, media added and bytes zipped. Without a stream the counters
+    are still kept but nothing is written.
+    """
+    
+    def __init__(self, stream=None, request_id=None, interval=PROGRESS_INTERVAL_SECONDS):
+        self.stream = stream
+        self.request_id = request_id
+        self.interval = interval
+        self.stage = None
+        self.counters = {'notesBuilt': 0, 'mediaAdded': 0, 'bytesZipped': 0}
+        self._last_emit = 0.0
+        # The heartbeat thread emits too
+        self._lock = threading.Lock()
+    
+    def set_stage(self, stage):
+        self.stage = stage
+        self.emit(force=True)
+    
+    def add(self, counter, amount=1):
+        self.counters[counter] += amount
+        if self.stream is not None and time.monotonic() - self._last_emit >= self.interval:
+            self.emit()
+    
+    def track(self, counter, iterable):
+        """Yield from iterable, counting each item under counter"""
+        for item in iterable:
+            yield item
+            self.add(counter)
+    
+    @contextlib.contextmanager
+    def heartbeat(self, interval=HEARTBEAT_INTERVAL_SECONDS):
+        """Repeat the latest record every interval seconds while the block runs
+        
+        For phases that move no counter for minutes (genanki's write_to_db,
+        deduping a whole deck, waiting on a large deck in the batch pool), so
+        the bridge's idle timeout doesn't kill a healthy job.
+        """
+        if self.stream is None:
+            yield
+            return
+        
+        stopped = threading.Event()
+        
+        def beat():
+            while not stopped.wait(interval):
+                if time.monotonic() - self._last_emit >= interval:
+                    self.emit()
+        
+        thread = threading.Thread(target=beat, name='progress-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+    
+    def emit(self, force=False):
+        with self._lock:
+            if self.stream is None:
+                return
+            
+            self._last_emit = time.monotonic()
+            record = {'event': 'progress', 'stage': self.stage, **self.counters}
+            if self.request_id is not None:
+                record['id'] = self.request_id
+            
+            try:
+                self.stream.write(json.dumps(record) + '\n')
+                self.stream.flush()
+            except (BrokenPipeError, ValueError, OSError):
+                # Nobody is listening any more; packaging carries on regardless
+                self.stream = None
+
+def heartbeat(progress):
+    """progress.heartbeat(), or a no-op when no reporter is in use"""
+    return progress.heartbeat() if progress is not None else contextlib.nullcontext()
+
+def open_progress_stream(fd):
+    """Line-buffered text stream over an inherited file descriptor, or None"""
+    if fd is None:
+        return None
+    try:
+        return os.fdopen(fd, 'w', buffering=1, encoding='utf-8')
+    except OSError as e:
+        logger.warning(f"Progress channel on fd {fd} unavailable: {str(e)}")
+        return None
+
+# Opt-in profiling, enabled with --profile DIR or ANKI_GENERATOR_PROFILE=DIR
+PROFILE_TOP_ENTRIES = 40
+PROFILE_TRACEMALLOC_FRAMES = 5
+
+# Direct SQLite backend settings
+SQLITE_BATCH_SIZE = 1000
+SQLITE_BUILD_PRAGMAS = (
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA locking_mode = EXCLUSIVE',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -65536',
+)
+NOTE_INSERT_SQL = 'INSERT INTO notes VALUES(?,?,?,?,?,?,?,?,?,?,?)'
+CARD_INSERT_SQL = 'INSERT INTO cards VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'
+# .apkg zip settings: PNG/JPEG/GIF are already compressed, text-like media is not
+ZIP_CHUNK_SIZE = 1 << 20
+ZIP_COMPRESS_LEVEL = 6
+DEFLATE_MEDIA_EXTENSIONS = ('.svg', '.html', '.htm', '.css', '.txt', '.json', '.xml')
+NOTE_UPDATE_SQL = 'UPDATE notes SET guid=?, mid=?, mod=?, usn=?, tags=?, flds=?, sfld=?, csum=?, flags=?, data=? WHERE id=?'
+
+# Flat-file output: backend name -> (separator, the name Anki's importer header uses for it)
+FLAT_FORMATS = {'tsv': ('\t', 'Tab'), 'csv': (',', 'Comma')}
+# Columns: GUID, note type, deck, the model's two fields, tags
+FLAT_HEADER = '#html:true\n#guid column:1\n#notetype column:2\n#deck column:3\n#tags column:6\n'
+
+# Incremental note cache; bump the version when note building changes
+NOTE_CACHE_VERSION = 6
+NOTE_CACHE_SCHEMA = """
+CREATE TABLE cache.meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE cache.note_cache (
+    source_key TEXT PRIMARY KEY,
+    input_hash TEXT NOT NULL,
+    note_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    media TEXT NOT NULL
+);
+CREATE INDEX cache.ix_note_cache_note_id ON note_cache (note_id);
+"""
+NOTE_CACHE_INDEX_SUFFIX = '.notes.sqlite'
+# Other decks' caches are evicted past these limits after each incremental build (0 disables)
+NOTE_CACHE_MAX_BYTES = int(float(os.environ.get('ANKI_NOTE_CACHE_MAX_MB', '512')) * 1024 * 1024)
+NOTE_CACHE_MAX_AGE_SECONDS = float(os.environ.get('ANKI_NOTE_CACHE_MAX_AGE_DAYS', '30')) * 24 * 60 * 60
+
+CLOZE_ORD_RE = re.compile(r"{{c(\d+)::.+?}}", re.DOTALL)
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+# Tags whose file name Anki keeps in the first-field checksum
+MEDIA_TAG_RE = re.compile(
+    r'''<(?:img|audio|video|source)\b[^>]*?\ssrc\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))[^>]*>''', re.IGNORECASE)
+
+# Batches smaller than this are built in-process; pool start-up would outweigh the gain
+BATCH_POOL_MIN_CARDS = 2000
+
+# Field compaction: inline <style> blocks move into model CSS, markup whitespace is collapsed
+MAX_SHARED_STYLE_BLOCKS = 32
+# notes.data of generated notes: this prefix, then digests of the model CSS blocks hoisted out of the note
+NOTE_STYLES_PREFIX = 'styles:'
+# Unrolled rather than lazy .*? so the scan doesn't step one character at a time
+STYLE_BLOCK_RE = re.compile(r'<style\b[^>]*>([^<]*(?:<(?!/style\s*>)[^<]*)*)</style\s*>', re.IGNORECASE)
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+CSS_PUNCTUATION_SPACE_RE = re.compile(r'\s*([{};,>])\s*')
+WHITESPACE_RE = re.compile(r'\s+')
+COLLAPSIBLE_WHITESPACE_RE = re.compile(r'[ \t\r\n\f\v]+')
+# Whitespace that str.split() would swallow but that renders, such as non-breaking spaces
+RENDERED_SPACE_RE = re.compile(r'[^\S \t\r\n\f\v]')
+PRESERVED_WHITESPACE_RE = re.compile(r'(<(pre|textarea)\b.*?</\2\s*>)', re.IGNORECASE | re.DOTALL)
+
 def process_input_data(input_json_path):
-    """Read and process the input JSON data"""
+    """Read and process the input JSON data
+    
+    Paths ending in .ndjson/.jsonl, or '-' for stdin, are read as streaming NDJSON:
+    a header line with deckName, deckId and images followed by one card per line.
+    """
     try:
-        with open(input_json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        if input_json_path == '-':
+            data = read_ndjson_input(sys.stdin)
+        elif input_json_path.endswith(NDJSON_EXTENSIONS):
+            f = open(input_json_path, 'r', encoding='utf-8')
+            try:
+                data = read_ndjson_input(f, close=True)
+            except BaseException:
+                # Once the header is read the card iterator owns the file and closes it
+                f.close()
+                raise
+        else:
+            with open(input_json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
             
         logger.info(f"Successfully loaded JSON data from {input_json_path}")
         return data
@@ -65,22 +526,1515 @@ def process_input_data(input_json_path):
         logger.error(f"Error loading JSON: {str(e)}")
         raise
 
-def create_anki_package(data, output_path, media_folder):
-    """Create an Anki package from the provided data"""
+MEDIA_HASH_CHUNK_SIZE = 1 << 20
+
+def hash_file(path):
+    """SHA-256 of a file's contents, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MEDIA_HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def resolve_media_path(media_folder, image_path):
+    """Find an image on disk, trying its path under media_folder before its bare basename"""
+    relative_path = os.path.join(media_folder, image_path.lstrip('/\\'))
+    if os.path.isfile(relative_path):
+        return relative_path
+    return os.path.join(media_folder, os.path.basename(image_path))
+
+class MediaStore:
+    """Content-addressed media set for one package
+    
+    Each distinct blob is stored once under the basename it was first seen with;
+    later copies are mapped onto that canonical name so fields can be rewritten.
+    """
+    
+    def __init__(self):
+        self.files = []
+        self.renames = {}
+        self._by_digest = {}
+        self._seen_paths = set()
+        self._names = set()
+        self._paths = {}
+        self._missing_paths = set()
+        self.stats = {'unique': 0, 'duplicates': 0, 'missing': 0, 'bytesSaved': 0}
+    
+    def add(self, source_path):
+        """Register a file and return its canonical name, or None if it doesn't exist"""
+        if source_path in self._seen_paths:
+            return os.path.basename(source_path)
+        
+        if not os.path.isfile(source_path):
+            logger.warning(f"Image file not found: {source_path}")
+            self._missing_paths.add(source_path)
+            self.stats['missing'] += 1
+            return None
+        
+        self._seen_paths.add(source_path)
+        name = os.path.basename(source_path)
+        self._names.add(name)
+        digest = hash_file(source_path)
+        canonical = self._by_digest.get(digest)
+        
+        if canonical is None:
+            self._by_digest[digest] = name
+            self._paths.setdefault(name, source_path)
+            self.files.append(source_path)
+            self.stats['unique'] += 1
+            return name
+        
+        if canonical != name:
+            self.renames[name] = canonical
+        self.stats['duplicates'] += 1
+        self.stats['bytesSaved'] += os.path.getsize(source_path)
+        return canonical
+    
+    def canonical_name(self, name):
+        """Canonical name for a basename already in the store, or None"""
+        if name in self.renames:
+            return self.renames[name]
+        return name if name in self._names else None
+    
+    def path_for(self, name):
+        """Source path of the file packaged under a canonical name, or None"""
+        return self._paths.get(name)
+    
+    def source_paths(self):
+        """Every path looked up: packaged, duplicate or missing
+        
+        A change to any of these files (or a missing one appearing) can change
+        the package, so callers caching packages fingerprint all of them.
+        """
+        return sorted(self._seen_paths | self._missing_paths)
+
+# Field tokens, matched in one left-to-right scan: unsafe elements with their
+# content, stray unsafe tags, <img> tags, markdown images, and any other start
+# tag with attributes
+UNSAFE_ELEMENTS = 'script|iframe|object|embed|applet|frame|frameset|noscript'
+UNSAFE_TAGS = f'{UNSAFE_ELEMENTS}|link|meta|base|form'
+# A quoted attribute value may contain ">"
+TAG_ATTRIBUTES = r'''(?:"[^"]*"|'[^']*'|[^'">])*'''
+# Every token starts with "<" or "!"; the lookahead lets the scan skip other characters
+# without trying each alternative at every position. An unsafe tag with an
+# unbalanced quote is dropped up to the next ">", or to the end of the field.
+FIELD_TOKEN_RE = re.compile(
+    r'(?=[<!])(?:'
+    rf'(?P<element><(?P<element_name>{UNSAFE_ELEMENTS})\b{TAG_ATTRIBUTES}>.*?</(?P=element_name)\s*>)'
+    rf'|(?P<unsafe></?(?:{UNSAFE_TAGS})\b(?:{TAG_ATTRIBUTES}>|[^>]*>?))'
+    rf'|(?P<img><img\b{TAG_ATTRIBUTES}>)'
+    r'|!\[(?P<alt>[^\]\n]*)\]\(\s*(?P<target><[^>\n]*>|[^)\s]+)(?:\s+"[^"\n]*")?\s*\)'
+    rf'|(?P<tag><[a-z][\w:-]*[\s/]{TAG_ATTRIBUTES}>))',
+    re.IGNORECASE | re.DOTALL)
+IMG_SRC_RE = re.compile(r'''(\ssrc\s*=\s*)(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.IGNORECASE)
+# Browsers also accept "/" between attributes, as in <svg/onload=...>
+EVENT_ATTR_RE = re.compile(r'''[\s/]+on[a-z]+\s*=\s*(?:"[^"]*"|'[^']*'|[^\s>]+)''', re.IGNORECASE)
+URL_ATTR_RE = re.compile(
+    r'''[\s/]+(?:href|src|action|formaction|xlink:href|background|poster|data)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''',
+    re.IGNORECASE)
+# References left as they are: remote and inline images
+EXTERNAL_REFERENCE_RE = re.compile(r'^(?:https?:|data:|//)', re.IGNORECASE)
+UNSAFE_SCHEME_RE = re.compile(r'^(?:javascript|vbscript):', re.IGNORECASE)
+# Browsers ignore control characters and whitespace anywhere in a URL's scheme
+URL_IGNORED_CHARS_RE = re.compile(r'[\x00-\x20]')
+
+def is_unsafe_url(value):
+    return bool(UNSAFE_SCHEME_RE.match(URL_IGNORED_CHARS_RE.sub('', html.unescape(value))))
+
+class FieldRewriter:
+    """Rewrite of card fields before they are stored
+    
+    Fields are first sanitized: script-like elements, inline event handlers
+    and javascript:/vbscript: URLs on any tag are dropped, and the scan is
+    repeated until nothing more is removed, since a removal can join the
+    text around it into a new tag or attribute. One more scan then turns
+    markdown images into <img> tags, points every local image reference at
+    its media name (the canonical one for duplicate files) and registers the
+    file with the MediaStore. References to missing files are logged and
+    left pointing at their basename.
+    """
+    
+    def __init__(self, media, media_folder, names=None):
+        self.media = media
+        self.media_folder = media_folder
+        # Reference -> media name; a batch export seeds it with the names resolved in the parent
+        self._names = dict(names) if names else {}
+        # Media names referenced by the note being rewritten (see rewrite_fields)
+        self.note_media = set()
+        self.stats = {'references': 0, 'missingReferences': 0, 'unsafeRemoved': 0}
+    
+    def media_name(self, reference):
+        """Media name for a local reference, adding the file to the package"""
+        name = self._names.get(reference)
+        if name is None:
+            path = unquote(reference).split('?', 1)[0]
+            # Fields usually name listed images by basename alone
+            name = self.media.canonical_name(path)
+            if name is None:
+                path = resolve_media_path(self.media_folder, path)
+                name = self.media.add(path)
+                if name is None:
+                    logger.warning(f"Card references missing image: {reference}")
+                    self.stats['missingReferences'] += 1
+                    name = os.path.basename(path)
+                # A path seen before comes back under its own basename, which may be a duplicate
+                name = self.media.renames.get(name, name)
+            self._names[reference] = name
+        self.note_media.add(name)
+        self.stats['references'] += 1
+        return name
+    
+    def resolved_names(self):
+        """Reference -> media name for every reference resolved so far"""
+        return dict(self._names)
+    
+    def add_related_images(self, card):
+        """Pull the card's related images into the package"""
+        for image_path in card.related_images:
+            if isinstance(image_path, str) and not EXTERNAL_REFERENCE_RE.match(image_path):
+                self.media_name(image_path)
+    
+    def register(self, card):
+        """Resolve and package the media a card references, without rewriting anything
+        
+        Batch exports run this over every deck in the parent, so decks built in
+        separate processes agree on each file's media name.
+        """
+        self.add_related_images(card)
+        try:
+            fields = build_note(card)[2]
+        except Exception:
+            # The deck build logs and counts the card's error
+            return
+        for field in fields:
+            for match in FIELD_TOKEN_RE.finditer(self.sanitize(field or '')):
+                if match.group('img'):
+                    src_match = IMG_SRC_RE.search(match.group('img'))
+                    if src_match is not None:
+                        self.rewrite_src(next(value for value in src_match.groups()[1:] if value is not None))
+                elif match.group('target'):
+                    self.rewrite_src(match.group('target').strip('<>'))
+    
+    def rewrite_src(self, src):
+        """New value for an image source, or None to drop the image"""
+        if is_unsafe_url(src):
+            return None
+        src = html.unescape(src.strip())
+        if not src or EXTERNAL_REFERENCE_RE.match(src):
+            return src
+        return self.media_name(src)
+    
+    def drop_unsafe_url(self, match):
+        if is_unsafe_url(next(value for value in match.groups() if value is not None)):
+            self.stats['unsafeRemoved'] += 1
+            return ''
+        return match.group(0)
+    
+    def strip_unsafe_attributes(self, tag):
+        """tag without inline event handlers and javascript:/vbscript: URLs"""
+        tag, removed = EVENT_ATTR_RE.subn('', tag)
+        self.stats['unsafeRemoved'] += removed
+        return URL_ATTR_RE.sub(self.drop_unsafe_url, tag)
+    
+    def drop_unsafe(self, match):
+        """Sanitizing replacement for a token; it only ever removes text"""
+        if match.group('tag'):
+            return self.strip_unsafe_attributes(match.group('tag'))
+        
+        if match.group('img'):
+            tag, removed = EVENT_ATTR_RE.subn('', match.group('img'))
+            self.stats['unsafeRemoved'] += removed
+            src_match = IMG_SRC_RE.search(tag)
+            if src_match is not None and is_unsafe_url(next(value for value in src_match.groups()[1:] if value is not None)):
+                self.stats['unsafeRemoved'] += 1
+                return ''
+            return tag
+        
+        if match.group('target'):
+            if is_unsafe_url(match.group('target').strip('<>')):
+                self.stats['unsafeRemoved'] += 1
+                return ''
+            return match.group(0)
+        
+        self.stats['unsafeRemoved'] += 1
+        return ''
+    
+    def sanitize(self, text):
+        """text with unsafe markup removed, rescanned until it stops changing
+        
+        Each scan only removes text, so this always terminates.
+        """
+        while True:
+            cleaned = FIELD_TOKEN_RE.sub(self.drop_unsafe, text)
+            if cleaned == text:
+                return text
+            text = cleaned
+    
+    def replace(self, match):
+        if match.group('img'):
+            tag = match.group('img')
+            src_match = IMG_SRC_RE.search(tag)
+            if src_match is None:
+                return tag
+            src = self.rewrite_src(next(value for value in src_match.groups()[1:] if value is not None))
+            return f'{tag[:src_match.start()]}{src_match.group(1)}"{html.escape(src)}"{tag[src_match.end():]}'
+        
+        if match.group('target'):
+            src = self.rewrite_src(match.group('target').strip('<>'))
+            return f'<img src="{html.escape(src)}" alt="{html.escape(match.group("alt"))}">'
+        
+        return match.group(0)
+    
+    def rewrite(self, text):
+        if not text:
+            return text
+        # Sanitized text has no unsafe tokens left, so rewrite_src never drops an image here
+        return FIELD_TOKEN_RE.sub(self.replace, self.sanitize(text))
+
+def build_note(card):
+    """Turn a Card into (kind, model, fields, tags) ready for either backend"""
+    tags = card.tags
+    
+    # Anki stores tags space-separated, so a tag can't contain whitespace
+    for tag in tags:
+        if ' ' in tag:
+            raise ValueError(f'Tag "{tag}" contains a space; this is not allowed!')
+    
+    # Handle cloze cards
+    if card.type == 'cloze':
+        cloze_text = card.text
+        extra_text = card.notes
+        
+        # Ensure the cloze text has at least one cloze marker
+        if '{{c' not in cloze_text:
+            # Try to find meaningful words to create a cloze
+            words = cloze_text.split()
+            for i, word in enumerate(words):
+                if len(word) > 5 and word.isalpha() and word.lower() not in ['about', 'there', 'their', 'would', 'could', 'should']:
+                    cloze_text = cloze_text.replace(word, f"{{{{c1::{word}}}}}", 1)
+                    break
+        
+        return 'cloze', cloze_model, [cloze_text, extra_text], tags
+    
+    # Handle standard Q&A cards
+    front = card.question
+    back = card.answer
+    
+    # Add notes if available
+    if card.notes:
+        back += f"<hr>{card.notes}"
+    
+    return 'standard', basic_model, [front, back], tags
+
+def minify_css(css):
+    """Drop comments and insignificant whitespace from a stylesheet"""
+    css = CSS_COMMENT_RE.sub('', css)
+    css = WHITESPACE_RE.sub(' ', css)
+    css = CSS_PUNCTUATION_SPACE_RE.sub(r'\1', css)
+    return css.replace(': ', ':').replace(';}', '}').strip()
+
+def minify_html(text):
+    """Collapse whitespace runs to single spaces, which renders identically
+    
+    Content of <pre> and <textarea> elements is left untouched.
+    """
+    if '<pre' not in text and '<textarea' not in text:
+        # str.split() is far faster than a regex substitution when it's safe to use
+        if text.isascii() or not RENDERED_SPACE_RE.search(text):
+            return ' '.join(text.split())
+        return COLLAPSIBLE_WHITESPACE_RE.sub(' ', text).strip()
+    
+    parts = PRESERVED_WHITESPACE_RE.split(text)
+    # split() yields text, then the preserved element and its tag name, repeating
+    out = []
+    for i in range(0, len(parts), 3):
+        out.append(COLLAPSIBLE_WHITESPACE_RE.sub(' ', parts[i]))
+        if i + 1 < len(parts):
+            out.append(parts[i + 1])
+    return ''.join(out).strip()
+
+class FieldCompactor:
+    """Moves inline <style> blocks into model-level CSS and minifies field HTML
+    
+    Notes formatted by app.js carry the same stylesheet in every card, so the
+    collection stores it once per note. Model CSS applies to every note of
+    the model, so a (minified) block is only shared once a second note
+    carries it: the first copy stays inline, and from then on the block is
+    registered on the model of the note it came from and stripped from the
+    field. Blocks used by a single note never leave it. Past
+    MAX_SHARED_STYLE_BLOCKS shared blocks, further ones are left inline so
+    the model CSS can't grow without bound.
+    
+    After compact, note_styles holds the blocks stripped from that note.
+    """
+    
+    def __init__(self, max_shared_styles=MAX_SHARED_STYLE_BLOCKS):
+        self.max_shared_styles = max_shared_styles
+        # model_id -> distinct minified blocks, in first-seen order
+        self.styles = {}
+        self._known = set()
+        # Blocks seen in an earlier note but not shared yet
+        self._seen = set()
+        # Raw block text -> minified CSS; the same block usually repeats verbatim
+        self._minified = {}
+        self.note_styles = []
+        self.stats = {'bytesBefore': 0, 'bytesAfter': 0, 'styleBlocksHoisted': 0, 'sharedStyles': 0}
+    
+    def compact(self, model, fields):
+        """Return the note's fields with shared styles hoisted and whitespace minified"""
+        model_styles = self.styles.setdefault(model.model_id, [])
+        note_blocks = set()
+        self.note_styles = []
+        
+        def hoist(match):
+            raw = match.group(1)
+            block = self._minified.get(raw)
+            if block is None:
+                block = self._minified[raw] = minify_css(raw)
+            if not block:
+                return ''
+            if block not in self._known:
+                if block not in self._seen or len(self._known) >= self.max_shared_styles:
+                    note_blocks.add(block)
+                    return f'<style>{block}</style>'
+                self._known.add(block)
+                self._seen.discard(block)
+                self.stats['sharedStyles'] += 1
+            if block not in model_styles:
+                model_styles.append(block)
+            if block not in self.note_styles:
+                self.note_styles.append(block)
+            self.stats['styleBlocksHoisted'] += 1
+            return ''
+        
+        compacted = []
+        for field in fields:
+            self.stats['bytesBefore'] += len(field.encode('utf-8'))
+            field = STYLE_BLOCK_RE.sub(hoist, field)
+            field = minify_html(field)
+            self.stats['bytesAfter'] += len(field.encode('utf-8'))
+            compacted.append(field)
+        
+        if len(self._known) < self.max_shared_styles:
+            self._seen |= note_blocks
+        return compacted
+
+def media_store(images, media_folder, progress=None):
+    """MediaStore holding the listed images, each identical file once"""
+    media = MediaStore()
+    for image in map(ImageRef.coerce, images):
+        if media.add(resolve_media_path(media_folder, image.path)) and progress is not None:
+            progress.add('mediaAdded')
+    return media
+
+def note_builders(media, media_folder, compact, stats, keep_styles=False):
+    """(FieldRewriter, FieldCompactor or None) for building a deck's notes, reporting into stats"""
+    rewriter = FieldRewriter(media, media_folder)
+    stats['rewrite'] = rewriter.stats
+    compactor = field_compactor(compact, keep_styles)
+    if compactor is not None:
+        stats['compaction'] = compactor.stats
+    return rewriter, compactor
+
+def field_compactor(compact, keep_styles=False):
+    """FieldCompactor for a build, or None; keep_styles only minifies, for outputs without model CSS"""
+    if not compact:
+        return None
+    return FieldCompactor(max_shared_styles=0) if keep_styles else FieldCompactor()
+
+def note_guid(card, fields):
+    """Stable GUID from the card's source key, falling back to genanki's field hash"""
+    if card.source_key:
+        return guid_for(card.source_key)
+    return guid_for(*fields)
+
+def rewrite_fields(rewriter, card, fields):
+    """Rewrite a note's fields and pull the card's related images into the package
+    
+    Afterwards rewriter.note_media holds the media names the note references.
+    """
+    rewriter.note_media.clear()
+    rewriter.add_related_images(card)
+    return [rewriter.rewrite(field) for field in fields]
+
+def style_digest(block):
+    """Short digest naming a hoisted style block in notes.data"""
+    return hashlib.blake2b(block.encode('utf-8'), digest_size=6).hexdigest()
+
+def note_styles_data(blocks):
+    """notes.data value recording the hoisted style blocks a note relies on"""
+    return NOTE_STYLES_PREFIX + ' '.join(map(style_digest, blocks))
+
+def iter_built_notes(cards_data, stats, rewriter=None, compactor=None):
+    """Lazily build notes from cards, counting successes and failures in stats
+    
+    Yields (model, fields, tags, guid, data) with data the note's notes.data
+    value (see note_styles_data).
+    """
+    for card in cards_data:
+        try:
+            kind, model, fields, tags = build_note(card)
+            if rewriter is not None:
+                fields = rewrite_fields(rewriter, card, fields)
+            # Hashed before compaction so content-keyed GUIDs match earlier packages
+            guid = note_guid(card, fields)
+            styles = []
+            if compactor is not None:
+                fields = compactor.compact(model, fields)
+                styles = compactor.note_styles
+        except Exception as e:
+            logger.error(f"Error processing card: {str(e)}")
+            stats['error'] += 1
+            continue
+        
+        stats[kind] += 1
+        yield model, fields, tags, guid, note_styles_data(styles)
+
+def card_ords_for(model, fields):
+    """Card ordinals a note generates, matching genanki's rules"""
+    if model.model_type == genanki.Model.CLOZE:
+        return sorted({int(m) - 1 for m in CLOZE_ORD_RE.findall(fields[0]) if int(m) > 0})
+    return [0] if fields[0] else []
+
+def field_checksum(field):
+    """Anki's duplicate-check checksum: first 8 hex digits of SHA1 of the stripped field
+    
+    As in Anki, media tags are replaced by their file names before the rest
+    of the markup is stripped. genanki leaves the column at 0.
+    """
+    text = MEDIA_TAG_RE.sub(lambda match: f" {next(value for value in match.groups() if value is not None)} ", field)
+    stripped = html.unescape(HTML_TAG_RE.sub('', text)).strip()
+    return int(hashlib.sha1(stripped.encode('utf-8')).hexdigest()[:8], 16)
+
+def zip_compression_for(filename):
+    """Deflate text-like members; store already-compressed media as-is"""
+    if filename.lower().endswith(DEFLATE_MEDIA_EXTENSIONS):
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+def copy_in_chunks(src, dest, progress=None):
+    """Copy between file objects in ZIP_CHUNK_SIZE pieces, reporting bytes written"""
+    for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b''):
+        dest.write(chunk)
+        if progress is not None:
+            progress.add('bytesZipped', len(chunk))
+
+def zip_file_member(outzip, source_path, arcname, compress_type, label=None, progress=None):
+    """Stream one file into the archive in fixed-size chunks and report on it"""
+    start = time.perf_counter()
+    zinfo = zipfile.ZipInfo.from_file(source_path, arcname)
+    zinfo.compress_type = compress_type
+    
+    with open(source_path, 'rb') as src, outzip.open(zinfo, 'w') as dest:
+        copy_in_chunks(src, dest, progress)
+    
+    return {
+        'name': arcname,
+        'file': label or os.path.basename(source_path),
+        'method': 'deflate' if compress_type == zipfile.ZIP_DEFLATED else 'store',
+        'bytes': zinfo.file_size,
+        'compressedBytes': zinfo.compress_size,
+        'seconds': round(time.perf_counter() - start, 6),
+    }
+
+def write_apkg_zip(output_path, db_path, media_files, progress=None):
+    """Zip a built collection and its media into an .apkg
+    
+    Returns a per-member breakdown of sizes and write times.
+    """
+    start = time.perf_counter()
+    members = []
+    if progress is not None:
+        progress.set_stage('zip')
+    
+    with zipfile.ZipFile(output_path, 'w', compresslevel=ZIP_COMPRESS_LEVEL) as outzip:
+        members.append(zip_file_member(outzip, db_path, 'collection.anki2', zipfile.ZIP_DEFLATED,
+                                       label='collection.anki2', progress=progress))
+        
+        media_json = {idx: os.path.basename(path) for idx, path in enumerate(media_files)}
+        outzip.writestr('media', json.dumps(media_json), compress_type=zipfile.ZIP_DEFLATED)
+        
+        for idx, path in enumerate(media_files):
+            members.append(zip_file_member(outzip, path, str(idx), zip_compression_for(path), progress=progress))
+    
+    return {
+        'seconds': round(time.perf_counter() - start, 6),
+        'bytes': os.path.getsize(output_path),
+        'members': members,
+    }
+
+@contextlib.contextmanager
+def temp_collection_path():
+    """Path for a throwaway collection database, removed afterwards"""
+    db_fd, db_path = tempfile.mkstemp(suffix='.anki2')
+    os.close(db_fd)
     try:
-        # Extract components from data
-        deck_name = data.get('deckName', 'OneNote Converted Deck')
-        cards_data = data.get('cards', [])
-        images = data.get('images', [])
+        yield db_path
+    finally:
+        os.remove(db_path)
+
+def write_package_genanki(deck_id, deck_name, notes, media_files, output_path, timer=None, progress=None,
+                          compactor=None):
+    """Build the package through genanki's object model"""
+    deck = genanki.Deck(deck_id, deck_name)
+    note_data = []
+    for model, fields, tags, guid, data in notes:
+        deck.add_note(genanki.Note(model=model, fields=fields, tags=tags, guid=guid))
+        note_data.append((data, guid))
+    
+    package = genanki.Package(deck)
+    timestamp = time.time()
+    
+    # Let genanki fill the database, but do the zipping ourselves
+    with temp_collection_path() as db_path:
+        conn = sqlite3.connect(db_path)
+        try:
+            cursor = conn.cursor()
+            with heartbeat(progress):
+                package.write_to_db(cursor, timestamp, itertools.count(int(timestamp * 1000)))
+            # genanki writes 0 checksums; fill in Anki's so both backends write the same rows
+            cursor.executemany('UPDATE notes SET csum = ? WHERE id = ?',
+                               [(field_checksum(flds.split('\x1f', 1)[0]), note_id)
+                                for note_id, flds in cursor.execute('SELECT id, flds FROM notes').fetchall()])
+            cursor.executemany('UPDATE notes SET data = ? WHERE guid = ?', note_data)
+            if compactor is not None:
+                rebuild_model_css(cursor, compactor.styles)
+            conn.commit()
+        finally:
+            conn.close()
         
-        # Create deck with consistent ID generation based on name
-        # This helps if the user regenerates the same deck
-        deck_id = random.randrange(1 << 30, 1 << 31)
-        if 'deckId' in data:
-            # Use provided ID if available
-            deck_id = data['deckId']
+        with timed_stage(timer, 'zip'):
+            return write_apkg_zip(output_path, db_path, media_files, progress)
+
+def init_collection(cursor, deck_id, deck_name, timestamp):
+    """Create genanki's empty collection schema with our deck and models registered"""
+    cursor.executescript(APKG_SCHEMA)
+    cursor.executescript(APKG_COL)
+    update_collection_metadata(cursor, deck_id, deck_name, timestamp)
+
+def update_collection_metadata(cursor, deck_id, deck_name, timestamp):
+    """Write the deck and both note models into the col row"""
+    decks_json_str, = cursor.execute('SELECT decks FROM col').fetchone()
+    decks = json.loads(decks_json_str)
+    decks[str(deck_id)] = genanki.Deck(deck_id, deck_name).to_json()
+    
+    models_json_str, = cursor.execute('SELECT models FROM col').fetchone()
+    models = json.loads(models_json_str)
+    for model in (cloze_model, basic_model):
+        model_json = model.to_json(timestamp, deck_id)
+        # Keep styles hoisted by earlier builds until rebuild_model_css sees which are still used
+        previous = models.get(str(model.model_id))
+        if previous and previous.get('css'):
+            model_json['css'] = previous['css']
+        models[str(model.model_id)] = model_json
+    
+    cursor.execute('UPDATE col SET decks = ?, models = ?', (json.dumps(decks), json.dumps(models)))
+
+def rebuild_model_css(cursor, styles):
+    """Set each model's CSS to the hoisted style blocks its notes still rely on
+    
+    styles maps model IDs to the blocks hoisted by this build; blocks hoisted
+    by earlier builds are read back from the models' current CSS. Blocks no
+    note of the model records in notes.data are dropped, unless one of its
+    notes predates those records (see note_styles_data).
+    """
+    referenced = {}
+    for model_id, data in cursor.execute('SELECT mid, data FROM notes'):
+        digests = referenced.setdefault(model_id, set())
+        if digests is None:
+            continue
+        if data.startswith(NOTE_STYLES_PREFIX):
+            digests.update(data[len(NOTE_STYLES_PREFIX):].split())
+        else:
+            referenced[model_id] = None
+    
+    models_json_str, = cursor.execute('SELECT models FROM col').fetchone()
+    models = json.loads(models_json_str)
+    
+    for model in (cloze_model, basic_model):
+        model_json = models.get(str(model.model_id))
+        if model_json is None:
+            continue
+        base_lines = set(model.css.split('\n'))
+        # Hoisted blocks are minified onto one line each, after the model's own CSS
+        blocks = [line for line in (model_json.get('css') or '').split('\n') if line and line not in base_lines]
+        blocks.extend(styles.get(model.model_id, ()))
+        digests = referenced.get(model.model_id, set())
+        used = [block for block in blocks if digests is None or style_digest(block) in digests]
+        model_json['css'] = '\n'.join(filter(None, [model.css, *dict.fromkeys(used)]))
+    
+    cursor.execute('UPDATE col SET models = ?', (json.dumps(models),))
+
+def note_row(note_id, model, fields, tags, guid, mod, data):
+    """Values for one row of the notes table"""
+    return (
+        note_id,
+        guid,
+        model.model_id,
+        mod,
+        -1,
+        ' ' + ' '.join(tags) + ' ',
+        '\x1f'.join(fields),
+        fields[model.sort_field_index],
+        field_checksum(fields[0]),
+        0,
+        data,
+    )
+
+def card_rows_for(note_id, deck_id, model, fields, mod, id_gen):
+    """Values for the cards table rows a note generates"""
+    return [(next(id_gen), note_id, deck_id, ord_, mod, -1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, '')
+            for ord_ in card_ords_for(model, fields)]
+
+def write_package_sqlite(deck_id, deck_name, notes, media_files, output_path, timer=None, progress=None,
+                         compactor=None, timestamp=None):
+    """Build the collection directly with batched inserts, then zip it"""
+    # compactor.styles fills up while notes are consumed, before it's read at the end
+    styles = compactor.styles if compactor is not None else None
+    return write_decks_sqlite([(deck_id, deck_name, notes)], media_files, output_path, timer=timer,
+                              progress=progress, styles=styles, timestamp=timestamp)
+
+def write_decks_sqlite(decks, media_files, output_path, timer=None, progress=None, styles=None, timestamp=None):
+    """Write one or more (deck_id, deck_name, notes) into a single collection, then zip it"""
+    if timestamp is None:
+        timestamp = time.time()
+    mod = int(timestamp)
+    # Notes and cards share one id sequence, as in genanki
+    id_gen = itertools.count(int(timestamp * 1000))
+    
+    with temp_collection_path() as db_path:
+        conn = sqlite3.connect(db_path)
+        try:
+            # The file is a throwaway build artifact, so durability is irrelevant
+            for pragma in SQLITE_BUILD_PRAGMAS:
+                conn.execute(pragma)
             
-        deck = genanki.Deck(deck_id, deck_name)
+            cursor = conn.cursor()
+            (first_id, first_name, _), *other_decks = decks
+            init_collection(cursor, first_id, first_name, timestamp)
+            for deck_id, deck_name, _ in other_decks:
+                update_collection_metadata(cursor, deck_id, deck_name, timestamp)
+            
+            note_rows = []
+            card_rows = []
+            for deck_id, _, notes in decks:
+                for model, fields, tags, guid, data in notes:
+                    note_id = next(id_gen)
+                    note_rows.append(note_row(note_id, model, fields, tags, guid, mod, data))
+                    card_rows.extend(card_rows_for(note_id, deck_id, model, fields, mod, id_gen))
+                    
+                    if len(note_rows) >= SQLITE_BATCH_SIZE:
+                        cursor.executemany(NOTE_INSERT_SQL, note_rows)
+                        cursor.executemany(CARD_INSERT_SQL, card_rows)
+                        note_rows.clear()
+                        card_rows.clear()
+            
+            if note_rows:
+                cursor.executemany(NOTE_INSERT_SQL, note_rows)
+                cursor.executemany(CARD_INSERT_SQL, card_rows)
+            
+            if styles:
+                rebuild_model_css(cursor, styles)
+            conn.commit()
+        finally:
+            conn.close()
+        
+        with timed_stage(timer, 'zip'):
+            return write_apkg_zip(output_path, db_path, media_files, progress)
+
+class NoteCache:
+    """Per-deck cache of built note rows, used for incremental regeneration
+    
+    The cache is a previously built collection (<key>.anki2) plus an index
+    (<key>.notes.sqlite) mapping each card's source key to the hash of the
+    input that produced it. Unchanged cards are left untouched, changed ones
+    are rebuilt in place and cards that disappeared are deleted, so the work
+    done is proportional to what changed rather than to the deck size.
+    """
+    
+    def __init__(self, cache_dir, cache_key):
+        os.makedirs(cache_dir, exist_ok=True)
+        safe_key = re.sub(r'[^A-Za-z0-9_.-]', '_', str(cache_key))
+        base_path = os.path.join(cache_dir, safe_key)
+        self.db_path = base_path + '.anki2'
+        self.index_path = base_path + NOTE_CACHE_INDEX_SUFFIX
+        self.lock_path = base_path + '.lock'
+    
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold an exclusive lock so concurrent runs for one deck don't interleave"""
+        with open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def usage(self):
+        """(bytes, last modified time) of the cache files, or None if there are none"""
+        sizes, mtimes = [], []
+        for path in (self.db_path, self.index_path):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            sizes.append(stat.st_size)
+            mtimes.append(stat.st_mtime)
+        return (sum(sizes), max(mtimes)) if sizes else None
+    
+    def remove_if_idle(self):
+        """Delete the cache unless a build holds its lock; True if it was deleted"""
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            for path in (self.db_path, self.index_path, self.lock_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            return True
+    
+    def open(self, deck_id, deck_name, timestamp):
+        """Open (or create) the cached collection with the index attached"""
+        fresh = not (os.path.exists(self.db_path) and os.path.exists(self.index_path))
+        if fresh:
+            for path in (self.db_path, self.index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('ATTACH DATABASE ? AS cache', (self.index_path,))
+        cursor = conn.cursor()
+        
+        if fresh:
+            init_collection(cursor, deck_id, deck_name, timestamp)
+            cursor.executescript(NOTE_CACHE_SCHEMA)
+            cursor.execute('INSERT INTO cache.meta VALUES (?, ?)', ('version', str(NOTE_CACHE_VERSION)))
+        else:
+            version = cursor.execute("SELECT value FROM cache.meta WHERE key = 'version'").fetchone()
+            if not version or version[0] != str(NOTE_CACHE_VERSION):
+                logger.info("Note cache was built by another generator version, discarding it")
+                # The index schema may have changed too, so it is recreated
+                cursor.executescript('DELETE FROM notes; DELETE FROM cards; '
+                                     'DROP TABLE cache.note_cache; DROP TABLE cache.meta;')
+                cursor.executescript(NOTE_CACHE_SCHEMA)
+                cursor.execute('INSERT INTO cache.meta VALUES (?, ?)', ('version', str(NOTE_CACHE_VERSION)))
+            
+            update_collection_metadata(cursor, deck_id, deck_name, timestamp)
+            cursor.execute('UPDATE cards SET did = ? WHERE did != ?', (deck_id, deck_id))
+        
+        conn.commit()
+        return conn
+
+def prune_note_caches(cache_dir, keep, max_bytes=NOTE_CACHE_MAX_BYTES, max_age_seconds=NOTE_CACHE_MAX_AGE_SECONDS,
+                      now=None):
+    """Delete other decks' note caches unused for max_age_seconds, then the least recently used while over max_bytes
+    
+    keep is the NoteCache just written; it counts toward max_bytes but is never
+    deleted. Caches locked by a running build are skipped. Returns how many
+    caches were deleted.
+    """
+    now = now or time.time()
+    total_bytes = 0
+    caches = []
+    with os.scandir(cache_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(NOTE_CACHE_INDEX_SUFFIX):
+                continue
+            cache = NoteCache(cache_dir, entry.name[:-len(NOTE_CACHE_INDEX_SUFFIX)])
+            usage = cache.usage()
+            if usage is None:
+                continue
+            total_bytes += usage[0]
+            if cache.db_path != keep.db_path:
+                caches.append((usage[1], usage[0], cache))
+    
+    evicted = 0
+    for used_at, size, cache in sorted(caches, key=lambda item: item[0]):
+        expired = max_age_seconds and now - used_at > max_age_seconds
+        if not expired and not (max_bytes and total_bytes > max_bytes):
+            break
+        if cache.remove_if_idle():
+            total_bytes -= size
+            evicted += 1
+    
+    if evicted:
+        logger.info(f"Evicted {evicted} note caches from {cache_dir}")
+    return evicted
+
+def card_input_hash(card, media_signature):
+    """Hash of everything that determines a card's built note"""
+    payload = json.dumps(card.to_dict(), sort_keys=True, ensure_ascii=False)
+    digest = hashlib.sha1(f'{NOTE_CACHE_VERSION}\0{media_signature}\0{payload}'.encode('utf-8'))
+    return digest.hexdigest()
+
+def write_package_incremental(deck_id, deck_name, cards_data, stats, rewriter, output_path, note_cache, timer=None,
+                              progress=None, compactor=None):
+    """Update the deck's cached collection with only the changed cards, then zip it
+    
+    The index keeps the source paths of the media each note references, so
+    a reused note's files are packaged without rewriting its fields again. A
+    note whose files are gone, or now go by another media name, is rebuilt.
+    """
+    media = rewriter.media
+    timestamp = time.time()
+    mod = int(timestamp)
+    cache_stats = {'reused': 0, 'rebuilt': 0, 'added': 0, 'removed': 0}
+    # Renamed media changes field contents, so it's part of every card's hash
+    media_signature = hashlib.sha1(json.dumps(sorted(media.renames.items())).encode('utf-8')).hexdigest()
+    
+    with note_cache.locked():
+        conn = note_cache.open(deck_id, deck_name, timestamp)
+        try:
+            cursor = conn.cursor()
+            cached = {key: (input_hash, note_id, kind, media_paths) for key, input_hash, note_id, kind, media_paths
+                      in cursor.execute('SELECT source_key, input_hash, note_id, kind, media FROM cache.note_cache')}
+            
+            def reuse_media(media_paths):
+                """Package a reused note's media; False if its fields would no longer match"""
+                for path in json.loads(media_paths):
+                    name = media.add(path)
+                    if name is None or media.renames.get(name, name) != os.path.basename(path):
+                        return False
+                return True
+            
+            # New ids must not collide with rows kept from earlier builds
+            max_id = cursor.execute('SELECT MAX(m) FROM (SELECT MAX(id) AS m FROM notes UNION ALL SELECT MAX(id) FROM cards)').fetchone()[0]
+            id_gen = itertools.count(max(int(timestamp * 1000), (max_id or 0) + 1))
+            
+            seen = set()
+            note_inserts, note_updates, card_inserts, stale_note_ids, index_rows = [], [], [], [], []
+            
+            def flush():
+                cursor.executemany('DELETE FROM cards WHERE nid = ?', stale_note_ids)
+                cursor.executemany(NOTE_INSERT_SQL, note_inserts)
+                cursor.executemany(NOTE_UPDATE_SQL, note_updates)
+                cursor.executemany(CARD_INSERT_SQL, card_inserts)
+                cursor.executemany('INSERT OR REPLACE INTO cache.note_cache VALUES (?, ?, ?, ?, ?)', index_rows)
+                for rows in (note_inserts, note_updates, card_inserts, stale_note_ids, index_rows):
+                    rows.clear()
+            
+            for card in cards_data:
+                input_hash = card_input_hash(card, media_signature)
+                source_key = card.source_key or f'content:{input_hash}'
+                if source_key in seen:
+                    logger.warning(f"Duplicate card source key {source_key}, keying by content instead")
+                    source_key = f'content:{input_hash}'
+                    if source_key in seen:
+                        continue
+                seen.add(source_key)
+                
+                previous = cached.get(source_key)
+                if previous and previous[0] == input_hash and reuse_media(previous[3]):
+                    stats[previous[2]] += 1
+                    cache_stats['reused'] += 1
+                    continue
+                
+                try:
+                    with timed_stage(timer, 'build'):
+                        kind, model, fields, tags = build_note(card)
+                        fields = rewrite_fields(rewriter, card, fields)
+                        media_paths = sorted(filter(None, map(media.path_for, rewriter.note_media)))
+                        guid = note_guid(card, fields)
+                        styles = []
+                        if compactor is not None:
+                            fields = compactor.compact(model, fields)
+                            styles = compactor.note_styles
+                except Exception as e:
+                    logger.error(f"Error processing card: {str(e)}")
+                    stats['error'] += 1
+                    # Drop whatever the cache held for this card
+                    seen.discard(source_key)
+                    continue
+                
+                stats[kind] += 1
+                if previous:
+                    note_id = previous[1]
+                    row = note_row(note_id, model, fields, tags, guid, mod, note_styles_data(styles))
+                    # Reorder to match NOTE_UPDATE_SQL: columns first, id last
+                    note_updates.append(row[1:] + (note_id,))
+                    stale_note_ids.append((note_id,))
+                    cache_stats['rebuilt'] += 1
+                else:
+                    note_id = next(id_gen)
+                    note_inserts.append(note_row(note_id, model, fields, tags, guid, mod, note_styles_data(styles)))
+                    cache_stats['added'] += 1
+                
+                card_inserts.extend(card_rows_for(note_id, deck_id, model, fields, mod, id_gen))
+                index_rows.append((source_key, input_hash, note_id, kind, json.dumps(media_paths)))
+                
+                if len(index_rows) >= SQLITE_BATCH_SIZE:
+                    flush()
+            
+            flush()
+            
+            # Cards that no longer exist in the source are removed from the deck
+            removed = [(cached[key][1],) for key in cached.keys() - seen]
+            if removed:
+                cursor.executemany('DELETE FROM cards WHERE nid = ?', removed)
+                cursor.executemany('DELETE FROM notes WHERE id = ?', removed)
+                cursor.executemany('DELETE FROM cache.note_cache WHERE note_id = ?', removed)
+            cache_stats['removed'] = len(removed)
+            
+            # Reused notes rely on styles hoisted by earlier runs, which update_collection_metadata kept
+            rebuild_model_css(cursor, compactor.styles if compactor is not None else {})
+            conn.commit()
+        finally:
+            conn.close()
+        
+        stats['cache'] = cache_stats
+        with timed_stage(timer, 'zip'):
+            return write_apkg_zip(output_path, note_cache.db_path, media.files, progress)
+
+def note_signature(model_id, tags, flds, data):
+    """Compact digest used to tell whether an existing note's content changed"""
+    return hashlib.blake2b(f'{model_id}\0{tags}\0{flds}\0{data}'.encode('utf-8'), digest_size=8).digest()
+
+def file_crc32(path):
+    """CRC-32 of a file, comparable with a zip member's CRC"""
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(ZIP_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+def copy_zip_member(inzip, outzip, zinfo, progress=None):
+    """Stream an existing member into a new archive, keeping its compression method"""
+    start = time.perf_counter()
+    new_info = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+    new_info.compress_type = zinfo.compress_type
+    new_info.external_attr = zinfo.external_attr
+    new_info.file_size = zinfo.file_size
+    
+    with inzip.open(zinfo) as src, outzip.open(new_info, 'w') as dest:
+        copy_in_chunks(src, dest, progress)
+    
+    return {
+        'name': zinfo.filename,
+        'method': 'copy',
+        'bytes': new_info.file_size,
+        'compressedBytes': new_info.compress_size,
+        'seconds': round(time.perf_counter() - start, 6),
+    }
+
+def append_to_package(base_path, deck_id, deck_name, notes, media, output_path, stats, timer=None, progress=None,
+                      compactor=None):
+    """Merge notes and media into a previously generated package
+    
+    Notes are matched by GUID: new ones are added, changed ones updated in
+    place and the rest of the collection is left alone. Media already in the
+    package is copied across unchanged; only new or modified files are added.
+    """
+    start = time.perf_counter()
+    timestamp = time.time()
+    mod = int(timestamp)
+    append_stats = {'added': 0, 'updated': 0, 'unchanged': 0,
+                    'mediaAdded': 0, 'mediaReplaced': 0, 'mediaKept': 0}
+    
+    with zipfile.ZipFile(base_path) as base_zip, temp_collection_path() as db_path:
+        with base_zip.open('collection.anki2') as src, open(db_path, 'wb') as dest:
+            shutil.copyfileobj(src, dest, ZIP_CHUNK_SIZE)
+        base_media = json.loads(base_zip.read('media') or b'{}')
+        
+        conn = sqlite3.connect(db_path)
+        try:
+            for pragma in SQLITE_BUILD_PRAGMAS:
+                conn.execute(pragma)
+            cursor = conn.cursor()
+            
+            # Regenerated decks get a new name (and ID) each day; keep merged cards in the package's own deck
+            decks = json.loads(cursor.execute('SELECT decks FROM col').fetchone()[0])
+            if str(deck_id) not in decks:
+                own_decks = [int(did) for did in decks if did != '1']
+                if own_decks:
+                    logger.info(f"Appending into existing deck {own_decks[0]} instead of {deck_id}")
+                    deck_id = own_decks[0]
+                    deck_name = decks[str(deck_id)]['name']
+            update_collection_metadata(cursor, deck_id, deck_name, timestamp)
+            
+            existing = {guid: (note_id, note_signature(mid, tags, flds, data)) for note_id, guid, mid, tags, flds, data
+                        in cursor.execute('SELECT id, guid, mid, tags, flds, data FROM notes')}
+            max_id = cursor.execute('SELECT MAX(m) FROM (SELECT MAX(id) AS m FROM notes UNION ALL SELECT MAX(id) FROM cards)').fetchone()[0]
+            id_gen = itertools.count(max(int(timestamp * 1000), (max_id or 0) + 1))
+            
+            note_inserts, note_updates, card_inserts, stale_note_ids = [], [], [], []
+            
+            def flush():
+                cursor.executemany('DELETE FROM cards WHERE nid = ?', stale_note_ids)
+                cursor.executemany(NOTE_INSERT_SQL, note_inserts)
+                cursor.executemany(NOTE_UPDATE_SQL, note_updates)
+                cursor.executemany(CARD_INSERT_SQL, card_inserts)
+                for rows in (note_inserts, note_updates, card_inserts, stale_note_ids):
+                    rows.clear()
+            
+            for model, fields, tags, guid, data in notes:
+                previous = existing.get(guid)
+                if previous:
+                    note_id = previous[0]
+                    row = note_row(note_id, model, fields, tags, guid, mod, data)
+                    signature = note_signature(row[2], row[5], row[6], row[10])
+                    if signature == previous[1]:
+                        append_stats['unchanged'] += 1
+                        continue
+                    note_updates.append(row[1:] + (note_id,))
+                    stale_note_ids.append((note_id,))
+                    append_stats['updated'] += 1
+                else:
+                    note_id = next(id_gen)
+                    row = note_row(note_id, model, fields, tags, guid, mod, data)
+                    note_inserts.append(row)
+                    append_stats['added'] += 1
+                
+                existing[guid] = (note_id, note_signature(row[2], row[5], row[6], row[10]))
+                card_inserts.extend(card_rows_for(note_id, deck_id, model, fields, mod, id_gen))
+                
+                if len(note_inserts) + len(note_updates) >= SQLITE_BATCH_SIZE:
+                    flush()
+            
+            flush()
+            rebuild_model_css(cursor, compactor.styles if compactor is not None else {})
+            conn.commit()
+        finally:
+            conn.close()
+        
+        # Work out which media members survive and which files are new or changed
+        index_by_name = {name: idx for idx, name in base_media.items()}
+        replaced = {}
+        additions = []
+        next_index = max((int(idx) for idx in base_media), default=-1) + 1
+        for path in media.files:
+            name = os.path.basename(path)
+            idx = index_by_name.get(name)
+            if idx is None:
+                additions.append((str(next_index), path))
+                base_media[str(next_index)] = name
+                next_index += 1
+                append_stats['mediaAdded'] += 1
+            elif base_zip.getinfo(idx).CRC != file_crc32(path):
+                replaced[idx] = path
+                append_stats['mediaReplaced'] += 1
+        
+        members = []
+        if progress is not None:
+            progress.set_stage('zip')
+        with timed_stage(timer, 'zip'), zipfile.ZipFile(output_path, 'w', compresslevel=ZIP_COMPRESS_LEVEL) as outzip:
+            members.append(zip_file_member(outzip, db_path, 'collection.anki2', zipfile.ZIP_DEFLATED,
+                                           label='collection.anki2', progress=progress))
+            outzip.writestr('media', json.dumps(base_media), compress_type=zipfile.ZIP_DEFLATED)
+            
+            for zinfo in base_zip.infolist():
+                if zinfo.filename in ('collection.anki2', 'media'):
+                    continue
+                if zinfo.filename in replaced:
+                    path = replaced[zinfo.filename]
+                    members.append(zip_file_member(outzip, path, zinfo.filename, zip_compression_for(path),
+                                                   progress=progress))
+                else:
+                    members.append(copy_zip_member(base_zip, outzip, zinfo, progress))
+                    append_stats['mediaKept'] += 1
+            
+            for idx, path in additions:
+                members.append(zip_file_member(outzip, path, idx, zip_compression_for(path), progress=progress))
+    
+    stats['append'] = append_stats
+    return {
+        'seconds': round(time.perf_counter() - start, 6),
+        'bytes': os.path.getsize(output_path),
+        'members': members,
+    }
+
+def flat_media_path(output_path):
+    """Side archive holding the media of a flat-file export"""
+    return f"{os.path.splitext(output_path)[0]}.media.zip"
+
+def write_decks_flat(decks, media_files, output_path, flat_format='tsv', timer=None, progress=None):
+    """Stream (deck_id, deck_name, notes) as a text file Anki can import, one row per note
+    
+    The header lines tell Anki's importer the separator and which columns
+    hold the GUID, note type, deck and tags; the two fields in between match
+    the Cloze (Text, Extra) and Basic (Front, Back) models. Notes are written
+    as they are built, so memory stays flat however large the deck. Media
+    goes into a side zip (see flat_media_path) to extract into Anki's
+    collection.media folder; the report's 'mediaPath' is None without media.
+    
+    Every field is quoted: Anki's importer skips any row starting with "#"
+    as a comment, and a base91 GUID in the first column can start with one.
+    """
+    separator, separator_name = FLAT_FORMATS[flat_format]
+    rows = 0
+    
+    with open(output_path, 'w', encoding='utf-8', newline='') as f:
+        f.write(f'#separator:{separator_name}\n{FLAT_HEADER}')
+        writer = csv.writer(f, delimiter=separator, lineterminator='\n', quoting=csv.QUOTE_ALL)
+        for deck_id, deck_name, notes in decks:
+            for model, fields, tags, guid, _ in notes:
+                writer.writerow((guid, model.name, deck_name, *fields, ' '.join(tags)))
+                rows += 1
+    
+    start = time.perf_counter()
+    members = []
+    media_path = None
+    if media_files:
+        media_path = flat_media_path(output_path)
+        if progress is not None:
+            progress.set_stage('zip')
+        with timed_stage(timer, 'zip'), zipfile.ZipFile(media_path, 'w', compresslevel=ZIP_COMPRESS_LEVEL) as outzip:
+            for path in media_files:
+                members.append(zip_file_member(outzip, path, os.path.basename(path), zip_compression_for(path),
+                                               progress=progress))
+    
+    return {
+        'seconds': round(time.perf_counter() - start, 6),
+        'bytes': os.path.getsize(media_path) if media_path else 0,
+        'members': members,
+        'rows': rows,
+        'textBytes': os.path.getsize(output_path),
+        'mediaPath': media_path,
+    }
+
+def write_package_flat(deck_id, deck_name, notes, media_files, output_path, timer=None, progress=None,
+                       compactor=None, flat_format='tsv'):
+    """Write the deck as a flat text file plus media zip instead of an .apkg"""
+    return write_decks_flat([(deck_id, deck_name, notes)], media_files, output_path, flat_format=flat_format,
+                            timer=timer, progress=progress)
+
+PACKAGE_BACKENDS = {
+    'genanki': write_package_genanki,
+    'sqlite': write_package_sqlite,
+    **{name: functools.partial(write_package_flat, flat_format=name) for name in FLAT_FORMATS},
+}
+
+def deck_id_for(deck_name):
+    """Deck ID derived from the name, matching the one anki_bridge.js assigns"""
+    return int(hashlib.md5(deck_name.encode('utf-8')).hexdigest()[:8], 16) % 2147483647
+
+def group_batch_cards(specs, cards_data, stats):
+    """Per-deck card lists for a batch export
+    
+    Cards are given inline in each deck spec or in the top-level card stream
+    tagged with the index of their deck; cards with no valid index count as errors.
+    """
+    groups = [list(iter_cards(spec.get('cards', []), stats)) for spec in specs]
+    for card in cards_data:
+        deck_index = card.deck if card.deck is not None else 0
+        if not isinstance(deck_index, int) or not 0 <= deck_index < len(groups):
+            logger.error(f"Card refers to unknown deck {deck_index!r}")
+            stats['error'] += 1
+            continue
+        groups[deck_index].append(card)
+    return groups
+
+def build_deck_notes(cards, media, media_folder, compact, keep_styles=False, names=None):
+    """Build one deck's notes; runs in a pool process during batch exports
+    
+    Models are returned by ID, since only plain data crosses the process
+    boundary. names maps every media reference the cards make to the media
+    name the parent resolved for it, so fields are rewritten to names that
+    are in the package whichever process builds the deck.
+    """
+    stats = {'cloze': 0, 'standard': 0, 'error': 0}
+    rewriter = FieldRewriter(media, media_folder, names)
+    compactor = field_compactor(compact, keep_styles)
+    notes = [(model.model_id, fields, tags, guid, data)
+             for model, fields, tags, guid, data in iter_built_notes(cards, stats, rewriter, compactor)]
+    stats['rewrite'] = rewriter.stats
+    if compactor is None:
+        return notes, stats, {}, None
+    return notes, stats, compactor.styles, compactor.stats
+
+def write_batch_package(data, cards_data, output_path, media_folder, stats, timer, progress,
+                        compact=True, jobs=None, backend='sqlite'):
+    """Write several decks (or Section::Page subdecks) into one package
+    
+    data['decks'] lists the deck specs. Media from every deck is pooled into
+    one deduplicated store, each deck's notes are built in parallel across a
+    process pool, and the collection is then written in a single pass
+    (or, with a flat backend, as one text file with a deck column).
+    Returns the zip report and the MediaStore holding the package's media.
+    """
+    specs = data['decks']
+    if not specs:
+        raise ValueError("Batch export needs at least one deck")
+    decks = [(spec.get('deckId') or deck_id_for(spec['deckName']), spec['deckName']) for spec in specs]
+    
+    progress.set_stage('media')
+    with timer.stage('media'):
+        images = itertools.chain(data.get('images', []), *(spec.get('images', []) for spec in specs))
+        media = media_store(images, media_folder, progress)
+    stats['media'] = media.stats
+    
+    groups = group_batch_cards(specs, cards_data, stats)
+    flat = backend in FLAT_FORMATS
+    
+    # Files the fields reference are resolved here, against the one content-addressed store,
+    # before any deck is built; workers deduplicating on their own could pick names that
+    # another deck's copy of the same file replaced in the package
+    with timer.stage('media'):
+        scan = FieldRewriter(media, media_folder)
+        missing = []
+        for cards in groups:
+            before = scan.stats['missingReferences']
+            for card in cards:
+                scan.register(card)
+            missing.append(scan.stats['missingReferences'] - before)
+        names = scan.resolved_names()
+    total_cards = sum(len(cards) for cards in groups)
+    jobs = min(jobs or os.cpu_count() or 1, len(groups))
+    
+    progress.set_stage('notes')
+    with timer.stage('build'), progress.heartbeat():
+        if jobs > 1 and total_cards >= BATCH_POOL_MIN_CARDS:
+            executor = ProcessPoolExecutor(max_workers=jobs)
+            results = executor.map(build_deck_notes, groups, itertools.repeat(media), itertools.repeat(media_folder),
+                                   itertools.repeat(compact), itertools.repeat(flat), itertools.repeat(names))
+        else:
+            executor = None
+            results = (build_deck_notes(cards, media, media_folder, compact, flat, names) for cards in groups)
+        
+        try:
+            built = []
+            for deck_notes, deck_stats, deck_styles, deck_compaction in results:
+                built.append((deck_notes, deck_stats, deck_styles, deck_compaction))
+                progress.add('notesBuilt', len(deck_notes))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    
+    styles = {}
+    compaction = {'bytesBefore': 0, 'bytesAfter': 0, 'styleBlocksHoisted': 0, 'sharedStyles': 0}
+    rewrite = {'references': 0, 'missingReferences': 0, 'unsafeRemoved': 0}
+    stats['decks'] = []
+    for (deck_id, deck_name), (deck_notes, deck_stats, deck_styles, deck_compaction), deck_missing in zip(
+            decks, built, missing):
+        # Missing files were found (and logged) by the parent's scan
+        deck_stats['rewrite']['missingReferences'] = deck_missing
+        for key in ('cloze', 'standard', 'error'):
+            stats[key] += deck_stats[key]
+        for key in rewrite:
+            rewrite[key] += deck_stats['rewrite'][key]
+        stats['decks'].append({'deckName': deck_name, 'deckId': deck_id, **deck_stats})
+        for model_id, blocks in deck_styles.items():
+            merged = styles.setdefault(model_id, [])
+            merged.extend(block for block in blocks if block not in merged)
+        if deck_compaction:
+            for key in compaction:
+                compaction[key] += deck_compaction[key]
+    if compact:
+        # Decks are compacted independently, so a block shared by several decks counts once per deck
+        stats['compaction'] = compaction
+    stats['rewrite'] = rewrite
+    
+    deck_notes = [(deck_id, deck_name, ((MODELS_BY_ID[model_id], fields, tags, guid, data)
+                                        for model_id, fields, tags, guid, data in notes))
+                  for (deck_id, deck_name), (notes, _, _, _) in zip(decks, built)]
+    with timer.stage('sqlite'):
+        if flat:
+            return write_decks_flat(deck_notes, media.files, output_path, flat_format=backend,
+                                    timer=timer, progress=progress), media
+        return write_decks_sqlite(deck_notes, media.files, output_path, timer=timer, progress=progress,
+                                  styles=styles), media
+
+# Near-duplicate detection: MinHash signatures over word shingles, bucketed with LSH
+MINHASH_PERMUTATIONS = 64
+SHINGLE_SIZE = 2
+# Dropped cards listed individually in stats; the count covers all of them
+DEDUPE_REPORT_LIMIT = 100
+# Each shingle is hashed once into MINHASH_PERMUTATIONS independent 32-bit values
+MINHASH_STRUCT = struct.Struct(f'<{MINHASH_PERMUTATIONS}I')
+CLOZE_MARKUP_RE = re.compile(r"{{c\d+::(.*?)(?:::[^}]*)?}}", re.DOTALL)
+WORD_RE = re.compile(r'\w+')
+
+def normalized_words(text):
+    return WORD_RE.findall(html.unescape(HTML_TAG_RE.sub(' ', text)).lower())
+
+def card_words(card):
+    """Normalized words of a card's prompt: cloze text, or question plus answer"""
+    if card.type == 'cloze':
+        text = card.text
+    else:
+        text = f"{card.question} {card.answer}"
+    text = CLOZE_MARKUP_RE.sub(r'\1', text)
+    return normalized_words(text)
+
+def cloze_deletions(card):
+    """Normalized text of each cloze deletion, or () for a basic card
+    
+    Cloze cards blanking different terms of the same sentence test different
+    facts, so only cards with the same deletions may be merged.
+    """
+    if card.type != 'cloze':
+        return ()
+    return tuple(sorted({' '.join(normalized_words(match.group(1)))
+                         for match in CLOZE_MARKUP_RE.finditer(card.text)}))
+
+@functools.lru_cache(maxsize=1 << 16)
+def shingle_hashes(shingle):
+    """MINHASH_PERMUTATIONS independent hashes of one shingle; common shingles recur across cards"""
+    return MINHASH_STRUCT.unpack(hashlib.shake_128(shingle.encode('utf-8')).digest(MINHASH_STRUCT.size))
+
+def minhash_signature(words):
+    """MinHash signature of the card's word shingles, or None for an empty card"""
+    if len(words) >= SHINGLE_SIZE:
+        shingles = {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    else:
+        shingles = set(words)
+    if not shingles:
+        return None
+    
+    hashes = [shingle_hashes(shingle) for shingle in shingles]
+    return tuple(map(min, *hashes)) if len(hashes) > 1 else hashes[0]
+
+def lsh_bands(threshold):
+    """(bands, rows) splitting the signature so pairs near threshold similarity become candidates
+    
+    Picks the split whose S-curve midpoint (1/bands)^(1/rows) is closest below
+    the threshold, favouring recall; candidates are then checked against it.
+    """
+    splits = [(bands, MINHASH_PERMUTATIONS // bands) for bands in range(1, MINHASH_PERMUTATIONS + 1)
+              if MINHASH_PERMUTATIONS % bands == 0]
+    below = [split for split in splits if (1 / split[0]) ** (1 / split[1]) <= threshold]
+    return max(below, key=lambda split: (1 / split[0]) ** (1 / split[1]), default=splits[-1])
+
+def dedupe_cards(cards_data, threshold, stats):
+    """Drop near-duplicate cards, keeping the first of each cluster with the cluster's tags merged in
+    
+    Cards whose estimated Jaccard similarity (over word shingles of their
+    prompt) reaches threshold are duplicates. LSH buckets keep this roughly
+    linear: each card is only compared with kept cards sharing a band. Cloze
+    and basic cards, cloze cards with different deletions, and cards of
+    different batch decks are never merged.
+    
+    A later duplicate's tags are merged into the earlier card, so the whole
+    deck is held in memory: deduping gives up the streamed card input.
+    Returns the kept cards in input order; stats['dedupe'] reports the drops.
+    """
+    bands, rows = lsh_bands(threshold)
+    kept = []
+    kept_positions = []
+    signatures = []
+    buckets = {}
+    cluster_sizes = {}
+    dropped = []
+    dropped_count = 0
+    
+    for position, card in enumerate(cards_data):
+        words = card_words(card)
+        signature = minhash_signature(words)
+        if signature is None:
+            kept.append(card)
+            kept_positions.append(position)
+            signatures.append(None)
+            continue
+        
+        group = (card.deck, card.type == 'cloze', cloze_deletions(card))
+        keys = [(group, band, hash(signature[band * rows:(band + 1) * rows])) for band in range(bands)]
+        
+        best, best_similarity = None, threshold
+        for candidate in {index for key in keys for index in buckets.get(key, ())}:
+            similarity = sum(a == b for a, b in zip(signature, signatures[candidate])) / MINHASH_PERMUTATIONS
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        
+        if best is None:
+            for key in keys:
+                buckets.setdefault(key, []).append(len(kept))
+            kept.append(card)
+            kept_positions.append(position)
+            signatures.append(signature)
+            continue
+        
+        tags = list(kept[best].tags)
+        tags += [tag for tag in card.tags if tag not in tags]
+        kept[best] = dataclasses.replace(kept[best], tags=tags)
+        cluster_sizes[best] = cluster_sizes.get(best, 1) + 1
+        
+        dropped_count += 1
+        if len(dropped) < DEDUPE_REPORT_LIMIT:
+            dropped.append({
+                'index': position,
+                'duplicateOf': kept_positions[best],
+                'similarity': round(best_similarity, 3),
+                'text': ' '.join(words)[:80],
+            })
+    
+    stats['dedupe'] = {
+        'threshold': threshold,
+        'dropped': dropped_count,
+        'clusters': len(cluster_sizes),
+        'droppedCards': dropped,
+    }
+    if dropped_count:
+        logger.info(f"Dropped {dropped_count} near-duplicate cards in {len(cluster_sizes)} clusters")
+    return kept
+
+def index_package(db_path, output_path, media_files, zip_report):
+    """Record the package's media (and a flat export's media zip) in the media index
+    
+    The images then stay on disk for as long as the package does; see
+    media_index.py. Indexing is bookkeeping, so a failure only logs a warning.
+    """
+    paths = list(media_files)
+    if zip_report and zip_report.get('mediaPath'):
+        paths.append(zip_report['mediaPath'])
+    try:
+        with open_index(db_path) as index:
+            index.record(output_path, 'package', paths)
+    except Exception as e:
+        logger.warning(f"Failed to record package in media index: {str(e)}")
+
+def create_anki_package(data, output_path, media_folder, backend='genanki', cache_dir=None, append_to=None,
+                        timer=None, profile_dir=None, progress=None, compact=True, jobs=None, dedupe=None,
+                        media_index=None):
+    """Create an Anki package from the provided data
+    
+    backend selects how the collection is written: 'genanki' (default) builds
+    genanki objects, 'sqlite' streams notes straight into the collection database.
+    'tsv' and 'csv' write a text file for Anki's importer plus a media zip
+    instead (see write_decks_flat); inline styles then stay in the fields.
+    When cache_dir is given the deck is instead regenerated incrementally from
+    its note cache there, keyed by data['cacheKey'] (or the deck ID).
+    When append_to names an existing .apkg, the cards and media are merged
+    into a copy of that package instead of building a new one. Both write the
+    collection directly, like the 'sqlite' backend, whatever backend says.
+    
+    The result's 'timings' report wall time and peak memory per stage (load,
+    build, media, sqlite, zip); pass a StageTimer to include time spent loading
+    the input beforehand. profile_dir (or ANKI_GENERATOR_PROFILE) enables
+    cProfile/tracemalloc dumps. A ProgressReporter receives live counts of
+    notes built, media added and bytes zipped.
+    
+    With compact (the default) repeated inline <style> blocks are moved into
+    the note models' CSS and field HTML is whitespace-minified; stats
+    'compaction' reports field bytes before and after.
+    
+    When data has 'decks', every deck spec goes into the one package (see
+    write_batch_package), built across up to jobs processes; the note cache
+    and append mode don't apply to batches.
+    
+    dedupe, a similarity threshold between 0 and 1, drops near-duplicate
+    cards before anything is built (see dedupe_cards); stats 'dedupe'
+    reports what was dropped. Deduping reads every card into memory first.
+    
+    Card fields go through a FieldRewriter: image references (markdown or
+    <img>) are pointed at their media names, files they name are packaged
+    even when not listed in data['images'], and script-like markup is
+    stripped; stats 'rewrite' counts references, missing files and removals.
+    
+    media_index, a path to the media index database, records the package
+    as the owner of the media files it was built from (see media_index.py).
+    """
+    timer = timer or StageTimer()
+    progress = progress or ProgressReporter()
+    profile_dir = profile_dir or os.environ.get('ANKI_GENERATOR_PROFILE')
+    
+    try:
+        if backend not in PACKAGE_BACKENDS:
+            raise ValueError(f"Unknown package backend: {backend}")
+        if backend in FLAT_FORMATS and (cache_dir or append_to):
+            raise ValueError("The note cache and append mode only apply to .apkg output")
         
         # Statistics tracking
         stats = {
@@ -89,88 +2043,83 @@ def create_anki_package(data, output_path, media_folder):
             'error': 0
         }
         
-        # Process each card
-        for card in cards_data:
-            try:
-                card_type = card.get('type', 'standard')
-                tags = card.get('tags', [])
-                
-                # Convert tags to string array if needed
-                if isinstance(tags, str):
-                    tags = [t.strip() for t in tags.split() if t.strip()]
-                
-                # Handle cloze cards
-                if card_type == 'cloze':
-                    cloze_text = card.get('text', '')
-                    extra_text = card.get('notes', '')
-                    
-                    # Ensure the cloze text has at least one cloze marker
-                    if '{{c' not in cloze_text:
-                        # Try to find meaningful words to create a cloze
-                        words = cloze_text.split()
-                        for i, word in enumerate(words):
-                            if len(word) > 5 and word.isalpha() and word.lower() not in ['about', 'there', 'their', 'would', 'could', 'should']:
-                                cloze_text = cloze_text.replace(word, f"{{{{c1::{word}}}}}", 1)
-                                break
-                    
-                    # Create and add the note
-                    note = genanki.Note(
-                        model=cloze_model,
-                        fields=[cloze_text, extra_text],
-                        tags=tags
-                    )
-                    deck.add_note(note)
-                    stats['cloze'] += 1
-                
-                # Handle standard Q&A cards
-                else:
-                    front = card.get('question', '')
-                    back = card.get('answer', '')
-                    
-                    # Add notes if available
-                    if card.get('notes'):
-                        back += f"<hr>{card['notes']}"
-                    
-                    note = genanki.Note(
-                        model=basic_model,
-                        fields=[front, back],
-                        tags=tags
-                    )
-                    deck.add_note(note)
-                    stats['standard'] += 1
-            
-            except Exception as e:
-                logger.error(f"Error processing card: {str(e)}")
-                stats['error'] += 1
-                continue
+        # Extract components from data; cards may be dicts or Cards, in a list or a lazy iterator
+        deck_name = data.get('deckName', 'OneNote Converted Deck')
+        cards_data = iter_cards(timer.timed_iter('load', data.get('cards', [])), stats)
+        images = [ImageRef.coerce(image) for image in data.get('images', [])]
+        
+        # Create deck with consistent ID generation based on name
+        # This helps if the user regenerates the same deck
+        deck_id = random.randrange(1 << 30, 1 << 31)
+        if 'deckId' in data:
+            # Use provided ID if available
+            deck_id = data['deckId']
         
-        # Create package and add any media files
-        package = genanki.Package(deck)
-        media_files = []
+        if dedupe:
+            progress.set_stage('dedupe')
+            with timer.stage('dedupe'), progress.heartbeat():
+                cards_data = dedupe_cards(cards_data, dedupe, stats)
         
-        # Process images
-        for image in images:
-            source_path = os.path.join(media_folder, os.path.basename(image['path']))
-            if os.path.exists(source_path):
-                media_files.append(source_path)
+        with profiling(profile_dir, deck_name) as profile_outputs:
+            if 'decks' in data:
+                if cache_dir or append_to:
+                    raise ValueError("The note cache and append mode don't apply to batch exports")
+                zip_report, media = write_batch_package(data, cards_data, output_path, media_folder, stats,
+                                                        timer, progress, compact=compact, jobs=jobs,
+                                                        backend=backend if backend in FLAT_FORMATS else 'sqlite')
             else:
-                logger.warning(f"Image file not found: {source_path}")
-        
-        # Add media files to package
-        if media_files:
-            package.media_files = media_files
+                # Process images, storing identical files only once
+                progress.set_stage('media')
+                with timer.stage('media'):
+                    media = media_store(images, media_folder, progress)
+                stats['media'] = media.stats
+                rewriter, compactor = note_builders(media, media_folder, compact, stats,
+                                                    keep_styles=backend in FLAT_FORMATS)
+                
+                # Build and save the package; whatever isn't load, build or zip is collection writing
+                notes = progress.track('notesBuilt', timer.timed_iter('build', iter_built_notes(cards_data, stats, rewriter, compactor)))
+                progress.set_stage('notes')
+                with timer.stage('sqlite'):
+                    if append_to:
+                        zip_report = append_to_package(append_to, deck_id, deck_name, notes, media, output_path, stats,
+                                                       timer=timer, progress=progress, compactor=compactor)
+                    elif cache_dir:
+                        note_cache = NoteCache(cache_dir, data.get('cacheKey') or deck_id)
+                        zip_report = write_package_incremental(deck_id, deck_name, progress.track('notesBuilt', cards_data),
+                                                               stats, rewriter, output_path, note_cache,
+                                                               timer=timer, progress=progress, compactor=compactor)
+                        # Housekeeping only; a failure here doesn't fail the package
+                        try:
+                            stats['cache']['evicted'] = prune_note_caches(cache_dir, note_cache)
+                        except OSError as e:
+                            logger.warning(f"Failed to evict note caches: {str(e)}")
+                    else:
+                        zip_report = PACKAGE_BACKENDS[backend](deck_id, deck_name, notes, media.files, output_path,
+                                                               timer=timer, progress=progress, compactor=compactor)
+            progress.set_stage('done')
         
-        # Save the package
-        package.write_to_file(output_path)
+        if media_index:
+            index_package(media_index, output_path, media.files, zip_report)
         
-        logger.info(f"Successfully created Anki package at {output_path}")
+        writer = backend
+        if append_to or cache_dir:
+            writer = 'append' if append_to else 'incremental'
+        elif 'decks' in data and backend not in FLAT_FORMATS:
+            writer = 'sqlite'
+        logger.info(f"Successfully created Anki package at {output_path} ({writer} writer)")
         logger.info(f"Card statistics: {stats}")
         
-        return {
+        result = {
             'success': True,
             'stats': stats,
-            'path': output_path
+            'zip': zip_report,
+            'timings': timer.report(),
+            'path': output_path,
+            'mediaSources': media.source_paths()
         }
+        if profile_outputs:
+            result['profile'] = profile_outputs
+        return result
     
     except Exception as e:
         logger.error(f"Error creating Anki package: {str(e)}")
@@ -179,29 +2128,258 @@ def create_anki_package(data, output_path, media_folder):
             'error': str(e)
         }
 
+@dataclass(slots=True)
+class PackageResult:
+    """Outcome of a build; to_dict() is the JSON the CLI and worker report"""
+    success: bool
+    path: str | None = None
+    stats: dict | None = None
+    zip: dict | None = None
+    timings: dict | None = None
+    profile: dict | None = None
+    error: str | None = None
+    # Every media path the build looked up (see MediaStore.source_paths)
+    media_sources: list | None = None
+    
+    @classmethod
+    def from_dict(cls, result):
+        fields = {name: result.get(name) for name in cls.__dataclass_fields__}
+        fields['media_sources'] = result.get('mediaSources')
+        return cls(**fields)
+    
+    def to_dict(self):
+        if not self.success:
+            return {'success': False, 'error': self.error}
+        result = {'success': True, 'stats': self.stats, 'zip': self.zip, 'timings': self.timings, 'path': self.path,
+                  'mediaSources': self.media_sources}
+        if self.profile:
+            result['profile'] = self.profile
+        return result
+
+class DeckBuilder:
+    """In-process entry point: collect cards and images, then build a package
+    
+    Cards may be Cards or JSON-style dicts, added from any iterable.
+    Iterables are only consumed by build(), so a builder fed generators
+    builds once. Each add_deck() call adds a subdeck and turns the build
+    into a batch export (see write_batch_package).
+    """
+    
+    def __init__(self, deck_name='OneNote Converted Deck', deck_id=None, media_folder='.', cache_key=None):
+        self.deck_name = deck_name
+        self.deck_id = deck_id
+        self.media_folder = media_folder
+        self.cache_key = cache_key
+        self._cards = []
+        self._images = []
+        self._decks = None
+    
+    @classmethod
+    def from_data(cls, data, media_folder):
+        """Builder for deck data in the JSON/NDJSON input format (see process_input_data)"""
+        builder = cls(data.get('deckName', 'OneNote Converted Deck'), data.get('deckId'),
+                      media_folder, data.get('cacheKey'))
+        builder.add_cards(data.get('cards', []))
+        builder.add_images(data.get('images', []))
+        if 'decks' in data:
+            builder._decks = []
+            for spec in data['decks']:
+                builder.add_deck(spec['deckName'], spec.get('cards', []), spec.get('images', []), spec.get('deckId'))
+        return builder
+    
+    def add_card(self, card):
+        self._cards.append((card,))
+        return self
+    
+    def add_cards(self, cards):
+        """Queue an iterable of cards; in a batch, cards pick their deck with Card.deck"""
+        self._cards.append(cards)
+        return self
+    
+    def add_images(self, images):
+        """Add ImageRefs, paths or {'path': ...} dicts, relative to the media folder"""
+        self._images.extend(map(ImageRef.coerce, images))
+        return self
+    
+    def add_deck(self, deck_name, cards=(), images=(), deck_id=None):
+        """Add a subdeck to a batch export, returning its index for Card.deck"""
+        if self._decks is None:
+            self._decks = []
+        spec = {'deckName': deck_name, 'cards': cards, 'images': [ImageRef.coerce(image) for image in images]}
+        if deck_id is not None:
+            spec['deckId'] = deck_id
+        self._decks.append(spec)
+        return len(self._decks) - 1
+    
+    def to_data(self):
+        """The deck data create_anki_package takes, with cards as a lazy stream"""
+        data = {
+            'deckName': self.deck_name,
+            'cards': itertools.chain.from_iterable(self._cards),
+            'images': list(self._images),
+        }
+        if self.deck_id is not None:
+            data['deckId'] = self.deck_id
+        if self.cache_key is not None:
+            data['cacheKey'] = self.cache_key
+        if self._decks is not None:
+            data['decks'] = self._decks
+        return data
+    
+    def build(self, output_path, **options):
+        """Write the package to output_path; options are create_anki_package's"""
+        output_dir = os.path.dirname(output_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        return PackageResult.from_dict(create_anki_package(self.to_data(), output_path, self.media_folder, **options))
+
+def handle_worker_request(request, progress_stream=None):
+    """Handle a single framed request received in worker mode"""
+    op = request.get('op', 'generate')
+    
+    if op == 'ping':
+        return {'success': True, 'pong': True, 'pid': os.getpid()}
+    
+    if op == 'generate':
+        # Cards may be sent inline or, for large decks, via an input file
+        timer = StageTimer()
+        if 'data' in request:
+            data = request['data']
+        else:
+            with timer.stage('load'):
+                data = process_input_data(request['input'])
+        
+        output_path = request['output']
+        media_folder = request.get('mediaFolder') or os.path.dirname(output_path)
+        
+        builder = DeckBuilder.from_data(data, media_folder)
+        return builder.build(output_path,
+                             backend=request.get('backend', 'genanki'),
+                             cache_dir=request.get('cacheDir'),
+                             append_to=request.get('appendTo'),
+                             timer=timer,
+                             profile_dir=request.get('profileDir'),
+                             progress=ProgressReporter(progress_stream, request.get('id')),
+                             compact=request.get('compact', True),
+                             jobs=request.get('jobs'),
+                             dedupe=request.get('dedupe'),
+                             media_index=request.get('mediaIndex')).to_dict()
+    
+    raise ValueError(f"Unknown worker op: {op}")
+
+def run_worker(input_stream, output_stream, progress_stream=None):
+    """Serve newline-delimited JSON requests until stdin closes or a shutdown op arrives
+    
+    Progress records for a generate request carry its id, so one progress
+    stream can be shared by every request the worker serves.
+    """
+    logger.info(f"Anki generator worker started (pid {os.getpid()})")
+    
+    for line in input_stream:
+        line = line.strip()
+        if not line:
+            continue
+        
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            
+            if request.get('op') == 'shutdown':
+                response = {'success': True}
+                output_stream.write(json.dumps({'id': request_id, **response}) + '\n')
+                output_stream.flush()
+                break
+            
+            response = handle_worker_request(request, progress_stream)
+        except Exception as e:
+            logger.error(f"Error handling worker request: {str(e)}")
+            response = {'success': False, 'error': str(e)}
+        
+        # One response per line, tagged with the request id
+        output_stream.write(json.dumps({'id': request_id, **response}) + '\n')
+        output_stream.flush()
+    
+    logger.info("Anki generator worker exiting")
+
+def parse_args(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Generate an Anki package from converted OneNote cards')
+    parser.add_argument('input_json_path', nargs='?',
+                        help="input JSON or NDJSON file, or '-' to read NDJSON from stdin")
+    parser.add_argument('output_apkg_path', nargs='?', help='path of the .apkg to write')
+    parser.add_argument('media_folder', nargs='?', help='folder containing referenced images')
+    parser.add_argument('--worker', action='store_true',
+                        help='serve newline-delimited JSON requests on stdin/stdout')
+    parser.add_argument('--backend', choices=sorted(PACKAGE_BACKENDS), default='genanki',
+                        help='how the collection is written (default: genanki)')
+    parser.add_argument('--cache-dir',
+                        help='regenerate incrementally using the per-deck note cache in this folder')
+    parser.add_argument('--append-to', metavar='APKG',
+                        help='merge into this previously generated package instead of rebuilding')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='write cProfile and tracemalloc reports to this folder (or set ANKI_GENERATOR_PROFILE)')
+    parser.add_argument('--no-compact', dest='compact', action='store_false',
+                        help='keep inline <style> blocks and field whitespace as given')
+    parser.add_argument('--jobs', type=int, metavar='N',
+                        help='processes used to build the decks of a batch export (default: CPU count)')
+    parser.add_argument('--dedupe', type=float, metavar='THRESHOLD',
+                        help='drop cards at least this similar (0-1) to an earlier card, merging their tags')
+    parser.add_argument('--media-index', metavar='DB',
+                        help='record the package and the media it uses in this media index database')
+    parser.add_argument('--progress-fd', type=int, metavar='FD',
+                        help='write newline-delimited JSON progress records to this inherited file descriptor')
+    return parser.parse_args(argv)
+
 def main():
     """Main entry point for the script"""
-    if len(sys.argv) < 3:
-        logger.error("Usage: python anki_generator.py <input_json_path> <output_apkg_path> [media_folder]")
-        sys.exit(1)
+    configure_logging()
+    args = parse_args()
+    progress_stream = open_progress_stream(args.progress_fd)
     
-    input_json_path = sys.argv[1]
-    output_apkg_path = sys.argv[2]
-    media_folder = sys.argv[3] if len(sys.argv) > 3 else os.path.dirname(input_json_path)
+    if args.worker:
+        # stdout carries the response frames, so logs and stray prints go to stderr
+        response_stream = sys.stdout
+        sys.stdout = sys.stderr
+        for handler in logging.getLogger().handlers:
+            handler.setStream(sys.stderr)
+        
+        run_worker(sys.stdin, response_stream, progress_stream)
+        sys.exit(0)
+    
+    if not args.input_json_path or not args.output_apkg_path:
+        logger.error("Usage: python anki_generator.py [--backend genanki|sqlite] [--cache-dir DIR] [--append-to APKG] <input_json_path|input.ndjson|-> <output_apkg_path> [media_folder]")
+        logger.error("       python anki_generator.py --worker")
+        sys.exit(1)
     
-    # Create output directory if it doesn't exist
-    os.makedirs(os.path.dirname(output_apkg_path), exist_ok=True)
+    input_json_path = args.input_json_path
+    output_apkg_path = args.output_apkg_path
+    if args.media_folder:
+        media_folder = args.media_folder
+    elif input_json_path == '-':
+        media_folder = os.getcwd()
+    else:
+        media_folder = os.path.dirname(input_json_path)
     
     try:
         # Process data and create package
-        data = process_input_data(input_json_path)
-        result = create_anki_package(data, output_apkg_path, media_folder)
+        timer = StageTimer()
+        with timer.stage('load'):
+            data = process_input_data(input_json_path)
+        builder = DeckBuilder.from_data(data, media_folder)
+        result = builder.build(output_apkg_path,
+                               backend=args.backend, cache_dir=args.cache_dir,
+                               append_to=args.append_to, timer=timer,
+                               profile_dir=args.profile,
+                               progress=ProgressReporter(progress_stream),
+                               compact=args.compact, jobs=args.jobs, dedupe=args.dedupe,
+                               media_index=args.media_index)
         
         # Return results as JSON to stdout
-        print(json.dumps(result))
+        print(json.dumps(result.to_dict()))
         
         # Exit with success code if everything worked
-        if result['success']:
+        if result.success:
             sys.exit(0)
         else:
             sys.exit(1)
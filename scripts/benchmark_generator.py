@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""Benchmark the anki_generator.py packaging pipeline on synthetic decks
+
+Each scenario (deck size x cloze/basic mix x note style x image count x
+backend x field compaction) runs in a fresh process so peak RSS is measured per scenario.
+Stages are timed separately, each with how far it raised the process's
+peak RSS, and the results (including the generator's own per-stage
+timings) are written as JSON so runs can be compared between backends and
+releases.
+
+Example:
+    python scripts/benchmark_generator.py --sizes 100,1000,10000,100000 \
+        --notes plain,styled --images 0,20 --compact on,off --output bench_results.json
+"""
+import sys
+import os
+import json
+import time
+import random
+import platform
+import tempfile
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import anki_generator  # noqa: E402
+
+# The inline style block formatNotesForAnki in app.js wraps around every card's notes
+ANKI_NOTES_STYLE = '''<style>
+  .anki-notes {
+    font-family: Arial, sans-serif;
+    line-height: 1.5;
+    color: #333;
+    max-width: 700px;
+    margin: 0 auto;
+  }
+  .anki-notes h2, .anki-notes h3 {
+    color: #2196F3;
+    margin-top: 15px;
+  }
+  .anki-notes h2 {
+    border-bottom: 1px solid #e0e0e0;
+    padding-bottom: 5px;
+    font-size: 1.4em;
+  }
+  .anki-notes h3 {
+    font-size: 1.2em;
+    margin-bottom: 8px;
+  }
+  .anki-notes em { color: #666; }
+  .anki-notes strong {
+    color: #333;
+    font-weight: bold;
+  }
+  .anki-notes img {
+    max-width: 100%;
+    margin: 10px 0;
+    border: 1px solid #ddd;
+    border-radius: 4px;
+    padding: 5px;
+    display: block;
+  }
+  .anki-notes ul { padding-left: 20px; }
+  .anki-notes .concept-map {
+    background-color: #f9f9f9;
+    padding: 10px;
+    border-radius: 5px;
+    margin: 10px 0;
+    border-left: 3px solid #2196F3;
+  }
+  .anki-notes .relationship {
+    color: #4CAF50;
+    font-weight: bold;
+  }
+  .anki-notes hr {
+    border: 0;
+    height: 1px;
+    background: #ddd;
+    margin: 15px 0;
+  }
+</style>'''
+
+# Concept map markup in the shape of testing_akpg_package.py's examples
+CONCEPT_MAP_TEMPLATE = '''<div class="concept-map">
+<h3>Concept Map: Concept {i}</h3>
+<p>Concept {i} is a synthetic topic used for benchmarking.</p>
+<p><strong>Related Concepts:</strong></p>
+<ul>
+<li><span class="relationship"><strong>Concept {i}</strong> → <strong>Concept {j}</strong></span> (sequential)<br><em>Concept {i} happens before concept {j}</em></li>
+<li><span class="relationship"><strong>Concept {k}</strong> ← <strong>Concept {i}</strong></span> (causal)<br><em>Concept {i} leads to concept {k}</em></li>
+</ul>
+</div>'''
+
+NOTE_STYLES = ('plain', 'styled', 'conceptmap')
+
+def card_notes(i, note_style, image_name):
+    """Notes field for card i in the given style"""
+    notes = f'Explanation of key terms for card {i}.'
+    if note_style == 'conceptmap':
+        notes += '<hr>' + CONCEPT_MAP_TEMPLATE.format(i=i, j=i + 1, k=i + 2)
+    if image_name:
+        notes += f'<hr><h3>Related Images</h3>\n<img src="{image_name}" alt="Image">\n'
+    if note_style in ('styled', 'conceptmap'):
+        notes = f'<div class="anki-notes">\n{notes}\n{ANKI_NOTES_STYLE}\n</div>'
+    return notes
+
+def iter_cards(count, cloze_ratio, note_style, image_names, seed=1234):
+    """Yield synthetic cards with a deterministic cloze/basic mix"""
+    rng = random.Random(seed)
+    for i in range(count):
+        image_name = image_names[i % len(image_names)] if image_names else None
+        card = {
+            'notes': card_notes(i, note_style, image_name),
+            'tags': ['benchmark', f'page_{i // 25}'],
+            'sourceKey': f'page_{i // 25}:{i % 25}',
+        }
+        if rng.random() < cloze_ratio:
+            card.update(type='cloze', text=f'Fact {i}: the {{{{c1::mitochondria}}}} produce {{{{c2::ATP}}}} via step {i}')
+        else:
+            card.update(type='standard', question=f'What is concept {i}?',
+                        answer=f'Concept {i} is defined as a synthetic benchmark fact.')
+        yield card
+
+def make_images(media_folder, count, size_kb):
+    """Write count images alternating incompressible PNG-like blobs and SVG text"""
+    names = []
+    for i in range(count):
+        if i % 2 == 0:
+            name = f'bench_{i}.png'
+            with open(os.path.join(media_folder, name), 'wb') as f:
+                f.write(os.urandom(size_kb * 1024))
+        else:
+            name = f'bench_{i}.svg'
+            rects = ''.join(f'<rect x="{n % 200}" y="{n // 200}" width="1" height="1"/>'
+                            for n in range(size_kb * 1024 // 48))
+            with open(os.path.join(media_folder, name), 'w') as f:
+                f.write(f'<svg xmlns="http://www.w3.org/2000/svg">{rects}</svg>')
+        names.append(name)
+    return names
+
+def megabytes(value):
+    return round(value / (1 << 20), 1)
+
+def timed_stage(stages, name, count, func):
+    """Run one stage and record wall time, throughput and peak RSS growth
+    
+    Peak RSS only ever rises within the scenario's process, so a stage's
+    footprint is how far it raised the peak; a stage that fits in memory an
+    earlier stage already used reports 0.
+    """
+    rss_before = anki_generator.peak_rss_bytes()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    stages[name] = {
+        'seconds': round(elapsed, 4),
+        'cardsPerSecond': round(count / elapsed, 1) if elapsed else None,
+        'peakRssGrowthMb': megabytes(anki_generator.peak_rss_bytes() - rss_before),
+    }
+    return result
+
+def run_scenario(scenario):
+    """Run every stage of one scenario; meant to execute in a fresh process"""
+    anki_generator.logger.setLevel('WARNING')
+    size = scenario['size']
+    stages = {}
+    rss_start = anki_generator.peak_rss_bytes()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        media_folder = os.path.join(work_dir, 'images')
+        os.makedirs(media_folder)
+        # Image paths in the input are relative to this folder, as they are to public/ in the app
+        media_root = work_dir
+        image_names = make_images(media_folder, scenario['images'], scenario['imageKb'])
+        cards = lambda: iter_cards(size, scenario['clozeRatio'], scenario['notes'], image_names)  # noqa: E731
+
+        header = {
+            'deckName': 'Benchmark Deck',
+            'deckId': 1234567890,
+            'cacheKey': 'benchmark',
+            'images': [{'path': f'/images/{name}'} for name in image_names],
+        }
+        input_path = os.path.join(work_dir, 'input.ndjson')
+
+        def serialize():
+            with open(input_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(header) + '\n')
+                for card in cards():
+                    f.write(json.dumps(card) + '\n')
+            return os.path.getsize(input_path)
+
+        def load():
+            data = anki_generator.process_input_data(input_path)
+            return sum(1 for _ in data['cards'])
+
+        def build():
+            # Field rewriting and compaction as create_anki_package sets them up, without writing a package
+            data = anki_generator.process_input_data(input_path)
+            stats = {'cloze': 0, 'standard': 0, 'error': 0}
+            media = anki_generator.media_store(data.get('images', []), media_root)
+            rewriter, compactor = anki_generator.note_builders(
+                media, media_root, scenario['compact'], stats,
+                keep_styles=scenario['backend'] in anki_generator.FLAT_FORMATS)
+            cards_data = anki_generator.iter_cards(data['cards'], stats)
+            for _ in anki_generator.iter_built_notes(cards_data, stats, rewriter, compactor):
+                pass
+            return stats
+
+        output_path = os.path.join(work_dir, 'output.apkg')
+
+        def package():
+            data = anki_generator.process_input_data(input_path)
+            kwargs = {'backend': scenario['backend']}
+            if scenario['backend'] == 'cached':
+                kwargs = {'cache_dir': os.path.join(work_dir, 'cache')}
+            kwargs['compact'] = scenario['compact']
+            result = anki_generator.create_anki_package(data, output_path, media_root, **kwargs)
+            if not result['success']:
+                raise RuntimeError(result['error'])
+            return result
+
+        input_bytes = timed_stage(stages, 'serialize', size, serialize)
+        timed_stage(stages, 'load', size, load)
+        build_stats = timed_stage(stages, 'build', size, build)
+        result = timed_stage(stages, 'package', size, package)
+        generator_timings = {'package': result.get('timings')}
+        if scenario['backend'] == 'cached':
+            # Second run against a warm cache measures an unchanged re-export
+            generator_timings['package_warm'] = timed_stage(stages, 'package_warm', size, package).get('timings')
+
+        return {
+            **scenario,
+            'cards': build_stats,
+            'inputBytes': input_bytes,
+            'outputBytes': os.path.getsize(output_path),
+            'peakRssMb': megabytes(anki_generator.peak_rss_bytes()),
+            'peakRssGrowthMb': megabytes(anki_generator.peak_rss_bytes() - rss_start),
+            'stages': stages,
+            'generatorStats': result.get('stats'),
+            'generatorTimings': generator_timings,
+        }
+
+def parse_list(value, cast=str):
+    return [cast(item) for item in value.split(',') if item]
+
+def main():
+    anki_generator.configure_logging()
+    parser = argparse.ArgumentParser(description='Benchmark the anki_generator.py packaging pipeline')
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='comma-separated card counts, e.g. 100,1000,10000,100000 (default: 100,1000,10000)')
+    parser.add_argument('--backends', default='genanki,sqlite',
+                        help="comma-separated backends: genanki, sqlite, cached (default: genanki,sqlite)")
+    parser.add_argument('--cloze-ratios', default='0.5',
+                        help='comma-separated fractions of cloze cards (default: 0.5)')
+    parser.add_argument('--notes', default='plain,styled',
+                        help=f"comma-separated note styles from {', '.join(NOTE_STYLES)} (default: plain,styled)")
+    parser.add_argument('--images', default='0',
+                        help='comma-separated image counts per deck (default: 0)')
+    parser.add_argument('--compact', default='on',
+                        help='comma-separated field compaction settings: on, off (default: on)')
+    parser.add_argument('--image-kb', type=int, default=64, help='size of each image in KB (default: 64)')
+    parser.add_argument('--output', default='bench_results.json', help='results file (default: bench_results.json)')
+    args = parser.parse_args()
+
+    scenarios = [
+        {'size': size, 'backend': backend, 'clozeRatio': ratio, 'notes': notes,
+         'images': images, 'imageKb': args.image_kb, 'compact': compact == 'on'}
+        for size, ratio, notes, images, backend, compact in itertools.product(
+            parse_list(args.sizes, int), parse_list(args.cloze_ratios, float), parse_list(args.notes),
+            parse_list(args.images, int), parse_list(args.backends), parse_list(args.compact))
+    ]
+
+    runs = []
+    # One process per scenario keeps peak RSS figures independent
+    context = multiprocessing.get_context('spawn')
+    for scenario in scenarios:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            run = executor.submit(run_scenario, scenario).result()
+        package = run['stages']['package']
+        anki_generator.logger.info(
+            f"{run['backend']:8s} {run['size']:>7d} cards, {run['notes']:10s} notes, {run['images']:>3d} images, "
+            f"compact {'on ' if run['compact'] else 'off'}: "
+            f"{package['seconds']}s ({package['cardsPerSecond']} cards/s), "
+            f"peak RSS +{package['peakRssGrowthMb']} MB, {run['outputBytes']} bytes")
+        runs.append(run)
+
+    results = {
+        'generatedAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'genanki': getattr(anki_generator.genanki, '__version__', None),
+        'platform': platform.platform(),
+        'runs': runs,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    anki_generator.logger.info(f"Wrote {len(runs)} benchmark runs to {args.output}")
+
+if __name__ == "__main__":
+    main()
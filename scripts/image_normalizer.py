@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""Downscale and recompress oversized raster images before they are sent to
+Gemini and packaged into decks
+
+Reads a JSON request on stdin:
+    {"images": [{"input": "/abs/in.png", "output": "/abs/cache/<hash>"}, ...],
+     "maxDimension": 1600, "maxBytes": 524288}
+and writes each result to output + extension (".jpg" when an opaque image
+had to be re-encoded as JPEG to fit the byte budget, otherwise the input's
+extension). An image that is kept as it is isn't copied: an empty
+output + ".unchanged" marker records that instead, and its result has
+no output. A JSON summary is printed to stdout; logs go to stderr.
+
+Without Pillow every image is kept unchanged.
+"""
+import sys
+import os
+import io
+import json
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Configure logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    stream=sys.stderr)
+logger = logging.getLogger("ImageNormalizer")
+
+RASTER_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff'}
+DEFAULT_MAX_DIMENSION = 1600
+DEFAULT_MAX_BYTES = 512 * 1024
+# JPEG qualities tried in turn until the image fits the byte budget
+JPEG_QUALITIES = (85, 75, 65, 55)
+# Each further pass shrinks the image to this fraction when no quality fits
+SHRINK_FACTOR = 0.75
+MAX_SHRINK_PASSES = 4
+# Returned by reencode when the original should be kept as it is
+KEEP_ORIGINAL = object()
+# Appended to output for the marker of an image kept as it is
+UNCHANGED_SUFFIX = '.unchanged'
+# Smaller batches are normalized in-process; starting a pool costs more than it saves
+POOL_MIN_IMAGES = 4
+
+def has_alpha(image):
+    """Whether the image uses transparency, which JPEG can't keep"""
+    return image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+
+def encode(image, fmt, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+def encode_within_budget(image, ext, max_bytes):
+    """Encode image as small as needed to fit max_bytes, returning (data, ext)
+    
+    Transparent images stay PNG (palette-quantized if needed); opaque ones keep
+    their format if it fits and are re-encoded as JPEG at falling quality
+    otherwise. If nothing fits, the image is shrunk and the attempts repeated.
+    """
+    for _ in range(MAX_SHRINK_PASSES + 1):
+        if has_alpha(image):
+            data = encode(image, 'PNG', optimize=True)
+            if len(data) > max_bytes:
+                data = encode(image.convert('RGBA').quantize(256), 'PNG', optimize=True)
+            candidates = [(data, '.png')]
+        else:
+            candidates = []
+            if ext in ('.jpg', '.jpeg'):
+                candidates.append((encode(image.convert('RGB'), 'JPEG', quality=JPEG_QUALITIES[0], optimize=True), ext))
+            else:
+                candidates.append((encode(image, 'PNG', optimize=True), '.png'))
+            rgb = image.convert('RGB')
+            candidates.extend((encode(rgb, 'JPEG', quality=quality, optimize=True), '.jpg')
+                              for quality in JPEG_QUALITIES)
+        
+        for data, data_ext in candidates:
+            if len(data) <= max_bytes:
+                return data, data_ext
+        
+        width, height = image.size
+        if min(width, height) * SHRINK_FACTOR < 16:
+            break
+        image = image.resize((int(width * SHRINK_FACTOR), int(height * SHRINK_FACTOR)), Image.LANCZOS)
+    
+    # Still over budget: settle for the smallest attempt
+    return min(candidates, key=lambda candidate: len(candidate[0]))
+
+# Outputs land in a cache other pages read from, so they only ever appear complete
+def write_atomic(path, data):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def reencode(input_path, ext, bytes_before, max_dimension, max_bytes, result):
+    """(data, ext) for an image over the limits, or KEEP_ORIGINAL with result['reason'] set"""
+    if Image is None or ext not in RASTER_EXTENSIONS:
+        result['reason'] = 'not a supported raster image'
+        return KEEP_ORIGINAL
+    
+    try:
+        with Image.open(input_path) as image:
+            result['width'], result['height'] = image.size
+            # Animated images would lose their frames
+            if getattr(image, 'is_animated', False):
+                result['reason'] = 'animated image'
+                return KEEP_ORIGINAL
+            
+            if max(image.size) <= max_dimension and bytes_before <= max_bytes:
+                result['reason'] = 'already within limits'
+                return KEEP_ORIGINAL
+            
+            image.load()
+            if max(image.size) > max_dimension:
+                image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            data, data_ext = encode_within_budget(image, ext, max_bytes)
+    except OSError as e:
+        # Unreadable or truncated images are passed through for the caller to deal with
+        result['reason'] = str(e)
+        return KEEP_ORIGINAL
+    
+    # Re-encoding can come out larger than a small but oversized-in-pixels original
+    if len(data) >= bytes_before and max(result['width'], result['height']) <= max_dimension:
+        return KEEP_ORIGINAL
+    return data, data_ext
+
+def normalize_image(request, max_dimension, max_bytes):
+    """Normalize one image, returning a summary dict for the JSON result"""
+    input_path = request['input']
+    ext = os.path.splitext(input_path)[1].lower()
+    bytes_before = os.path.getsize(input_path)
+    result = {'input': input_path, 'bytesBefore': bytes_before, 'changed': False}
+    
+    encoded = reencode(input_path, ext, bytes_before, max_dimension, max_bytes, result)
+    if encoded is KEEP_ORIGINAL:
+        # The caller goes on using the original; the marker saves deciding again for the same content
+        write_atomic(request['output'] + UNCHANGED_SUFFIX, b'')
+        result.update(output=None, bytesAfter=bytes_before)
+        return result
+    
+    data, data_ext = encoded
+    output_path = request['output'] + data_ext
+    write_atomic(output_path, data)
+    with Image.open(output_path) as written:
+        result['width'], result['height'] = written.size
+    result.update(output=output_path, bytesAfter=len(data), changed=True)
+    return result
+
+def normalize_one(args):
+    """Pool entry point; errors are reported per image rather than failing the batch"""
+    request, max_dimension, max_bytes = args
+    try:
+        return normalize_image(request, max_dimension, max_bytes)
+    except Exception as e:
+        logger.error(f"Failed to normalize {request.get('input')}: {str(e)}")
+        return {'input': request.get('input'), 'error': str(e)}
+
+def normalize_images(requests, max_dimension=DEFAULT_MAX_DIMENSION, max_bytes=DEFAULT_MAX_BYTES, jobs=None):
+    """Normalize a batch of images, across a process pool when there are enough of them"""
+    tasks = [(request, max_dimension, max_bytes) for request in requests]
+    jobs = min(jobs or os.cpu_count() or 1, len(tasks))
+    
+    if jobs > 1 and len(tasks) >= POOL_MIN_IMAGES:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(normalize_one, tasks))
+    return [normalize_one(task) for task in tasks]
+
+def parse_args(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Downscale and recompress oversized raster images')
+    parser.add_argument('--jobs', type=int, metavar='N',
+                        help='processes used to normalize images in parallel (default: CPU count)')
+    return parser.parse_args(argv)
+
+def main():
+    """Main entry point for the script"""
+    args = parse_args()
+    
+    try:
+        request = json.load(sys.stdin)
+        if Image is None:
+            logger.warning("Pillow is not installed; images are kept unchanged")
+        
+        results = normalize_images(request.get('images', []),
+                                   max_dimension=request.get('maxDimension') or DEFAULT_MAX_DIMENSION,
+                                   max_bytes=request.get('maxBytes') or DEFAULT_MAX_BYTES,
+                                   jobs=args.jobs)
+        changed = [r for r in results if r.get('changed')]
+        saved = sum(r['bytesBefore'] - r['bytesAfter'] for r in changed)
+        logger.info(f"Normalized {len(changed)} of {len(results)} images, saving {saved} bytes")
+        
+        print(json.dumps({'success': True, 'images': results}))
+    except Exception as e:
+        logger.error(f"Unhandled exception: {str(e)}")
+        print(json.dumps({
+            'success': False,
+            'error': str(e)
+        }))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
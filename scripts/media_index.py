@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""Reference-counted index of generated files, and the garbage collector that uses it
+
+The index is a small SQLite database recording which owners reference which
+files. Owners are files themselves: a generated package references the
+images packaged into it (recorded by anki_generator.py), and a page's cached
+AI output references the images downloaded for the page (recorded by app.js).
+
+Garbage collection scans the given root folders and removes in bulk:
+  - owners and caches (any kind but 'image') unused for longer than maxAge
+  - images no live owner references, once older than a grace period
+  - least recently used owners and caches, while the roots exceed a byte
+    budget, together with the images only they referenced
+With dryRun nothing is deleted and the report shows what would be freed.
+
+Reads a JSON request on stdin:
+    {"db": "/abs/media.sqlite",
+     "ops": [{"op": "record", "owner": "/abs/deck.apkg", "ownerKind": "package", "paths": [...]},
+             {"op": "touch", "paths": [...]},
+             {"op": "release", "owner": "/abs/deck.apkg"},
+             {"op": "gc", "roots": [{"path": "/abs/public/images", "kind": "image"}, ...],
+              "budgetBytes": 1073741824, "maxAgeSeconds": 1209600, "graceSeconds": 3600,
+              "dryRun": true}]}
+and prints {"success": true, "results": [...]} with one result per op.
+"""
+import sys
+import os
+import json
+import time
+import sqlite3
+import logging
+import itertools
+import contextlib
+
+logger = logging.getLogger("MediaIndex")
+
+# Kind of files that live only as long as something references them
+REFERENCED_KIND = 'image'
+DEFAULT_GRACE_SECONDS = 3600
+# Deleted files listed individually in a report; the totals cover all of them
+GC_REPORT_LIMIT = 200
+SQLITE_BATCH_SIZE = 1000
+
+MEDIA_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS refs (
+    owner TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (owner, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_refs_path ON refs (path);
+"""
+
+def batched(items, size=SQLITE_BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def scan_root(root, kind):
+    """(path, kind, size, mtime) for the regular files directly inside root
+    
+    Hidden files and partial downloads or writes in progress are skipped.
+    """
+    try:
+        entries = os.scandir(root)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.name.startswith('.') or entry.name.endswith(('.part', '.tmp')):
+                continue
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            yield os.path.abspath(entry.path), kind, stat.st_size, stat.st_mtime
+
+class MediaIndex:
+    """Which owners reference which files, in a SQLite database shared between processes"""
+    
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # The generator worker, one-shot generators and app.js's flushes may write at once
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.executescript(MEDIA_INDEX_SCHEMA)
+    
+    def close(self):
+        self.conn.close()
+    
+    def record(self, owner, owner_kind, paths, kind=REFERENCED_KIND, now=None):
+        """Set the files owner references, replacing what it referenced before"""
+        now = now or time.time()
+        owner = os.path.abspath(owner)
+        paths = {os.path.abspath(path) for path in paths}
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (owner, owner_kind, now))
+            self.conn.execute('DELETE FROM refs WHERE owner = ?', (owner,))
+            self.conn.executemany('INSERT OR IGNORE INTO refs VALUES (?, ?)', ((owner, path) for path in paths))
+            self.conn.executemany(
+                'INSERT INTO files VALUES (?, ?, ?) ON CONFLICT(path) DO UPDATE SET last_used = excluded.last_used',
+                ((path, kind, now) for path in paths))
+        return {'owner': owner, 'references': len(paths)}
+    
+    def touch(self, paths, now=None):
+        """Mark indexed files as just used, e.g. a cached package served again"""
+        now = now or time.time()
+        with self.conn:
+            self.conn.executemany('UPDATE files SET last_used = ? WHERE path = ?',
+                                  ((now, os.path.abspath(path)) for path in paths))
+        return {'touched': len(paths)}
+    
+    def release(self, owner):
+        """Drop everything owner references"""
+        with self.conn:
+            cursor = self.conn.execute('DELETE FROM refs WHERE owner = ?', (os.path.abspath(owner),))
+        return {'released': cursor.rowcount}
+    
+    def collect(self, roots, budget_bytes=None, max_age_seconds=None, grace_seconds=DEFAULT_GRACE_SECONDS,
+                dry_run=True, report_limit=GC_REPORT_LIMIT, now=None):
+        """Remove expired, unreferenced and over-budget files under roots; see the module docstring
+        
+        roots is a list of {'path', 'kind'}. Files on disk that were never
+        indexed are treated as unreferenced and last used at their mtime.
+        """
+        start = time.perf_counter()
+        now = now or time.time()
+        
+        disk = {}
+        for root in roots:
+            for path, kind, size, mtime in scan_root(root['path'], root.get('kind', REFERENCED_KIND)):
+                disk[path] = (kind, size, mtime)
+        
+        last_used = dict(self.conn.execute('SELECT path, last_used FROM files'))
+        refs = {}
+        for owner, path in self.conn.execute('SELECT owner, path FROM refs'):
+            refs.setdefault(owner, []).append(path)
+        
+        # Owners whose file is gone no longer hold their references
+        stale_owners = [owner for owner in refs if owner not in disk and not os.path.exists(owner)]
+        for owner in stale_owners:
+            del refs[owner]
+        
+        ref_counts = {}
+        for paths in refs.values():
+            for path in paths:
+                ref_counts[path] = ref_counts.get(path, 0) + 1
+        
+        def used_at(path):
+            return max(last_used.get(path, 0), disk[path][2])
+        
+        deletions = {}
+        remaining_bytes = sum(size for _, size, _ in disk.values())
+        
+        def delete(path, reason):
+            nonlocal remaining_bytes
+            deletions[path] = reason
+            remaining_bytes -= disk[path][1]
+            released = refs.get(path, ())
+            for ref in released:
+                ref_counts[ref] -= 1
+                # Companion files, like a flat export's media zip, go with their owner
+                if ref in disk and ref not in deletions and disk[ref][0] != REFERENCED_KIND and not ref_counts[ref]:
+                    delete(ref, reason)
+            return released
+        
+        def collectable(path):
+            kind, _, _ = disk[path]
+            return (kind == REFERENCED_KIND and path not in deletions and not ref_counts.get(path)
+                    and now - used_at(path) > grace_seconds)
+        
+        # Owners and caches, least recently used first; companions still referenced wait for their owner
+        aged = sorted((path for path, (kind, _, _) in disk.items()
+                       if kind != REFERENCED_KIND and not ref_counts.get(path)), key=used_at)
+        if max_age_seconds:
+            for path in aged:
+                if path not in deletions and now - used_at(path) > max_age_seconds:
+                    delete(path, 'expired')
+        
+        for path in disk:
+            if collectable(path):
+                delete(path, 'unreferenced')
+        
+        if budget_bytes is not None:
+            for path in aged:
+                if remaining_bytes <= budget_bytes:
+                    break
+                if path in deletions:
+                    continue
+                for ref in delete(path, 'budget'):
+                    if ref in disk and collectable(ref):
+                        delete(ref, 'unreferenced')
+        
+        failed = 0
+        if not dry_run:
+            for path in deletions:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"Failed to delete {path}: {str(e)}")
+                    failed += 1
+            
+            # Rows for files that are gone, from this run or earlier, go too
+            root_dirs = {os.path.abspath(root['path']) for root in roots}
+            gone = [path for path in last_used
+                    if path in deletions or (path not in disk and os.path.dirname(path) in root_dirs)]
+            with self.conn:
+                for chunk in batched(stale_owners + [path for path in deletions if path in refs]):
+                    self.conn.executemany('DELETE FROM refs WHERE owner = ?', ((owner,) for owner in chunk))
+                for chunk in batched(gone):
+                    self.conn.executemany('DELETE FROM files WHERE path = ?', ((path,) for path in chunk))
+        
+        by_reason = {'expired': 0, 'unreferenced': 0, 'budget': 0}
+        bytes_by_reason = dict.fromkeys(by_reason, 0)
+        by_kind = {}
+        for path, reason in deletions.items():
+            kind, size, _ = disk[path]
+            by_reason[reason] += 1
+            bytes_by_reason[reason] += size
+            kind_totals = by_kind.setdefault(kind, {'files': 0, 'bytes': 0})
+            kind_totals['files'] += 1
+            kind_totals['bytes'] += size
+        
+        report = {
+            'dryRun': dry_run,
+            'scannedFiles': len(disk),
+            'scannedBytes': sum(size for _, size, _ in disk.values()),
+            'deleted': by_reason,
+            'bytesByReason': bytes_by_reason,
+            'deletedByKind': by_kind,
+            'bytesFreed': sum(bytes_by_reason.values()),
+            'remainingBytes': remaining_bytes,
+            'budgetBytes': budget_bytes,
+            'overBudget': budget_bytes is not None and remaining_bytes > budget_bytes,
+            'staleOwners': len(stale_owners),
+            'failed': failed,
+            'files': [{'path': path, 'kind': disk[path][0], 'bytes': disk[path][1], 'reason': reason}
+                      for path, reason in itertools.islice(deletions.items(), report_limit)],
+            'seconds': round(time.perf_counter() - start, 6),
+        }
+        
+        verb = 'Would free' if dry_run else 'Freed'
+        logger.info(f"{verb} {report['bytesFreed']} bytes in {len(deletions)} of {len(disk)} files "
+                    f"({by_reason['expired']} expired, {by_reason['unreferenced']} unreferenced, "
+                    f"{by_reason['budget']} over budget)")
+        return report
+
+def handle_op(index, request):
+    """Run one op against an open MediaIndex"""
+    op = request.get('op')
+    
+    if op == 'record':
+        return index.record(request['owner'], request.get('ownerKind', 'package'), request.get('paths', []),
+                            kind=request.get('kind', REFERENCED_KIND))
+    if op == 'touch':
+        return index.touch(request.get('paths', []))
+    if op == 'release':
+        return index.release(request['owner'])
+    if op == 'gc':
+        return index.collect(request.get('roots', []),
+                             budget_bytes=request.get('budgetBytes'),
+                             max_age_seconds=request.get('maxAgeSeconds'),
+                             grace_seconds=request.get('graceSeconds', DEFAULT_GRACE_SECONDS),
+                             dry_run=request.get('dryRun', True))
+    
+    raise ValueError(f"Unknown media index op: {op}")
+
+@contextlib.contextmanager
+def open_index(db_path):
+    index = MediaIndex(db_path)
+    try:
+        yield index
+    finally:
+        index.close()
+
+def main():
+    """Main entry point for the script"""
+    # stdout carries the JSON result
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        stream=sys.stderr)
+    
+    try:
+        request = json.load(sys.stdin)
+        with open_index(request['db']) as index:
+            results = [handle_op(index, op) for op in request.get('ops', [])]
+        print(json.dumps({'success': True, 'results': results}))
+    except Exception as e:
+        logger.error(f"Unhandled exception: {str(e)}")
+        print(json.dumps({
+            'success': False,
+            'error': str(e)
+        }))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+// GeneratorWorker against the real generator and against scripted stand-ins
+// that close stdin, crash or hang, checking requests fail cleanly and the
+// next one gets a fresh process
+const { test, after } = require('node:test');
+const assert = require('node:assert');
+const fs = require('fs');
+const os = require('os');
+const path = require('path');
+const { GeneratorWorker } = require('../anki_bridge');
+
+const PYTHON = process.env.PYTHON || 'python3';
+const tempDir = fs.mkdtempSync(path.join(os.tmpdir(), 'autoanki-worker-'));
+const workers = [];
+
+after(() => {
+  for (const worker of workers) worker.stop();
+  fs.rmSync(tempDir, { recursive: true, force: true });
+});
+
+function newWorker(scriptPath = path.join(__dirname, '..', 'scripts', 'anki_generator.py')) {
+  const worker = new GeneratorWorker({ pythonPath: PYTHON, scriptPath, healthCheckIntervalMs: 0 });
+  workers.push(worker);
+  return worker;
+}
+
+// A stand-in worker: answers each request with its pid, then does whatever
+// the request's "then" field says
+const STAND_IN = `
+import json, os, sys, time
+for line in sys.stdin:
+    request = json.loads(line)
+    then = request.get('then')
+    if then == 'close-stdin':
+        os.close(0)
+    if then == 'crash':
+        sys.exit(3)
+    if then == 'hang':
+        time.sleep(60)
+    sys.stdout.write(json.dumps({'id': request['id'], 'success': True, 'pid': os.getpid()}) + '\\n')
+    sys.stdout.flush()
+    if then == 'close-stdin':
+        time.sleep(60)
+`;
+const standInPath = path.join(tempDir, 'stand_in.py');
+fs.writeFileSync(standInPath, STAND_IN);
+
+test('requests round-trip through the real generator with progress', async () => {
+  const worker = newWorker();
+  assert.strictEqual(await worker.ping(), true);
+
+  const records = [];
+  const response = await worker.request({
+    op: 'generate',
+    output: path.join(tempDir, 'deck.apkg'),
+    backend: 'sqlite',
+    data: { deckName: 'Deck', cards: [{ type: 'basic', question: 'Q', answer: 'A' }] }
+  }, 60000, { idleTimeoutMs: 60000, onProgress: record => records.push(record) });
+
+  assert.strictEqual(response.success, true);
+  assert.strictEqual(response.stats.standard, 1);
+  assert.ok(fs.existsSync(response.path));
+  assert.strictEqual(response.id, undefined);
+  assert.strictEqual(records.at(-1).stage, 'done');
+});
+
+test('a worker that closes stdin fails the next request with EPIPE and is restarted', async () => {
+  const worker = newWorker(standInPath);
+  const first = await worker.request({ op: 'ping', then: 'close-stdin' }, 10000);
+
+  // Without the stdin error listener this write would crash the process
+  await assert.rejects(worker.request({ op: 'ping' }, 10000), /stdin error: .*EPIPE/);
+
+  const next = await worker.request({ op: 'ping' }, 10000);
+  assert.strictEqual(next.success, true);
+  assert.notStrictEqual(next.pid, first.pid);
+});
+
+test('a worker that exits fails its request and the next one starts a new process', async () => {
+  const worker = newWorker(standInPath);
+  const first = await worker.request({ op: 'ping' }, 10000);
+
+  await assert.rejects(worker.request({ op: 'ping', then: 'crash' }, 10000), /exited with code 3/);
+  assert.strictEqual(worker.process, null);
+
+  const next = await worker.request({ op: 'ping' }, 10000);
+  assert.notStrictEqual(next.pid, first.pid);
+});
+
+test('a request that makes no progress times out and the hung worker is replaced', async () => {
+  const worker = newWorker(standInPath);
+  const first = await worker.request({ op: 'ping' }, 10000);
+  const hung = worker.process;
+
+  await assert.rejects(worker.request({ op: 'ping', then: 'hang' }, 10000, { idleTimeoutMs: 200 }),
+    /made no progress for 0 seconds/);
+  assert.notStrictEqual(worker.process, hung);
+
+  const next = await worker.request({ op: 'ping' }, 10000);
+  assert.notStrictEqual(next.pid, first.pid);
+});
+
+test('queued requests run one at a time in order', async () => {
+  const worker = newWorker(standInPath);
+  const order = [];
+  await Promise.all([1, 2, 3].map(n => worker.request({ op: 'ping' }, 10000).then(() => order.push(n))));
+  assert.deepStrictEqual(order, [1, 2, 3]);
+});
@@ -0,0 +1,238 @@
+// app.js against a mock Microsoft Graph server and a stub Gemini model: the
+// per-page AI output cache, Graph retries and the per-session list cache
+const { test, before, after, beforeEach } = require('node:test');
+const assert = require('node:assert');
+const http = require('http');
+const fs = require('fs');
+const os = require('os');
+const path = require('path');
+const { GoogleGenerativeAI } = require('@google/generative-ai');
+
+// Mock Graph: routes maps a path to a list of responses served in turn (the last one repeats)
+const graph = { routes: new Map(), hits: new Map() };
+const graphServer = http.createServer((req, res) => {
+  const { pathname } = new URL(req.url, 'http://localhost');
+  graph.hits.set(pathname, (graph.hits.get(pathname) || 0) + 1);
+
+  const responses = graph.routes.get(pathname);
+  if (!responses) {
+    res.writeHead(404, { 'Content-Type': 'application/json' });
+    res.end(JSON.stringify({ error: { code: 'itemNotFound' } }));
+    return;
+  }
+  const { status = 200, headers = {}, body } = responses.length > 1 ? responses.shift() : responses[0];
+  res.writeHead(status, { 'Content-Type': typeof body === 'string' ? 'text/html' : 'application/json', ...headers });
+  res.end(typeof body === 'string' ? body : JSON.stringify(body || {}));
+});
+
+// Stub model: every prompt is answered with one flashcard
+const model = { calls: 0 };
+GoogleGenerativeAI.prototype.getGenerativeModel = () => ({
+  generateContent: async () => {
+    model.calls++;
+    return { response: { text: () => '```json\n[{"type": "standard", "question": "What makes ATP?", "answer": "Mitochondria"}]\n```' } };
+  }
+});
+
+const pageCacheDir = fs.mkdtempSync(path.join(os.tmpdir(), 'autoanki-pages-'));
+let app;
+let graphBase;
+
+before(async () => {
+  await new Promise(resolve => graphServer.listen(0, '127.0.0.1', resolve));
+  graphBase = `http://127.0.0.1:${graphServer.address().port}/v1.0`;
+  Object.assign(process.env, {
+    GRAPH_API_BASE: graphBase,
+    PAGE_AI_CACHE_DIR: pageCacheDir,
+    GOOGLE_API_KEY: 'test',
+    MS_CLIENT_ID: 'test-client',
+    MS_CLIENT_SECRET: 'test-secret',
+    MEDIA_INDEX: '0',
+    IMAGE_NORMALIZE: '0'
+  });
+  app = require('../app');
+});
+
+after(() => {
+  graphServer.close();
+  fs.rmSync(pageCacheDir, { recursive: true, force: true });
+});
+
+beforeEach(() => {
+  graph.routes.clear();
+  graph.hits.clear();
+});
+
+let sessionCount = 0;
+function newRequest() {
+  sessionCount++;
+  return { session: { accessToken: 'token' }, sessionID: `session-${sessionCount}`, query: {} };
+}
+
+const PREFERENCES = {
+  enableCloze: true,
+  enableStandard: true,
+  maxCardsPerPage: 0,
+  processImages: false,
+  generateConceptMaps: false
+};
+
+test('page AI output is reused until the page version or preferences change', async () => {
+  const req = newRequest();
+  graph.routes.set('/v1.0/me/onenote/pages/page-1/content', [{ body: '<p>Mitochondria make ATP.</p>' }]);
+  const page = version => ({ id: 'page-1', title: 'Cells', lastModifiedDateTime: version });
+
+  const first = await app.processPageForAnki(req, page('2024-01-01T00:00:00Z'), PREFERENCES);
+  assert.strictEqual(model.calls, 1);
+  assert.deepStrictEqual(first.flashcards.map(card => card.tags), [['cells']]);
+
+  // Same version: served from the cache without fetching the page
+  const second = await app.processPageForAnki(req, page('2024-01-01T00:00:00Z'), PREFERENCES);
+  assert.strictEqual(model.calls, 1);
+  assert.strictEqual(graph.hits.get('/v1.0/me/onenote/pages/page-1/content'), 1);
+  assert.deepStrictEqual(second.flashcards, first.flashcards);
+
+  // The card limit is applied after generation and shares the entry
+  await app.processPageForAnki(req, page('2024-01-01T00:00:00Z'), { ...PREFERENCES, maxCardsPerPage: 1 });
+  assert.strictEqual(model.calls, 1);
+
+  // An edited page is regenerated, and the new version is cached in turn
+  await app.processPageForAnki(req, page('2024-02-01T00:00:00Z'), PREFERENCES);
+  assert.strictEqual(model.calls, 2);
+  await app.processPageForAnki(req, page('2024-02-01T00:00:00Z'), PREFERENCES);
+  assert.strictEqual(model.calls, 2);
+
+  // Preferences that change the AI output have their own entry
+  await app.processPageForAnki(req, page('2024-02-01T00:00:00Z'), { ...PREFERENCES, enableCloze: false });
+  assert.strictEqual(model.calls, 3);
+  assert.notStrictEqual(app.pageCachePath('page-1', PREFERENCES),
+    app.pageCachePath('page-1', { ...PREFERENCES, enableCloze: false }));
+  assert.strictEqual(app.pageCachePath('page-1', PREFERENCES),
+    app.pageCachePath('page-1', { ...PREFERENCES, maxCardsPerPage: 5 }));
+});
+
+test('pages without a modification time are keyed by their content', async () => {
+  const req = newRequest();
+  const contentPath = '/v1.0/me/onenote/pages/page-2/content';
+  const page = { id: 'page-2', title: 'Undated' };
+  graph.routes.set(contentPath, [{ body: '<p>Version one</p>' }]);
+  const callsBefore = model.calls;
+
+  await app.processPageForAnki(req, page, PREFERENCES);
+  await app.processPageForAnki(req, page, PREFERENCES);
+  assert.strictEqual(model.calls, callsBefore + 1);
+  assert.strictEqual(graph.hits.get(contentPath), 2);
+
+  graph.routes.set(contentPath, [{ body: '<p>Version two</p>' }]);
+  await app.processPageForAnki(req, page, PREFERENCES);
+  assert.strictEqual(model.calls, callsBefore + 2);
+});
+
+test('a cache entry whose page version differs is a miss', () => {
+  const cachePath = path.join(pageCacheDir, 'direct.json');
+  app.writePageCache(cachePath, 'v1', { flashcards: [{ question: 'Q' }], images: [], conceptMap: null });
+
+  assert.deepStrictEqual(app.readPageCache(cachePath, 'v1').flashcards, [{ question: 'Q' }]);
+  assert.strictEqual(app.readPageCache(cachePath, 'v2'), null);
+  assert.strictEqual(app.readPageCache(path.join(pageCacheDir, 'missing.json'), 'v1'), null);
+});
+
+test('throttled and unavailable Graph calls are retried', async () => {
+  const req = newRequest();
+  const past = new Date(Date.now() - 60000).toUTCString();
+  graph.routes.set('/v1.0/throttled', [
+    { status: 429, headers: { 'Retry-After': '0' } },
+    { status: 503, headers: { 'Retry-After': past } },
+    { status: 504, headers: { 'Retry-After': '0' } },
+    { body: { value: ['ok'] } }
+  ]);
+
+  assert.deepStrictEqual(await app.callGraphAPI(req, '/throttled'), { value: ['ok'] });
+  assert.strictEqual(graph.hits.get('/v1.0/throttled'), 4);
+});
+
+test('Graph retries stop after GRAPH_MAX_RETRIES, and other errors are not retried', async () => {
+  const req = newRequest();
+  graph.routes.set('/v1.0/down', [{ status: 503, headers: { 'Retry-After': '0' } }]);
+
+  await assert.rejects(app.callGraphAPI(req, '/down'), error => error.response.status === 503);
+  assert.strictEqual(graph.hits.get('/v1.0/down'), 4);
+
+  await assert.rejects(app.callGraphAPI(req, '/missing'), error => error.response.status === 404);
+  assert.strictEqual(graph.hits.get('/v1.0/missing'), 1);
+});
+
+test('retry delays follow Retry-After, falling back to exponential backoff', () => {
+  assert.strictEqual(app.graphRetryDelayMs('3', 0), 3000);
+  assert.strictEqual(app.graphRetryDelayMs('0', 2), 0);
+
+  const delay = app.graphRetryDelayMs(new Date(Date.now() + 5000).toUTCString(), 0);
+  assert.ok(delay > 3000 && delay <= 5000, `unexpected delay ${delay}`);
+  assert.strictEqual(app.graphRetryDelayMs(new Date(Date.now() - 5000).toUTCString(), 0), 0);
+
+  assert.strictEqual(app.graphRetryDelayMs(undefined, 0), 1000);
+  assert.strictEqual(app.graphRetryDelayMs(undefined, 2), 4000);
+  assert.strictEqual(app.graphRetryDelayMs('soon', 1), 2000);
+});
+
+test('list results are shared within a session, including calls in flight', async () => {
+  graph.routes.set('/v1.0/me/onenote/notebooks', [{ body: { value: [{ id: 'nb-1' }], '@odata.nextLink': `${graphBase}/me/onenote/notebooks/next` } }]);
+  graph.routes.set('/v1.0/me/onenote/notebooks/next', [{ body: { value: [{ id: 'nb-2' }] } }]);
+  const req = newRequest();
+
+  const [first, concurrent] = await Promise.all([app.getOneNoteNotebooks(req), app.getOneNoteNotebooks(req)]);
+  const again = await app.getOneNoteNotebooks(req);
+  assert.deepStrictEqual(first.map(notebook => notebook.id), ['nb-1', 'nb-2']);
+  assert.strictEqual(concurrent, first);
+  assert.strictEqual(again, first);
+  assert.strictEqual(graph.hits.get('/v1.0/me/onenote/notebooks'), 1);
+
+  // Another session doesn't see this one's lists
+  await app.getOneNoteNotebooks(newRequest());
+  assert.strictEqual(graph.hits.get('/v1.0/me/onenote/notebooks'), 2);
+});
+
+test('failed list lookups are not cached', async () => {
+  const req = newRequest();
+  graph.routes.set('/v1.0/me/onenote/notebooks', [{ status: 500 }, { body: { value: [{ id: 'nb-1' }] } }]);
+
+  await assert.rejects(app.getOneNoteNotebooks(req));
+  assert.deepStrictEqual(await app.getOneNoteNotebooks(req), [{ id: 'nb-1' }]);
+  assert.strictEqual(graph.hits.get('/v1.0/me/onenote/notebooks'), 2);
+});
+
+test('section scans reuse the page list unless ?refresh=true', async () => {
+  const session = { accessToken: 'token' };
+  // express-session leaves a request's existing session alone, so the routes run as a signed-in user
+  const server = http.createServer((req, res) => {
+    req.session = session;
+    req.sessionID = 'scan-session';
+    app.app(req, res);
+  });
+  await new Promise(resolve => server.listen(0, '127.0.0.1', resolve));
+  const scan = async query => {
+    const response = await fetch(`http://127.0.0.1:${server.address().port}/api/onenote/scan/section-1${query}`);
+    assert.strictEqual(response.status, 200);
+    return response.json();
+  };
+
+  try {
+    const pagesPath = '/v1.0/me/onenote/sections/section-1/pages';
+    graph.routes.set(pagesPath, [
+      { body: { value: [{ id: 'p1', title: 'One', lastModifiedDateTime: '2024-01-01T00:00:00Z' }] } },
+      { body: { value: [{ id: 'p1', title: 'One' }, { id: 'p2', title: 'Two' }] } }
+    ]);
+
+    assert.deepStrictEqual((await scan('')).pages.map(page => page.id), ['p1']);
+    assert.deepStrictEqual((await scan('')).pages.map(page => page.id), ['p1']);
+    assert.strictEqual(graph.hits.get(pagesPath), 1);
+
+    assert.deepStrictEqual((await scan('?refresh=true')).pages.map(page => page.id), ['p1', 'p2']);
+    assert.strictEqual(graph.hits.get(pagesPath), 2);
+    // The refreshed list replaces the cached one
+    assert.deepStrictEqual((await scan('')).pages.map(page => page.id), ['p1', 'p2']);
+    assert.strictEqual(graph.hits.get(pagesPath), 2);
+  } finally {
+    server.close();
+  }
+});
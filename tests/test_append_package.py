@@ -0,0 +1,125 @@
+"""Append mode: merging a new export into a previously generated package"""
+import os
+import sys
+import json
+import sqlite3
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import anki_generator  # noqa: E402
+from genanki.util import guid_for  # noqa: E402
+
+def read_package(package_path):
+    """(notes by GUID as (flds, deck IDs of its cards), media contents by name)"""
+    with zipfile.ZipFile(package_path) as package:
+        media_map = json.loads(package.read('media'))
+        media = {name: package.read(idx) for idx, name in media_map.items()}
+        collection = package.read('collection.anki2')
+
+    db_path = f'{package_path}.anki2'
+    with open(db_path, 'wb') as f:
+        f.write(collection)
+    conn = sqlite3.connect(db_path)
+    try:
+        notes = {guid: (flds, sorted(did for (did,) in conn.execute('SELECT did FROM cards WHERE nid = ?', (nid,))))
+                 for nid, guid, flds in conn.execute('SELECT id, guid, flds FROM notes')}
+    finally:
+        conn.close()
+        os.remove(db_path)
+    return notes, media
+
+@pytest.fixture
+def media_folder(tmp_path):
+    folder = tmp_path / 'public'
+    (folder / 'images').mkdir(parents=True)
+    (folder / 'images' / 'cell.png').write_bytes(b'\x89PNG cell')
+    return folder
+
+def card(key, question, answer='a'):
+    return {'type': 'basic', 'question': question, 'answer': answer, 'sourceKey': key}
+
+@pytest.fixture
+def base_package(tmp_path, media_folder):
+    data = {
+        'deckName': 'Biology',
+        'deckId': 1111,
+        'cards': [card('page-1/0', 'What makes ATP? <img src="images/cell.png">', 'Mitochondria'),
+                  card('page-1/1', 'What holds DNA?', 'The nucleus')],
+    }
+    path = str(tmp_path / 'base.apkg')
+    assert anki_generator.create_anki_package(data, path, str(media_folder), backend='sqlite')['success']
+    return path
+
+def test_new_changed_and_unchanged_notes_are_merged(tmp_path, media_folder, base_package):
+    (media_folder / 'images' / 'ribosome.png').write_bytes(b'\x89PNG ribosome')
+    data = {
+        'deckName': 'Biology',
+        'deckId': 1111,
+        'cards': [
+            card('page-1/0', 'What makes ATP? <img src="images/cell.png">', 'Mitochondria'),
+            card('page-1/1', 'What holds DNA?', 'The nucleus, in a double membrane'),
+            card('page-2/0', 'What builds proteins? <img src="images/ribosome.png">', 'Ribosomes'),
+        ],
+    }
+    output_path = str(tmp_path / 'merged.apkg')
+    result = anki_generator.create_anki_package(data, output_path, str(media_folder), append_to=base_package)
+
+    assert result['success']
+    assert result['stats']['append'] == {'added': 1, 'updated': 1, 'unchanged': 1,
+                                         'mediaAdded': 1, 'mediaReplaced': 0, 'mediaKept': 1}
+    base_notes, _ = read_package(base_package)
+    notes, media = read_package(output_path)
+
+    assert set(notes) == {guid_for('page-1/0'), guid_for('page-1/1'), guid_for('page-2/0')}
+    assert notes[guid_for('page-1/0')] == base_notes[guid_for('page-1/0')]
+    assert 'double membrane' in notes[guid_for('page-1/1')][0]
+    # An updated note keeps one card rather than gaining another
+    assert notes[guid_for('page-1/1')][1] == [1111]
+    assert notes[guid_for('page-2/0')][1] == [1111]
+    assert media == {'cell.png': b'\x89PNG cell', 'ribosome.png': b'\x89PNG ribosome'}
+
+def test_notes_missing_from_the_new_export_are_kept(tmp_path, media_folder, base_package):
+    data = {'deckName': 'Biology', 'deckId': 1111, 'cards': [card('page-3/0', 'New page', 'b')]}
+    output_path = str(tmp_path / 'merged.apkg')
+    assert anki_generator.create_anki_package(data, output_path, str(media_folder), append_to=base_package)['success']
+
+    notes, media = read_package(output_path)
+    assert set(notes) == {guid_for('page-1/0'), guid_for('page-1/1'), guid_for('page-3/0')}
+    assert set(media) == {'cell.png'}
+
+def test_changed_media_replaces_the_packaged_file(tmp_path, media_folder, base_package):
+    (media_folder / 'images' / 'cell.png').write_bytes(b'\x89PNG redrawn cell')
+    data = {'deckName': 'Biology', 'deckId': 1111,
+            'cards': [card('page-1/0', 'What makes ATP? <img src="images/cell.png">', 'Mitochondria')]}
+    output_path = str(tmp_path / 'merged.apkg')
+    result = anki_generator.create_anki_package(data, output_path, str(media_folder), append_to=base_package)
+
+    assert result['stats']['append']['mediaReplaced'] == 1
+    assert result['stats']['append']['mediaAdded'] == 0
+    _, media = read_package(output_path)
+    assert media == {'cell.png': b'\x89PNG redrawn cell'}
+
+def test_cards_for_a_renamed_deck_go_into_the_package_deck(tmp_path, media_folder, base_package):
+    # Regenerated exports get a dated name and a new deck ID
+    data = {'deckName': 'Biology 2024-02-01', 'deckId': 2222, 'cards': [card('page-4/0', 'Another', 'c')]}
+    output_path = str(tmp_path / 'merged.apkg')
+    assert anki_generator.create_anki_package(data, output_path, str(media_folder), append_to=base_package)['success']
+
+    notes, _ = read_package(output_path)
+    assert notes[guid_for('page-4/0')][1] == [1111]
+
+def test_appending_the_same_export_changes_nothing(tmp_path, media_folder, base_package):
+    data = {
+        'deckName': 'Biology',
+        'deckId': 1111,
+        'cards': [card('page-1/0', 'What makes ATP? <img src="images/cell.png">', 'Mitochondria'),
+                  card('page-1/1', 'What holds DNA?', 'The nucleus')],
+    }
+    output_path = str(tmp_path / 'merged.apkg')
+    result = anki_generator.create_anki_package(data, output_path, str(media_folder), append_to=base_package)
+
+    assert result['stats']['append'] == {'added': 0, 'updated': 0, 'unchanged': 2,
+                                         'mediaAdded': 0, 'mediaReplaced': 0, 'mediaKept': 1}
+    assert read_package(output_path) == read_package(base_package)
@@ -0,0 +1,58 @@
+"""Batch exports: media referenced only from card fields, across decks built in parallel"""
+import os
+import re
+import sys
+import json
+import sqlite3
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import anki_generator  # noqa: E402
+
+IMG_SRC_RE = re.compile(r'<img\b[^>]*\bsrc="([^"]*)"')
+
+def packaged_references(package_path):
+    """(image names the notes reference, names of the media in the package)"""
+    with zipfile.ZipFile(package_path) as package:
+        media_names = set(json.loads(package.read('media')).values())
+        collection = package.read('collection.anki2')
+
+    db_path = f'{package_path}.anki2'
+    with open(db_path, 'wb') as f:
+        f.write(collection)
+    conn = sqlite3.connect(db_path)
+    try:
+        referenced = {src for (flds,) in conn.execute('SELECT flds FROM notes') for src in IMG_SRC_RE.findall(flds)}
+    finally:
+        conn.close()
+    return referenced, media_names
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_decks_sharing_an_image_only_from_fields(tmp_path, monkeypatch, jobs):
+    # Build decks in a process pool even for a handful of cards
+    monkeypatch.setattr(anki_generator, 'BATCH_POOL_MIN_CARDS', 0)
+
+    media_folder = tmp_path / 'public'
+    (media_folder / 'images').mkdir(parents=True)
+    # The same image downloaded for two pages under different names
+    for name in ('first.png', 'second.png'):
+        (media_folder / 'images' / name).write_bytes(b'\x89PNG same content')
+
+    data = {
+        'deckName': 'Notebook',
+        'decks': [{'deckName': 'Section::Page 1'}, {'deckName': 'Section::Page 2'}],
+        'cards': [
+            {'type': 'basic', 'question': 'One <img src="images/first.png">', 'answer': 'a', 'deck': 0},
+            {'type': 'basic', 'question': 'Two', 'answer': '![diagram](images/second.png)', 'deck': 1},
+        ],
+    }
+    output_path = str(tmp_path / 'notebook.apkg')
+    result = anki_generator.create_anki_package(data, output_path, str(media_folder), jobs=jobs)
+
+    assert result['success']
+    referenced, media_names = packaged_references(output_path)
+    assert referenced == {'first.png'}
+    assert media_names == {'first.png'}
+    assert result['stats']['rewrite']['missingReferences'] == 0
@@ -0,0 +1,109 @@
+"""Near-duplicate card removal: MinHash signatures bucketed with LSH"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import anki_generator  # noqa: E402
+from anki_generator import Card  # noqa: E402
+
+LONG_ANSWER = 'The mitochondria is the powerhouse of the cell and produces most of its ATP through respiration'
+
+def basic(question, answer=LONG_ANSWER, **fields):
+    return Card.coerce({'type': 'basic', 'question': question, 'answer': answer, **fields})
+
+def cloze(text, **fields):
+    return Card.coerce({'type': 'cloze', 'text': text, **fields})
+
+def dedupe(cards, threshold=0.8):
+    stats = {}
+    kept = anki_generator.dedupe_cards(cards, threshold, stats)
+    return kept, stats['dedupe']
+
+def test_near_duplicates_are_dropped_and_their_tags_merged():
+    cards = [
+        basic('What does the mitochondria do?', tags=['biology']),
+        basic('Which organelle makes ATP?', answer='Ribosomes build proteins; chloroplasts run photosynthesis'),
+        basic('What does the <b>mitochondria</b> do?', tags=['cells', 'biology']),
+    ]
+    kept, report = dedupe(cards)
+
+    assert [card.question for card in kept] == [cards[0].question, cards[1].question]
+    assert kept[0].tags == ['biology', 'cells']
+    assert report['dropped'] == 1
+    assert report['clusters'] == 1
+    assert report['droppedCards'][0]['index'] == 2
+    assert report['droppedCards'][0]['duplicateOf'] == 0
+    assert report['droppedCards'][0]['similarity'] >= 0.8
+
+def test_cards_below_the_threshold_are_kept():
+    cards = [
+        basic('What does the mitochondria do?'),
+        basic('What does the nucleus do?', answer='The nucleus holds the genetic material of the cell'),
+    ]
+    kept, report = dedupe(cards, threshold=0.9)
+    assert kept == cards
+    assert report['dropped'] == 0
+
+def test_cloze_cards_blanking_different_terms_are_kept_apart():
+    sentence = 'The {a} is the powerhouse of the cell and makes {b} by respiration'
+    cards = [
+        cloze(sentence.format(a='{{c1::mitochondria}}', b='ATP')),
+        cloze(sentence.format(a='mitochondria', b='{{c1::ATP}}')),
+        # Same deletion, with a hint and different markup: a duplicate of the first
+        cloze(sentence.format(a='{{c1::<i>Mitochondria</i>::organelle}}', b='ATP')),
+    ]
+    kept, report = dedupe(cards)
+
+    assert kept == cards[:2]
+    assert report['droppedCards'][0]['duplicateOf'] == 0
+
+def test_cloze_and_basic_cards_are_never_merged():
+    cards = [
+        basic('The mitochondria is the powerhouse of the cell', answer='and makes ATP'),
+        cloze('The {{c1::mitochondria}} is the powerhouse of the cell and makes ATP'),
+    ]
+    kept, _ = dedupe(cards, threshold=0.5)
+    assert kept == cards
+
+def test_cards_of_different_batch_decks_are_never_merged():
+    cards = [basic('What does the mitochondria do?', deck=0), basic('What does the mitochondria do?', deck=1)]
+    kept, _ = dedupe(cards)
+    assert kept == cards
+
+def test_empty_cards_are_kept():
+    cards = [basic('', answer=''), basic('', answer='')]
+    kept, report = dedupe(cards)
+    assert kept == cards
+    assert report['dropped'] == 0
+
+@pytest.mark.parametrize('threshold', [0.5, 0.7, 0.8, 0.9, 0.95])
+def test_lsh_bands_split_the_signature_below_the_threshold(threshold):
+    bands, rows = anki_generator.lsh_bands(threshold)
+    assert bands * rows == anki_generator.MINHASH_PERMUTATIONS
+    assert (1 / bands) ** (1 / rows) <= threshold
+
+def test_minhash_estimates_jaccard_similarity():
+    words = anki_generator.normalized_words(LONG_ANSWER)
+    signature = anki_generator.minhash_signature(words)
+    assert anki_generator.minhash_signature(list(words)) == signature
+    assert anki_generator.minhash_signature([]) is None
+
+    other = anki_generator.minhash_signature(anki_generator.normalized_words('Ribosomes translate messenger RNA into proteins'))
+    agreement = sum(a == b for a, b in zip(signature, other)) / anki_generator.MINHASH_PERMUTATIONS
+    assert agreement < 0.2
+
+def test_package_build_drops_duplicates(tmp_path):
+    data = {
+        'deckName': 'Deck',
+        'cards': [
+            {'type': 'basic', 'question': 'What does the mitochondria do?', 'answer': LONG_ANSWER, 'tags': ['a']},
+            {'type': 'basic', 'question': 'What does the mitochondria do?', 'answer': LONG_ANSWER, 'tags': ['b']},
+        ],
+    }
+    result = anki_generator.create_anki_package(data, str(tmp_path / 'deck.apkg'), str(tmp_path),
+                                                backend='sqlite', dedupe=0.8)
+    assert result['success']
+    assert result['stats']['standard'] == 1
+    assert result['stats']['dedupe']['dropped'] == 1
@@ -0,0 +1,165 @@
+"""FieldCompactor: hoisting repeated <style> blocks into the model CSS"""
+import os
+import sys
+import json
+import sqlite3
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import anki_generator  # noqa: E402
+from anki_generator import FieldCompactor, basic_model, cloze_model  # noqa: E402
+
+def packaged_collection(package_path):
+    """(CSS by model ID, note field strings) of a package's collection"""
+    with zipfile.ZipFile(package_path) as package:
+        collection = package.read('collection.anki2')
+    db_path = f'{package_path}.anki2'
+    with open(db_path, 'wb') as f:
+        f.write(collection)
+    conn = sqlite3.connect(db_path)
+    try:
+        models = json.loads(conn.execute('SELECT models FROM col').fetchone()[0])
+        fields = sorted(flds for (flds,) in conn.execute('SELECT flds FROM notes'))
+    finally:
+        conn.close()
+        os.remove(db_path)
+    return {int(model_id): model['css'] for model_id, model in models.items()}, fields
+
+STYLE = '<style>\n  .card  { color: red; }\n  /* theme */\n</style>'
+OTHER_STYLE = '<style>.term { font-weight: bold }</style>'
+
+def test_a_block_is_hoisted_once_a_second_note_repeats_it():
+    compactor = FieldCompactor()
+    first = compactor.compact(basic_model, [f'{STYLE}<p>One</p>', 'a'])
+    second = compactor.compact(basic_model, [f'{STYLE}<p>Two</p>', 'b'])
+    third = compactor.compact(basic_model, [f'{STYLE}<p>Three</p>', 'c'])
+
+    # The first copy stays inline (minified), since it was the only one when that note was built
+    assert first == ['<style>.card{color:red}</style><p>One</p>', 'a']
+    assert second == ['<p>Two</p>', 'b']
+    assert third == ['<p>Three</p>', 'c']
+    assert compactor.styles == {basic_model.model_id: ['.card{color:red}']}
+    assert compactor.stats['sharedStyles'] == 1
+    assert compactor.stats['styleBlocksHoisted'] == 2
+
+def test_blocks_used_by_a_single_note_stay_inline():
+    compactor = FieldCompactor()
+    # Repeated within one note's fields isn't repeated across notes
+    fields = compactor.compact(basic_model, [f'{OTHER_STYLE}Q', f'{OTHER_STYLE}A'])
+    compactor.compact(basic_model, [f'{STYLE}Q', 'A'])
+
+    assert fields == ['<style>.term{font-weight:bold}</style>Q', '<style>.term{font-weight:bold}</style>A']
+    assert compactor.styles.get(basic_model.model_id, []) == []
+    assert compactor.stats['sharedStyles'] == 0
+
+def test_blocks_are_registered_on_the_model_of_the_note_that_shares_them():
+    compactor = FieldCompactor()
+    compactor.compact(basic_model, [f'{STYLE}Q', 'A'])
+    compactor.compact(cloze_model, [f'{STYLE}{{{{c1::Text}}}}', ''])
+
+    assert compactor.styles[cloze_model.model_id] == ['.card{color:red}']
+    assert compactor.styles[basic_model.model_id] == []
+    # Once shared, the block is hoisted from notes of either model
+    assert compactor.compact(basic_model, [f'{STYLE}Q2', 'A']) == ['Q2', 'A']
+    assert compactor.styles[basic_model.model_id] == ['.card{color:red}']
+
+def test_shared_blocks_are_capped():
+    compactor = FieldCompactor(max_shared_styles=2)
+    styles = [f'<style>.c{i} {{ color: red }}</style>' for i in range(4)]
+    for _ in range(2):
+        for style in styles:
+            compactor.compact(basic_model, [f'{style}Q', 'A'])
+
+    assert compactor.styles[basic_model.model_id] == ['.c0{color:red}', '.c1{color:red}']
+    # Past the cap, further blocks stay in every note that carries them
+    assert compactor.compact(basic_model, [f'{styles[3]}Q', 'A']) == ['<style>.c3{color:red}</style>Q', 'A']
+    assert compactor.compact(basic_model, [f'{styles[0]}Q', 'A']) == ['Q', 'A']
+
+def test_without_shared_styles_fields_are_only_minified():
+    compactor = anki_generator.field_compactor(True, keep_styles=True)
+    for _ in range(3):
+        fields = compactor.compact(basic_model, [f'{STYLE}  <p>Text   here</p>\n', 'A'])
+    assert fields == ['<style>.card{color:red}</style> <p>Text here</p>', 'A']
+    assert compactor.styles[basic_model.model_id] == []
+
+def test_empty_blocks_are_dropped():
+    compactor = FieldCompactor()
+    assert compactor.compact(basic_model, ['<style> /* nothing */ </style>Q', 'A']) == ['Q', 'A']
+    assert compactor.stats['bytesAfter'] < compactor.stats['bytesBefore']
+
+def test_package_models_carry_the_hoisted_css(tmp_path):
+    data = {
+        'deckName': 'Deck',
+        'cards': [{'type': 'basic', 'question': f'{STYLE}Question {i}', 'answer': 'A'} for i in range(3)],
+    }
+    for backend in ('genanki', 'sqlite'):
+        output_path = str(tmp_path / f'{backend}.apkg')
+        result = anki_generator.create_anki_package(data, output_path, str(tmp_path), backend=backend)
+        assert result['success']
+        assert result['stats']['compaction']['styleBlocksHoisted'] == 2
+        css, fields = packaged_collection(output_path)
+        assert css[basic_model.model_id] == '.card{color:red}'
+        assert css.get(cloze_model.model_id, '') == ''
+        assert fields == ['<style>.card{color:red}</style>Question 0\x1fA', 'Question 1\x1fA', 'Question 2\x1fA']
+
+def styled_cards(style, count=3, key='page'):
+    return [{'type': 'basic', 'question': f'{style}Question {i}', 'answer': 'A', 'sourceKey': f'{key}/{i}'}
+            for i in range(count)]
+
+def test_incremental_builds_drop_styles_no_note_uses(tmp_path):
+    def build(cards, name):
+        output_path = str(tmp_path / name)
+        data = {'deckName': 'Deck', 'deckId': 1234, 'cards': cards}
+        assert anki_generator.create_anki_package(data, output_path, str(tmp_path),
+                                                  cache_dir=str(tmp_path / 'cache'))['success']
+        return packaged_collection(output_path)
+
+    css, _ = build(styled_cards(STYLE), 'first.apkg')
+    assert css[basic_model.model_id] == '.card{color:red}'
+
+    # Reused notes still rely on the block hoisted by the first build
+    cards = styled_cards(STYLE)
+    cards[0]['answer'] = 'Edited'
+    css, fields = build(cards, 'second.apkg')
+    assert css[basic_model.model_id] == '.card{color:red}'
+    assert 'Question 1\x1fA' in fields
+
+    css, _ = build(styled_cards(OTHER_STYLE), 'third.apkg')
+    assert css[basic_model.model_id] == '.term{font-weight:bold}'
+
+def test_appended_packages_drop_styles_no_note_uses(tmp_path):
+    base_path = str(tmp_path / 'base.apkg')
+    data = {'deckName': 'Deck', 'deckId': 1234, 'cards': styled_cards(STYLE)}
+    assert anki_generator.create_anki_package(data, base_path, str(tmp_path))['success']
+
+    # Notes of another page keep the old block in use
+    output_path = str(tmp_path / 'added.apkg')
+    data = {'deckName': 'Deck', 'deckId': 1234, 'cards': styled_cards(OTHER_STYLE, key='other')}
+    assert anki_generator.create_anki_package(data, output_path, str(tmp_path), append_to=base_path)['success']
+    css, _ = packaged_collection(output_path)
+    assert css[basic_model.model_id] == '.card{color:red}\n.term{font-weight:bold}'
+
+    # Once every note using it is restyled, the block goes
+    output_path = str(tmp_path / 'restyled.apkg')
+    data = {'deckName': 'Deck', 'deckId': 1234, 'cards': styled_cards(OTHER_STYLE)}
+    assert anki_generator.create_anki_package(data, output_path, str(tmp_path), append_to=base_path)['success']
+    css, fields = packaged_collection(output_path)
+    assert css[basic_model.model_id] == '.term{font-weight:bold}'
+    assert fields[0] == '<style>.term{font-weight:bold}</style>Question 0\x1fA'
+
+def test_notes_without_style_records_keep_every_block():
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    anki_generator.init_collection(cursor, 1234, 'Deck', 0)
+    cursor.execute(anki_generator.NOTE_INSERT_SQL,
+                   anki_generator.note_row(1, basic_model, ['Q', 'A'], [], 'a', 0, anki_generator.note_styles_data([])))
+    anki_generator.rebuild_model_css(cursor, {basic_model.model_id: ['.card{color:red}']})
+    models = json.loads(cursor.execute('SELECT models FROM col').fetchone()[0])
+    assert models[str(basic_model.model_id)]['css'] == ''
+
+    # A note written before notes recorded their styles may need any of them
+    cursor.execute(anki_generator.NOTE_INSERT_SQL, anki_generator.note_row(2, basic_model, ['Q2', 'A'], [], 'b', 0, ''))
+    anki_generator.rebuild_model_css(cursor, {basic_model.model_id: ['.card{color:red}']})
+    models = json.loads(cursor.execute('SELECT models FROM col').fetchone()[0])
+    assert models[str(basic_model.model_id)]['css'] == '.card{color:red}'
+    conn.close()
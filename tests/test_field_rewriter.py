@@ -0,0 +1,54 @@
+"""FieldRewriter: sanitizing card fields and pointing image references at media names"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import anki_generator  # noqa: E402
+
+@pytest.fixture
+def rewriter(tmp_path):
+    (tmp_path / 'images').mkdir()
+    (tmp_path / 'images' / 'diagram.png').write_bytes(b'\x89PNG diagram')
+    return anki_generator.FieldRewriter(anki_generator.MediaStore(), str(tmp_path))
+
+@pytest.mark.parametrize('field, expected', [
+    # Removing the inner element joins the outer halves into a new <script> tag
+    ('<scr<script></script>ipt>alert(1)</script>', 'alert(1)'),
+    # Removing the URL attribute joins the halves of an event handler
+    ('<a o/href="javascript:x"nclick=alert(1)>hi</a>', '<a>hi</a>'),
+    ('<div o/data="javascript:1"nmouseover=alert(1)>', '<div>'),
+    # A quoted ">" inside the attribute doesn't end the tag
+    ('<iframe srcdoc="<script>alert(1)</script>">', ''),
+    ('<script a="b>alert(1)</script>', 'alert(1)'),
+    ('<svg/onload=alert(1)>', '<svg>'),
+    ('<a href="jav&#x09;ascript:alert(1)">x</a>', '<a>x</a>'),
+    ('<img src="javascript:alert(1)">text', 'text'),
+])
+def test_unsafe_markup_is_removed(rewriter, field, expected):
+    assert rewriter.rewrite(field) == expected
+    assert rewriter.stats['unsafeRemoved'] > 0
+
+def test_safe_markup_is_kept(rewriter):
+    field = '<p style="color:red" title="a > b">ok</p><a href="https://example.com/">link</a>'
+    assert rewriter.rewrite(field) == field
+    assert rewriter.stats['unsafeRemoved'] == 0
+
+def test_image_references_point_at_media_names(rewriter):
+    field = 'Before <img src="images/diagram.png" onerror=alert(1)> ![chart](images/diagram.png) <img src="https://x/y.png">'
+    assert rewriter.rewrite(field) == (
+        'Before <img src="diagram.png"> <img src="diagram.png" alt="chart"> <img src="https://x/y.png">')
+    assert rewriter.note_media == {'diagram.png'}
+    assert rewriter.stats['references'] == 2
+    assert rewriter.media.path_for('diagram.png').endswith(os.path.join('images', 'diagram.png'))
+
+def test_missing_image_keeps_its_basename(rewriter):
+    assert rewriter.rewrite('<img src="images/gone.png">') == '<img src="gone.png">'
+    assert rewriter.stats['missingReferences'] == 1
+
+def test_register_resolves_the_same_names_as_rewrite(rewriter):
+    card = anki_generator.Card.coerce({
+        'type': 'basic', 'question': '<im<script></script>g src="images/diagram.png">', 'answer': 'a'})
+    rewriter.register(card)
+    assert rewriter.resolved_names() == {'images/diagram.png': 'diagram.png'}
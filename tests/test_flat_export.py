@@ -0,0 +1,44 @@
+"""Flat (TSV/CSV) exports, read back the way Anki's text importer reads them"""
+import os
+import sys
+import csv
+import itertools
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import anki_generator  # noqa: E402
+
+def hash_guid_key():
+    """A source key whose GUID starts with "#"; about one key in 3,000 has one"""
+    return next(key for key in (f'page-{i}' for i in itertools.count())
+                if anki_generator.guid_for(key).startswith('#'))
+
+def anki_rows(path, separator):
+    """Header settings and rows, skipping every line that starts with "#" as Anki does"""
+    with open(path, encoding='utf-8', newline='') as f:
+        lines = f.read().splitlines(keepends=True)
+    headers = dict(line[1:].rstrip('\n').split(':', 1) for line in lines if line.startswith('#'))
+    return headers, list(csv.reader((line for line in lines if not line.startswith('#')), delimiter=separator))
+
+@pytest.mark.parametrize('flat_format, separator', [('tsv', '\t'), ('csv', ',')])
+def test_guid_starting_with_hash_survives_import(tmp_path, flat_format, separator):
+    key = hash_guid_key()
+    data = {
+        'deckName': 'Notebook::Page',
+        'cards': [
+            {'type': 'basic', 'question': 'Q1', 'answer': 'A1', 'sourceKey': key, 'tags': ['onenote']},
+            {'type': 'cloze', 'text': 'The {{c1::mitochondria}} makes ATP', 'notes': 'x, "y"', 'sourceKey': 'other'},
+        ],
+    }
+    output_path = str(tmp_path / f'deck.{flat_format}')
+    result = anki_generator.create_anki_package(data, output_path, str(tmp_path), backend=flat_format)
+    
+    assert result['success']
+    headers, rows = anki_rows(output_path, separator)
+    assert headers['guid column'] == '1'
+    assert rows == [
+        [anki_generator.guid_for(key), 'Basic', 'Notebook::Page', 'Q1', 'A1', 'onenote'],
+        [anki_generator.guid_for('other'), 'Cloze', 'Notebook::Page', 'The {{c1::mitochondria}} makes ATP',
+         'x, "y"', ''],
+    ]
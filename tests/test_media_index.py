@@ -0,0 +1,212 @@
+"""Media index garbage collection: expiry, references, the byte budget and dry runs"""
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import media_index  # noqa: E402
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'media_index.py')
+NOW = 1_700_000_000
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+class Tree:
+    """Image, package and page cache folders with files of chosen sizes and ages"""
+
+    def __init__(self, root):
+        self.root = root
+        self.dirs = {kind: root / folder for kind, folder in
+                     (('image', 'images'), ('package', 'packages'), ('page', 'pages'))}
+        for folder in self.dirs.values():
+            folder.mkdir()
+        self.index = media_index.MediaIndex(str(root / 'media.sqlite'))
+
+    def file(self, kind, name, size=100, age=0):
+        path = self.dirs[kind] / name
+        path.write_bytes(b'\0' * size)
+        os.utime(path, (NOW - age, NOW - age))
+        return str(path)
+
+    def roots(self):
+        return [{'path': str(folder), 'kind': kind} for kind, folder in self.dirs.items()]
+
+    def collect(self, **options):
+        options.setdefault('dry_run', False)
+        return self.index.collect(self.roots(), now=NOW, **options)
+
+    def indexed(self):
+        files = {path for (path,) in self.index.conn.execute('SELECT path FROM files')}
+        refs = set(self.index.conn.execute('SELECT owner, path FROM refs'))
+        return files, refs
+
+@pytest.fixture
+def tree(tmp_path):
+    tree = Tree(tmp_path)
+    yield tree
+    tree.index.close()
+
+def test_referenced_and_recent_images_are_kept(tree):
+    used = tree.file('image', 'used.png', age=10 * DAY)
+    orphan = tree.file('image', 'orphan.png', age=2 * HOUR)
+    fresh = tree.file('image', 'fresh.png', age=10)
+    package = tree.file('package', 'deck.apkg')
+    tree.index.record(package, 'package', [used], now=NOW - 10 * DAY)
+
+    report = tree.collect()
+    assert os.path.exists(used) and os.path.exists(fresh) and os.path.exists(package)
+    assert not os.path.exists(orphan)
+    assert report['deleted'] == {'expired': 0, 'unreferenced': 1, 'budget': 0}
+    assert report['files'] == [{'path': orphan, 'kind': 'image', 'bytes': 100, 'reason': 'unreferenced'}]
+
+def test_expired_owners_go_and_release_their_images(tree):
+    image = tree.file('image', 'old.png', age=20 * DAY)
+    shared = tree.file('image', 'shared.png', age=20 * DAY)
+    old_package = tree.file('package', 'old.apkg', age=20 * DAY)
+    new_package = tree.file('package', 'new.apkg', age=20 * DAY)
+    tree.index.record(old_package, 'package', [image, shared], now=NOW - 20 * DAY)
+    # Recorded recently, so last used now even though the file is old
+    tree.index.record(new_package, 'package', [shared], now=NOW - HOUR)
+
+    report = tree.collect(max_age_seconds=14 * DAY)
+    assert report['deleted'] == {'expired': 1, 'unreferenced': 1, 'budget': 0}
+    assert not os.path.exists(old_package) and not os.path.exists(image)
+    assert os.path.exists(new_package) and os.path.exists(shared)
+
+    files, refs = tree.indexed()
+    assert old_package not in files and image not in files
+    assert refs == {(new_package, shared)}
+
+def test_touch_keeps_an_owner_from_expiring(tree):
+    package = tree.file('package', 'served.apkg', age=20 * DAY)
+    tree.index.record(package, 'package', [], now=NOW - 20 * DAY)
+    tree.index.touch([package], now=NOW - DAY)
+
+    assert tree.collect(max_age_seconds=14 * DAY)['deleted']['expired'] == 0
+    assert os.path.exists(package)
+
+def test_budget_evicts_least_recently_used_owners_with_their_images(tree):
+    images = [tree.file('image', f'{i}.png', size=1000, age=2 * DAY) for i in range(3)]
+    packages = [tree.file('package', f'{i}.apkg', size=1000, age=(3 - i) * DAY) for i in range(3)]
+    for package, image in zip(packages, images):
+        tree.index.record(package, 'package', [image], now=os.path.getmtime(package))
+    page = tree.file('page', 'page.json', size=500, age=DAY // 2)
+
+    report = tree.collect(budget_bytes=3000)
+    # Oldest first: package 0 and its image, then package 1 and its image
+    assert report['deleted'] == {'expired': 0, 'unreferenced': 2, 'budget': 2}
+    assert [os.path.exists(path) for path in packages] == [False, False, True]
+    assert [os.path.exists(path) for path in images] == [False, False, True]
+    assert os.path.exists(page)
+    assert report['remainingBytes'] == 2500
+    assert not report['overBudget']
+    assert report['bytesByReason'] == {'expired': 0, 'unreferenced': 2000, 'budget': 2000}
+    assert report['deletedByKind'] == {'image': {'files': 2, 'bytes': 2000}, 'package': {'files': 2, 'bytes': 2000}}
+
+def test_budget_keeps_images_a_remaining_owner_references(tree):
+    image = tree.file('image', 'shared.png', size=500, age=2 * DAY)
+    package = tree.file('package', 'deck.apkg', size=1000, age=DAY)
+    page = tree.file('page', 'page.json', size=1000, age=DAY)
+    tree.index.record(package, 'package', [image], now=NOW - DAY)
+    tree.index.record(page, 'page', [image], now=NOW - HOUR)
+
+    report = tree.collect(budget_bytes=1600)
+    # Evicting the package is enough, and the page cache still needs the image
+    assert report['deleted'] == {'expired': 0, 'unreferenced': 0, 'budget': 1}
+    assert not os.path.exists(package)
+    assert os.path.exists(image) and os.path.exists(page)
+    assert tree.indexed()[1] == {(page, image)}
+
+def test_dry_run_reports_without_deleting(tree):
+    orphan = tree.file('image', 'orphan.png', age=2 * DAY)
+    package = tree.file('package', 'old.apkg', age=30 * DAY)
+    image = tree.file('image', 'used.png', age=30 * DAY)
+    tree.index.record(package, 'package', [image], now=NOW - 30 * DAY)
+    before = tree.indexed()
+
+    report = tree.collect(max_age_seconds=14 * DAY, dry_run=True)
+    assert report['dryRun']
+    assert report['deleted'] == {'expired': 1, 'unreferenced': 2, 'budget': 0}
+    assert report['bytesFreed'] == 300
+    assert all(os.path.exists(path) for path in (orphan, package, image))
+    assert tree.indexed() == before
+
+    # The real run frees exactly what the dry run reported
+    real = tree.collect(max_age_seconds=14 * DAY)
+    assert real['files'] == report['files']
+    assert not any(os.path.exists(path) for path in (orphan, package, image))
+    assert tree.indexed() == (set(), set())
+
+def test_owners_deleted_elsewhere_release_their_references(tree):
+    image = tree.file('image', 'used.png', age=2 * DAY)
+    package = tree.file('package', 'deck.apkg')
+    tree.index.record(package, 'package', [image], now=NOW - 2 * DAY)
+    os.remove(package)
+
+    report = tree.collect()
+    assert report['staleOwners'] == 1
+    assert not os.path.exists(image)
+    assert tree.indexed() == (set(), set())
+
+def test_companion_files_go_with_their_owner(tree):
+    export = tree.file('package', 'deck.tsv', age=30 * DAY)
+    media_zip = tree.file('package', 'deck.media.zip', age=30 * DAY)
+    tree.index.record(export, 'package', [media_zip], kind='package', now=NOW - 30 * DAY)
+
+    # Expiring the export takes its media zip along
+    report = tree.collect(max_age_seconds=14 * DAY, dry_run=True)
+    assert {entry['path'] for entry in report['files']} == {export, media_zip}
+    assert report['deleted']['expired'] == 2
+
+    # While the export is in use, its zip stays however old it is
+    tree.index.touch([export], now=NOW)
+    report = tree.collect(max_age_seconds=14 * DAY, dry_run=True)
+    assert report['files'] == []
+
+def test_hidden_and_partial_files_are_ignored(tree):
+    for name in ('.hidden.png', 'download.png.part', 'write.png.tmp'):
+        tree.file('image', name, age=30 * DAY)
+    report = tree.collect()
+    assert report['scannedFiles'] == 0
+    assert len(os.listdir(tree.dirs['image'])) == 3
+
+def test_missing_roots_are_skipped(tree, tmp_path):
+    report = tree.index.collect([{'path': str(tmp_path / 'missing'), 'kind': 'image'}], dry_run=False, now=NOW)
+    assert report['scannedFiles'] == 0
+
+def test_report_lists_at_most_report_limit_files(tree):
+    for i in range(5):
+        tree.file('image', f'{i}.png', age=2 * DAY)
+    report = tree.index.collect(tree.roots(), dry_run=True, report_limit=2, now=NOW)
+    assert report['deleted']['unreferenced'] == 5
+    assert len(report['files']) == 2
+
+def test_command_line_runs_ops_in_order(tree):
+    image = tree.file('image', 'used.png', age=2 * DAY)
+    orphan = tree.file('image', 'orphan.png', age=2 * DAY)
+    package = tree.file('package', 'deck.apkg')
+    request = {
+        'db': str(tree.root / 'cli.sqlite'),
+        'ops': [
+            {'op': 'record', 'owner': package, 'ownerKind': 'package', 'paths': [image]},
+            {'op': 'gc', 'roots': tree.roots(), 'graceSeconds': 0, 'dryRun': False},
+            {'op': 'release', 'owner': package},
+        ],
+    }
+    result = subprocess.run([sys.executable, SCRIPT], input=json.dumps(request), capture_output=True, text=True,
+                            timeout=60)
+
+    response = json.loads(result.stdout)
+    assert response['success']
+    record, gc, release = response['results']
+    assert record == {'owner': package, 'references': 1}
+    assert gc['deleted']['unreferenced'] == 1
+    assert release == {'released': 1}
+    assert os.path.exists(image) and not os.path.exists(orphan)
+
+def test_unknown_ops_fail(tree):
+    with pytest.raises(ValueError):
+        media_index.handle_op(tree.index, {'op': 'vacuum'})
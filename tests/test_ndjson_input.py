@@ -0,0 +1,54 @@
+"""Reading deck data from JSON and streaming NDJSON input files"""
+import os
+import sys
+import json
+import builtins
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import anki_generator  # noqa: E402
+
+@pytest.fixture
+def opened_files(monkeypatch):
+    """Every file process_input_data opens"""
+    files = []
+
+    def tracking_open(*args, **kwargs):
+        f = builtins.open(*args, **kwargs)
+        files.append(f)
+        return f
+    monkeypatch.setattr(anki_generator, 'open', tracking_open, raising=False)
+    return files
+
+def test_ndjson_cards_are_read_lazily_and_the_file_closed_after(tmp_path, opened_files):
+    path = tmp_path / 'deck.ndjson'
+    path.write_text('{"deckName": "Deck", "images": []}\n'
+                    '{"type": "basic", "question": "Q1", "answer": "A1"}\n'
+                    '\n'
+                    'not json\n'
+                    '{"type": "basic", "question": "Q2", "answer": "A2"}\n', encoding='utf-8')
+
+    data = anki_generator.process_input_data(str(path))
+    assert data['deckName'] == 'Deck'
+    assert not opened_files[0].closed
+    assert [card['question'] for card in data['cards']] == ['Q1', 'Q2']
+    assert opened_files[0].closed
+
+@pytest.mark.parametrize('header', ['\n', '{"deckName": ', '["not", "a", "header"]\n'])
+def test_a_bad_header_closes_the_file(tmp_path, opened_files, header):
+    path = tmp_path / 'deck.jsonl'
+    path.write_text(header + '{"type": "basic", "question": "Q", "answer": "A"}\n', encoding='utf-8')
+
+    with pytest.raises((ValueError, TypeError)):
+        anki_generator.process_input_data(str(path))
+    assert len(opened_files) == 1
+    assert opened_files[0].closed
+
+def test_json_input_is_read_whole(tmp_path, opened_files):
+    path = tmp_path / 'deck.json'
+    path.write_text(json.dumps({'deckName': 'Deck', 'cards': [{'type': 'basic', 'question': 'Q', 'answer': 'A'}]}))
+
+    data = anki_generator.process_input_data(str(path))
+    assert data['cards'] == [{'type': 'basic', 'question': 'Q', 'answer': 'A'}]
+    assert opened_files[0].closed
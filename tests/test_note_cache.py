@@ -0,0 +1,138 @@
+"""Incremental builds from the per-deck note cache, and pruning of old caches"""
+import os
+import sys
+import sqlite3
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import anki_generator  # noqa: E402
+from anki_generator import NoteCache, prune_note_caches  # noqa: E402
+
+DAY = 24 * 60 * 60
+
+def packaged_fields(package_path):
+    """Field strings of the notes in a package, sorted"""
+    with zipfile.ZipFile(package_path) as package:
+        collection = package.read('collection.anki2')
+    db_path = f'{package_path}.anki2'
+    with open(db_path, 'wb') as f:
+        f.write(collection)
+    conn = sqlite3.connect(db_path)
+    try:
+        return sorted(flds for (flds,) in conn.execute('SELECT flds FROM notes'))
+    finally:
+        conn.close()
+        os.remove(db_path)
+
+def cards(count, edited=None):
+    return [{'type': 'basic', 'question': f'Question {i}', 'sourceKey': f'page/{i}',
+             'answer': 'Edited answer' if i == edited else f'Answer {i}'} for i in range(count)]
+
+@pytest.fixture
+def build(tmp_path):
+    cache_dir = tmp_path / 'cache'
+    runs = iter(range(100))
+
+    def build(card_list, compact=True):
+        output_path = str(tmp_path / f'deck-{next(runs)}.apkg')
+        data = {'deckName': 'Deck', 'deckId': 1234, 'cards': card_list}
+        result = anki_generator.create_anki_package(data, output_path, str(tmp_path), cache_dir=str(cache_dir),
+                                                    compact=compact)
+        assert result['success']
+        return result['stats'], output_path
+    return build
+
+def test_unchanged_cards_are_reused(build):
+    stats, _ = build(cards(5))
+    assert stats['cache'] == {'reused': 0, 'rebuilt': 0, 'added': 5, 'removed': 0, 'evicted': 0}
+
+    stats, output_path = build(cards(5))
+    assert stats['cache']['reused'] == 5
+    assert stats['cache']['added'] == stats['cache']['rebuilt'] == 0
+    assert stats['standard'] == 5
+    assert len(packaged_fields(output_path)) == 5
+
+def test_only_edited_cards_are_rebuilt(build, tmp_path):
+    _, first_path = build(cards(5))
+    stats, output_path = build(cards(5, edited=2))
+    assert stats['cache']['reused'] == 4
+    assert stats['cache']['rebuilt'] == 1
+
+    fields = packaged_fields(output_path)
+    assert len(fields) == 5
+    assert any('Edited answer' in flds for flds in fields)
+    assert not any('Answer 2' in flds for flds in fields)
+    assert len(set(fields) & set(packaged_fields(first_path))) == 4
+
+def test_removed_and_new_cards(build):
+    build(cards(5))
+    card_list = cards(5)[1:] + [{'type': 'basic', 'question': 'New', 'answer': 'card', 'sourceKey': 'page/new'}]
+    stats, output_path = build(card_list)
+    assert stats['cache']['removed'] == 1
+    assert stats['cache']['added'] == 1
+    assert stats['cache']['reused'] == 4
+    assert not any('Question 0' in flds for flds in packaged_fields(output_path))
+
+def test_incremental_build_matches_a_full_build(build, tmp_path):
+    build(cards(5))
+    _, incremental_path = build(cards(5, edited=3))
+
+    full_path = str(tmp_path / 'full.apkg')
+    data = {'deckName': 'Deck', 'deckId': 1234, 'cards': cards(5, edited=3)}
+    assert anki_generator.create_anki_package(data, full_path, str(tmp_path), backend='sqlite')['success']
+    assert packaged_fields(incremental_path) == packaged_fields(full_path)
+
+def make_cache(cache_dir, key, size, age, now):
+    """A NoteCache whose files total about size bytes and were last used age seconds before now"""
+    cache = NoteCache(str(cache_dir), key)
+    for path in (cache.db_path, cache.index_path):
+        with open(path, 'wb') as f:
+            f.write(b'\0' * (size // 2))
+        os.utime(path, (now - age, now - age))
+    return cache
+
+def exists(cache):
+    return os.path.exists(cache.db_path) or os.path.exists(cache.index_path)
+
+def test_prune_evicts_expired_caches(tmp_path):
+    now = 1_700_000_000
+    keep = make_cache(tmp_path, 'current', 1000, 100 * DAY, now)
+    old = make_cache(tmp_path, 'old', 1000, 31 * DAY, now)
+    recent = make_cache(tmp_path, 'recent', 1000, DAY, now)
+
+    assert prune_note_caches(str(tmp_path), keep, max_bytes=0, max_age_seconds=30 * DAY, now=now) == 1
+    assert not exists(old)
+    assert not os.path.exists(old.lock_path)
+    # The cache just written is kept however old its files look
+    assert exists(keep) and exists(recent)
+
+def test_prune_evicts_least_recently_used_over_the_budget(tmp_path):
+    now = 1_700_000_000
+    keep = make_cache(tmp_path, 'current', 1000, 0, now)
+    oldest = make_cache(tmp_path, 'oldest', 1000, 3 * DAY, now)
+    older = make_cache(tmp_path, 'older', 1000, 2 * DAY, now)
+    newer = make_cache(tmp_path, 'newer', 1000, DAY, now)
+
+    assert prune_note_caches(str(tmp_path), keep, max_bytes=2500, max_age_seconds=0, now=now) == 2
+    assert not exists(oldest) and not exists(older)
+    assert exists(newer) and exists(keep)
+
+def test_prune_skips_caches_locked_by_a_running_build(tmp_path):
+    now = 1_700_000_000
+    keep = make_cache(tmp_path, 'current', 1000, 0, now)
+    busy = make_cache(tmp_path, 'busy', 1000, 60 * DAY, now)
+    idle = make_cache(tmp_path, 'idle', 1000, 60 * DAY, now)
+
+    with busy.locked():
+        assert prune_note_caches(str(tmp_path), keep, max_bytes=0, max_age_seconds=30 * DAY, now=now) == 1
+    assert exists(busy)
+    assert not exists(idle)
+
+def test_prune_ignores_other_files(tmp_path):
+    now = 1_700_000_000
+    keep = make_cache(tmp_path, 'current', 1000, 0, now)
+    (tmp_path / 'unrelated.anki2').write_bytes(b'\0' * 10000)
+    assert prune_note_caches(str(tmp_path), keep, max_bytes=1, max_age_seconds=0, now=now) == 0
+    assert (tmp_path / 'unrelated.anki2').exists()
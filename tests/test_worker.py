@@ -0,0 +1,95 @@
+"""Worker mode: newline-delimited JSON requests and responses, with progress records"""
+import io
+import os
+import sys
+import json
+import zipfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import anki_generator  # noqa: E402
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'anki_generator.py')
+
+def serve(*requests):
+    """(responses, progress records) from running the worker over the given requests"""
+    lines = [request if isinstance(request, str) else json.dumps(request) for request in requests]
+    output, progress = io.StringIO(), io.StringIO()
+    anki_generator.run_worker(io.StringIO('\n'.join(lines) + '\n'), output, progress)
+    return ([json.loads(line) for line in output.getvalue().splitlines()],
+            [json.loads(line) for line in progress.getvalue().splitlines()])
+
+def generate_request(tmp_path, request_id, **fields):
+    return {
+        'id': request_id,
+        'op': 'generate',
+        'output': str(tmp_path / f'{request_id}.apkg'),
+        'data': {'deckName': 'Deck', 'cards': [{'type': 'basic', 'question': 'Q', 'answer': 'A'}]},
+        **fields,
+    }
+
+def test_each_request_gets_one_response_tagged_with_its_id(tmp_path):
+    responses, progress = serve(
+        {'id': 1, 'op': 'ping'},
+        '',
+        generate_request(tmp_path, 2, backend='sqlite'),
+        generate_request(tmp_path, 3),
+    )
+
+    assert [response['id'] for response in responses] == [1, 2, 3]
+    assert responses[0]['pong'] and responses[0]['pid'] == os.getpid()
+    for response in responses[1:]:
+        assert response['success']
+        assert response['stats']['standard'] == 1
+        assert zipfile.is_zipfile(response['path'])
+    # Progress records of both builds share the stream, each carrying its request's id
+    assert {record['id'] for record in progress} == {2, 3}
+    assert all(record['event'] == 'progress' for record in progress)
+    assert [record['stage'] for record in progress if record['id'] == 2][-1] == 'done'
+
+def test_failures_are_reported_and_the_worker_carries_on(tmp_path):
+    responses, _ = serve(
+        'not json',
+        {'id': 'a', 'op': 'unknown'},
+        {'id': 'b', 'op': 'generate', 'input': str(tmp_path / 'missing.json'), 'output': str(tmp_path / 'b.apkg')},
+        {'id': 'c', 'op': 'ping'},
+    )
+
+    assert responses[0] == {'id': None, 'success': False, 'error': responses[0]['error']}
+    assert responses[1]['id'] == 'a' and not responses[1]['success']
+    assert 'Unknown worker op' in responses[1]['error']
+    assert responses[2]['id'] == 'b' and not responses[2]['success']
+    assert responses[3]['id'] == 'c' and responses[3]['success']
+
+def test_shutdown_is_acknowledged_and_stops_the_worker():
+    responses, _ = serve({'id': 1, 'op': 'shutdown'}, {'id': 2, 'op': 'ping'})
+    assert responses == [{'id': 1, 'success': True}]
+
+def test_generate_reads_input_files(tmp_path):
+    input_path = tmp_path / 'deck.ndjson'
+    input_path.write_text('{"deckName": "Deck"}\n{"type": "basic", "question": "Q", "answer": "A"}\n')
+    request = generate_request(tmp_path, 1, input=str(input_path))
+    del request['data']
+
+    responses, _ = serve(request)
+    assert responses[0]['success']
+    assert responses[0]['timings']['stages']['load']['seconds'] >= 0
+
+def test_progress_consumer_going_away_doesnt_fail_the_build(tmp_path):
+    progress = io.StringIO()
+    progress.close()
+    output = io.StringIO()
+    anki_generator.run_worker(io.StringIO(json.dumps(generate_request(tmp_path, 1)) + '\n'), output, progress)
+    assert json.loads(output.getvalue())['success']
+
+def test_worker_process_keeps_stdout_for_responses(tmp_path):
+    requests = [generate_request(tmp_path, 1), {'id': 2, 'op': 'shutdown'}]
+    result = subprocess.run([sys.executable, SCRIPT, '--worker'], input='\n'.join(map(json.dumps, requests)) + '\n',
+                            capture_output=True, text=True, timeout=60)
+
+    assert result.returncode == 0
+    responses = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [response['id'] for response in responses] == [1, 2]
+    assert responses[0]['success']
+    # Logging went to stderr rather than into the response frames
+    assert 'worker started' in result.stderr